@@ -0,0 +1,307 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+from aniposelib.boards import CharucoBoard, Checkerboard, merge_rows, extract_points
+from run_manifest import RunManifest
+
+# --- SETTINGS ---
+CACHE_DIR = "calibration_cache"     # one .npz of board detections per video and detection setting
+FRAME_SAMPLING = "stride"           # "all", "stride" (every STRIDE-th frame) or "motion" (only after the view changed)
+STRIDE = 5
+MOTION_THRESHOLD = 4.0              # mean gray-level change (0-255, on a 1/8-size frame) since the last frame kept
+MOTION_SCALE = 1 / 8
+RANGE_FRAMES = 600                  # frames per detection task, so long videos are split across workers
+MIN_BOARD_IDS = 8                   # board views with fewer corners are not used (as in calibrate_rows)
+
+
+# --- BOARDS ---
+# Boards are described by a plain dict so the spec can be sent to worker
+# processes (the OpenCV detector objects cannot be pickled) and hashed into
+# the cache key.
+def make_board(spec):
+    spec = dict(spec)
+    kind = spec.pop("kind")
+    if kind == "charuco":
+        return CharucoBoard(**spec)
+    if kind == "checkerboard":
+        return Checkerboard(**spec)
+    raise ValueError(f"unknown board kind: {kind}")
+
+
+def detection_key(video_hash, board_spec, sampling, stride, motion_threshold):
+    # anything that changes which corners are found; bundle-adjustment
+    # settings are deliberately not part of it
+    params = {"video": video_hash, "board": board_spec, "sampling": sampling}
+    if sampling == "stride":
+        params["stride"] = stride
+    elif sampling == "motion":
+        params["motion_threshold"] = motion_threshold
+    text = json.dumps(params, sort_keys=True)
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+
+def cache_path(cache_dir, video, key):
+    base = os.path.splitext(os.path.basename(video))[0]
+    return os.path.join(cache_dir, f"{base}_{key}.npz")
+
+
+# --- DETECTION ---
+worker_board = None
+
+
+def init_worker(board_spec):
+    global worker_board
+    worker_board = make_board(board_spec)
+
+
+def frame_count(video):
+    cap = cv2.VideoCapture(video)
+    if not cap.isOpened():
+        raise FileNotFoundError(f'missing video file "{video}"')
+    n = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return n
+
+
+def detect_range(video, start, stop, sampling, stride, motion_threshold):
+    # board detections in frames start..stop-1 (stop None = to the end) as
+    # (framenums, corner counts, corners (M, 2), ids (M,)); frames skipped by
+    # the sampling are grabbed but never decoded into an image
+    cap = cv2.VideoCapture(video)
+    if not cap.isOpened():
+        raise FileNotFoundError(f'missing video file "{video}"')
+    if start:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    framenums, counts, corners, ids = [], [], [], []
+    previous = None
+    framenum = start
+    while stop is None or framenum < stop:
+        if sampling == "stride" and framenum % stride:
+            if not cap.grab():
+                break
+            framenum += 1
+            continue
+        ok, frame = cap.read()
+        if not ok:
+            break
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        if sampling == "motion":
+            small = cv2.resize(gray, None, fx=MOTION_SCALE, fy=MOTION_SCALE,
+                               interpolation=cv2.INTER_AREA).astype(np.float32)
+            if previous is not None and np.mean(np.abs(small - previous)) < motion_threshold:
+                framenum += 1
+                continue
+            previous = small
+        found, found_ids = worker_board.detect_image(gray)
+        if found is not None and len(found) > 0:
+            framenums.append(framenum)
+            counts.append(len(found))
+            corners.append(np.asarray(found, dtype=np.float32).reshape(-1, 2))
+            ids.append(np.asarray(found_ids, dtype=np.int32).reshape(-1))
+        framenum += 1
+    cap.release()
+    return (np.array(framenums, dtype=np.int64), np.array(counts, dtype=np.int64),
+            np.concatenate(corners) if corners else np.empty((0, 2), np.float32),
+            np.concatenate(ids) if ids else np.empty(0, np.int32))
+
+
+def merge_ranges(parts):
+    # detect_range results of consecutive ranges -> one, frames ascending
+    parts = sorted(parts, key=lambda p: p[0])
+    return tuple(np.concatenate([p[1][i] for p in parts]) for i in range(4))
+
+
+def save_detections(path, detections):
+    framenums, counts, corners, ids = detections
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, framenums=framenums, counts=counts, corners=corners, ids=ids)
+    os.replace(tmp_path, path)
+
+
+def load_detections(path):
+    with np.load(path) as data:
+        return data["framenums"], data["counts"], data["corners"], data["ids"]
+
+
+def detections_to_rows(detections, prefix, board):
+    # the row dicts aniposelib's detect_video returns, ready for calibrate_rows
+    framenums, counts, corners, ids = detections
+    rows = []
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    for framenum, a, b in zip(framenums, offsets[:-1], offsets[1:]):
+        rows.append({
+            "framenum": (prefix, int(framenum)),
+            "corners": corners[a:b].reshape(-1, 1, 2),
+            "ids": ids[a:b].reshape(-1, 1),
+        })
+    return board.fill_points_rows(rows)
+
+
+def detect_boards(videos, board_spec, sampling=FRAME_SAMPLING, stride=STRIDE, motion_threshold=MOTION_THRESHOLD,
+                  workers=None, cache_dir=CACHE_DIR, range_frames=RANGE_FRAMES):
+    # videos: one list of video paths per camera, as for
+    # CameraGroup.calibrate_videos. Returns the per-camera rows for
+    # CameraGroup.calibrate_rows. Videos with a cached detection for the same
+    # content, board and sampling are not decoded at all; the rest are split
+    # into frame ranges and detected in a process pool.
+    os.makedirs(cache_dir, exist_ok=True)
+    hashes = RunManifest(os.path.join(cache_dir, "video_hashes.json"))
+    if sampling == "motion":
+        # each range starts its own motion reference; keep ranges long
+        range_frames = max(range_frames, 10 * RANGE_FRAMES)
+
+    detections = {}
+    pending = {}
+    for video in sorted({v for cam_videos in videos for v in cam_videos}):
+        key = detection_key(hashes.file_hash(video), board_spec, sampling, stride, motion_threshold)
+        path = cache_path(cache_dir, video, key)
+        if os.path.exists(path):
+            detections[video] = load_detections(path)
+        else:
+            pending[video] = path
+    hashes.save()
+    print(f"🗂 {len(detections)} videos from the detection cache, {len(pending)} to detect")
+
+    tasks = []
+    for video in pending:
+        n = frame_count(video)
+        if n <= 0:
+            tasks.append((video, 0, None))
+        else:
+            tasks.extend((video, start, min(start + range_frames, n)) for start in range(0, n, range_frames))
+
+    if tasks:
+        t0 = time.perf_counter()
+        parts = {video: [] for video in pending}
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 1 or len(tasks) <= 1:
+            init_worker(board_spec)
+            for video, start, stop in tasks:
+                parts[video].append((start, detect_range(video, start, stop, sampling, stride, motion_threshold)))
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=init_worker,
+                                     initargs=(board_spec,)) as pool:
+                futures = {pool.submit(detect_range, video, start, stop, sampling, stride, motion_threshold):
+                           (video, start) for video, start, stop in tasks}
+                for future in as_completed(futures):
+                    video, start = futures[future]
+                    parts[video].append((start, future.result()))
+        for video, path in pending.items():
+            detections[video] = merge_ranges(parts[video])
+            save_detections(path, detections[video])
+        print(f"🔎 Detected boards in {len(pending)} videos ({len(tasks)} frame ranges) "
+              f"in {time.perf_counter() - t0:.1f}s")
+
+    board = make_board(board_spec)
+    all_rows = []
+    for cam_videos in videos:
+        rows = []
+        for vnum, video in enumerate(cam_videos):
+            rows.extend(detections_to_rows(detections[video], vnum, board))
+        print(f"   {os.path.basename(cam_videos[0]) if cam_videos else '-'}: {len(rows)} boards detected")
+        all_rows.append(rows)
+    return all_rows
+
+
+# --- INCREMENTAL REFINEMENT ---
+def board_points(cgroup, all_rows, board):
+    # (C, N, 2) board corners seen by at least two cameras, plus the board
+    # poses bundle adjustment uses, from per-camera detection rows
+    all_rows = [board.estimate_pose_rows(cam, rows) for cam, rows in zip(cgroup.cameras, all_rows)]
+    rows = [[r for r in cam_rows if r["ids"].size >= MIN_BOARD_IDS] for cam_rows in all_rows]
+    merged = merge_rows(rows)
+    if not merged:
+        raise ValueError("no usable board views in the refinement clip")
+    return extract_points(merged, board, cam_names=list(range(len(rows))), min_cameras=2)
+
+
+def mean_error(cgroup, imgp):
+    p3ds = cgroup.triangulate(imgp, progress=False)
+    return float(np.nanmean(cgroup.reprojection_error(p3ds, imgp, mean=True)))
+
+
+def camera_poses(cgroup):
+    poses = []
+    for cam in cgroup.cameras:
+        rotation = cv2.Rodrigues(np.asarray(cam.get_rotation(), dtype=np.float64))[0]
+        poses.append((rotation, np.asarray(cam.get_translation(), dtype=np.float64).ravel()))
+    return poses
+
+
+def keep_world_frame(cgroup, previous, reference):
+    # Bundle adjustment is free to move the whole rig; move it back so the
+    # reference camera keeps its previous pose and earlier 3D data stays in
+    # the same coordinates
+    r_ref, t_ref = camera_poses(cgroup)[reference]
+    r_old, t_old = previous[reference]
+    r_gauge = r_ref.T @ r_old
+    t_gauge = r_ref.T @ (t_old - t_ref)
+    for cam, (rotation, translation) in zip(cgroup.cameras, camera_poses(cgroup)):
+        cam.set_rotation(cv2.Rodrigues(rotation @ r_gauge)[0].ravel())
+        cam.set_translation(rotation @ t_gauge + translation)
+
+
+def extrinsics_delta(previous, current, names):
+    # per camera: rotation change in degrees and how far the camera centre moved
+    delta = {}
+    for name, (r0, t0), (r1, t1) in zip(names, previous, current):
+        angle = np.linalg.norm(cv2.Rodrigues(r1 @ r0.T)[0])
+        shift = np.linalg.norm(-r1.T @ t1 + r0.T @ t0)
+        delta[name] = {"rotation_deg": round(float(np.degrees(angle)), 4), "center_shift": round(float(shift), 3)}
+    return delta
+
+
+def refine_calibration(cgroup, all_rows, board, reference=0, only_extrinsics=True, **kwargs):
+    # Warm-started bundle adjustment: cgroup comes from an existing
+    # calibration and is adjusted in place to the detections of a short new
+    # board clip (no intrinsic or extrinsic re-initialisation). Returns the
+    # error on the new clip before and after and the per-camera extrinsics change.
+    imgp, extra = board_points(cgroup, all_rows, board)
+    previous = camera_poses(cgroup)
+    error_before = mean_error(cgroup, imgp)
+    t0 = time.perf_counter()
+    cgroup.bundle_adjust_iter(imgp, extra, only_extrinsics=only_extrinsics, verbose=False, **kwargs)
+    keep_world_frame(cgroup, previous, reference)
+    return {
+        "board_corners": int(imgp.shape[1]),
+        "error_before": round(error_before, 4),
+        "error_after": round(mean_error(cgroup, imgp), 4),
+        "seconds": round(time.perf_counter() - t0, 2),
+        "reference_camera": cgroup.get_names()[reference],
+        "only_extrinsics": only_extrinsics,
+        "cameras": extrinsics_delta(previous, camera_poses(cgroup), cgroup.get_names()),
+    }
+
+
+def print_refinement(report):
+    print(f"📐 {report['board_corners']} board corners: reprojection error "
+          f"{report['error_before']:.3f} -> {report['error_after']:.3f} px in {report['seconds']:.1f}s")
+    for name, delta in report["cameras"].items():
+        note = " (reference)" if name == report["reference_camera"] else ""
+        print(f"   cam {name}: rotated {delta['rotation_deg']:.3f} deg, centre moved {delta['center_shift']:.1f}{note}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detect calibration boards with caching; reports cold and cached timings")
+    parser.add_argument("videos", nargs="+", help="one video per camera")
+    parser.add_argument("--sampling", default=FRAME_SAMPLING, choices=["all", "stride", "motion"])
+    parser.add_argument("--stride", type=int, default=STRIDE)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--board", default='{"kind": "charuco", "squaresX": 10, "squaresY": 7, '
+                                           '"square_length": 59, "marker_length": 44, "marker_bits": 4, "dict_size": 50}')
+    args = parser.parse_args()
+    spec = json.loads(args.board)
+    for label in ["first run", "cached run"]:
+        t0 = time.perf_counter()
+        rows = detect_boards([[v] for v in args.videos], spec, sampling=args.sampling, stride=args.stride,
+                             workers=args.workers, cache_dir=args.cache_dir)
+        print(f"⏱ {label}: {time.perf_counter() - t0:.2f}s, {sum(len(r) for r in rows)} detections\n")
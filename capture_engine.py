@@ -0,0 +1,587 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import queue
+import re
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+# --- CAPTURE ENGINE SETTINGS ---
+RING_CAPACITY = 32          # frame slots per camera between grabber and writer (~1 s at 30 fps)
+FIRST_FRAME_RETRIES = 30    # reads allowed for the camera to deliver its first frame
+CAPTURE_RETRY_SLEEP = 0.005 # back-off after a failed cap.read() so a dead camera does not spin
+DEFAULT_FPS = 30.0          # used when the driver does not report CAP_PROP_FPS
+TIMESTAMP_SUFFIX = "_timestamps.bin"  # little-endian int64 time.monotonic_ns() per written frame
+PREVIEW_HZ = 10             # preview refresh rate, independent of the capture rate
+PREVIEW_SIZE = (640, 360)   # (width, height) of each camera tile in the preview window
+ENCODER_MODE = "thread"     # "thread": writer thread per camera, "process": encoder process per camera
+SEGMENT_SECONDS = 30        # length of each rolling segment file; 0 records one file per trial
+SEGMENT_MANIFEST = "segments.json"
+SEGMENT_PATTERN = re.compile(r"_seg(\d{3,})$")
+
+
+def timestamp_path_for(video_filename):
+    return os.path.splitext(video_filename)[0] + TIMESTAMP_SUFFIX
+
+
+def camera_fps(cap):
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    return fps if fps and fps > 0 else DEFAULT_FPS
+
+
+def segment_path_for(video_filename, segment):
+    root, ext = os.path.splitext(video_filename)
+    return f"{root}_seg{segment:03d}{ext}"
+
+
+def is_segment_file(filename):
+    return SEGMENT_PATTERN.search(os.path.splitext(os.path.basename(filename))[0]) is not None
+
+
+def mp_context():
+    # spawn everywhere so Linux behaves like the Windows lab laptops
+    return multiprocessing.get_context("spawn")
+
+
+# --- FRAME RING BUFFER ---
+class FrameRing:
+    # Fixed pool of preallocated frame slots. Only slot indexes travel through
+    # the free/filled queues; the pixels stay where the grabber decoded them.
+    # The newest decoded slot is published as `latest`; the preview pins it
+    # while downsampling and the grabber never decodes into the latest or the
+    # pinned slot, so the preview reads the frame in place without a copy.
+    # With shared=True the slots and timestamps live in shared memory and the
+    # queues are multiprocessing queues, so an encoder process can attach to
+    # the same pixels.
+    def __init__(self, capacity, frame_shape, dtype=np.uint8, shared=False):
+        self.capacity = capacity
+        self.shape = (capacity,) + tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.shared = shared
+        if shared:
+            ctx = mp_context()
+            nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.ts_shm = shared_memory.SharedMemory(create=True, size=capacity * 8)
+            self.slots = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+            self.timestamps = np.ndarray((capacity,), dtype=np.int64, buffer=self.ts_shm.buf)
+            self.free = ctx.Queue()
+            self.filled = ctx.Queue()
+        else:
+            self.slots = np.empty(self.shape, dtype=self.dtype)
+            self.timestamps = np.zeros(capacity, dtype=np.int64)
+            self.free = queue.Queue()
+            self.filled = queue.Queue()
+        for idx in range(capacity):
+            self.free.put(idx)
+        self.lock = threading.Lock()
+        self.latest = -1
+        self.latest_seq = 0
+        self.pinned = -1
+
+    def acquire_free(self):
+        # raises queue.Empty when every free slot is the latest or the pinned one
+        for _ in range(self.capacity):
+            idx = self.free.get_nowait()
+            with self.lock:
+                usable = idx != self.latest and idx != self.pinned
+            if usable:
+                return idx
+            self.free.put(idx)
+        raise queue.Empty
+
+    def publish(self, idx):
+        with self.lock:
+            self.latest = idx
+            self.latest_seq += 1
+
+    def pin_latest(self):
+        with self.lock:
+            if self.latest < 0:
+                return -1, 0
+            self.pinned = self.latest
+            return self.pinned, self.latest_seq
+
+    def unpin(self):
+        with self.lock:
+            self.pinned = -1
+
+    def release(self):
+        if not self.shared:
+            return
+        # numpy views must go before the shared blocks can be closed
+        self.slots = None
+        self.timestamps = None
+        for shm in (self.shm, self.ts_shm):
+            shm.close()
+            shm.unlink()
+
+
+# --- SEGMENT MANIFEST ---
+class SegmentManifest:
+    # Per-session list of finalized segments. Rewritten atomically after every
+    # segment, so after a crash it lists exactly the files that are complete.
+    def __init__(self, path, session_info, segment_seconds=SEGMENT_SECONDS):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = dict(session_info, segment_seconds=segment_seconds, complete=False, segments=[])
+        self._write()
+
+    def add(self, entry):
+        with self.lock:
+            self.data["segments"].append(entry)
+            self._write()
+
+    def finish(self):
+        with self.lock:
+            self.data["complete"] = True
+            self._write()
+
+    def _write(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+
+def finished_segment_files(base_dir):
+    # basenames of every segment video listed in a manifest under base_dir
+    finished = set()
+    for root, dirs, files in os.walk(base_dir):
+        if SEGMENT_MANIFEST not in files:
+            continue
+        try:
+            with open(os.path.join(root, SEGMENT_MANIFEST), "r") as f:
+                manifest = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        for entry in manifest.get("segments", []):
+            finished.add(os.path.basename(entry["video"]))
+    return finished
+
+
+# --- SEGMENT WRITER ---
+class SegmentWriter:
+    # VideoWriter plus timestamp sidecar that rotates to a new file whenever a
+    # frame crosses a segment boundary. Boundaries are counted from a session
+    # start shared by all cameras, so segment k of every camera covers the
+    # same time window.
+    def __init__(self, filename, fourcc, fps, frame_size, camera="", segment_seconds=0,
+                 session_start_ns=None, on_segment=None):
+        self.filename = filename
+        self.fourcc = fourcc
+        self.fps = fps
+        self.frame_size = frame_size
+        self.camera = camera
+        self.segment_ns = int(segment_seconds * 1e9)
+        self.session_start_ns = session_start_ns
+        self.on_segment = on_segment
+        self.segment = None
+        self.out = None
+        self.ts_file = None
+        self.video_path = None
+        self.frames = 0
+        self.first_ts = None
+        self.last_ts = None
+
+    def _open(self, segment):
+        self.segment = segment
+        self.video_path = segment_path_for(self.filename, segment) if self.segment_ns else self.filename
+        self.out = cv2.VideoWriter(self.video_path, self.fourcc, self.fps, self.frame_size)
+        if not self.out.isOpened():
+            print(f"⚠ VideoWriter could not open {self.video_path}, every frame will count as a writer drop")
+        self.ts_file = open(timestamp_path_for(self.video_path), "wb")
+        self.frames = 0
+        self.first_ts = None
+
+    def _finish(self):
+        if self.out is None:
+            return
+        self.out.release()
+        self.ts_file.close()
+        self.out = None
+        if self.on_segment is not None and self.frames > 0:
+            self.on_segment({
+                "camera": self.camera,
+                "segment": self.segment,
+                "video": self.video_path,
+                "timestamps": timestamp_path_for(self.video_path),
+                "frames": self.frames,
+                "start_ns": self.first_ts,
+                "end_ns": self.last_ts,
+            })
+
+    def write(self, frame, ts):
+        segment = 0
+        if self.segment_ns:
+            if self.session_start_ns is None:
+                self.session_start_ns = ts
+            segment = max(0, (ts - self.session_start_ns) // self.segment_ns)
+        if segment != self.segment:
+            self._finish()
+            self._open(segment)
+        if not self.out.isOpened():
+            return False
+        self.out.write(frame)
+        self.ts_file.write(struct.pack("<q", ts))
+        if self.first_ts is None:
+            self.first_ts = ts
+        self.last_ts = ts
+        self.frames += 1
+        return True
+
+    def close(self):
+        self._finish()
+
+
+# --- ENCODER (same loop for the writer thread and the encoder process) ---
+def encode_slots(slots, timestamps, filled, free, writer):
+    stats = {"frame_count": 0, "writer": 0, "first_ts": None, "last_ts": None, "encode_seconds": 0.0}
+    while True:
+        idx = filled.get()
+        if idx is None:
+            break
+        ts = int(timestamps[idx])
+        t0 = time.perf_counter()
+        try:
+            written = writer.write(slots[idx], ts)
+        except (cv2.error, OSError):
+            written = False
+        stats["encode_seconds"] += time.perf_counter() - t0
+        if written:
+            if stats["first_ts"] is None:
+                stats["first_ts"] = ts
+            stats["last_ts"] = ts
+            stats["frame_count"] += 1
+        else:
+            stats["writer"] += 1
+        free.put(idx)
+    writer.close()
+    return stats
+
+
+def encode_process(shm_name, ts_shm_name, shape, dtype, filled, free, results,
+                   filename, fourcc, fps, camera, segment_seconds, session_start_ns):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    ts_shm = shared_memory.SharedMemory(name=ts_shm_name)
+    slots = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    timestamps = np.ndarray((shape[0],), dtype=np.int64, buffer=ts_shm.buf)
+
+    writer = SegmentWriter(filename, fourcc, fps, (shape[2], shape[1]), camera=camera,
+                           segment_seconds=segment_seconds, session_start_ns=session_start_ns,
+                           on_segment=lambda entry: results.put(("segment", entry)))
+    stats = encode_slots(slots, timestamps, filled, free, writer)
+
+    del slots, timestamps
+    shm.close()
+    ts_shm.close()
+    results.put(("done", stats))
+
+
+# --- PER-CAMERA RECORDER (grab thread -> ring -> writer thread/process) ---
+class CameraRecorder:
+    # open() starts the grab thread that owns the capture device for the whole
+    # session (preview included); start_recording()/stop_recording() only add
+    # and remove the encoder behind the ring.
+    def __init__(self, cap, filename, fourcc, fps=None, ring_capacity=RING_CAPACITY,
+                 encoder_mode=ENCODER_MODE, segment_seconds=SEGMENT_SECONDS, name=None):
+        self.cap = cap
+        self.filename = filename
+        self.name = name or os.path.splitext(os.path.basename(filename))[0]
+        self.segment_seconds = segment_seconds
+        self.fourcc = fourcc
+        self.fps = fps if fps else camera_fps(cap)
+        self.ring_capacity = ring_capacity
+        self.encoder_mode = encoder_mode
+        self.ring = None
+        self.frame_count = 0
+        self.dropped = {"capture": 0, "queue": 0, "writer": 0}
+        self.encode_seconds = 0.0
+        self.start_time_ns = None
+        self.first_ts = None
+        self.last_ts = None
+        self.running = threading.Event()
+        self.recording = threading.Event()
+        self.grab_thread = None
+        self.encoder = None
+        self.results = None
+        self.collector = None
+        self.manifest = None
+        self._held = -1  # latest slot kept for the preview only, not owned by the encoder
+
+    def _read_first_frame(self):
+        for _ in range(FIRST_FRAME_RETRIES):
+            ret, frame = self.cap.read()
+            if ret and frame is not None:
+                return frame
+            time.sleep(CAPTURE_RETRY_SLEEP)
+        raise RuntimeError(f"camera for {self.filename} did not deliver a frame")
+
+    def open(self):
+        frame = self._read_first_frame()
+        self.ring = FrameRing(self.ring_capacity, frame.shape, frame.dtype,
+                              shared=self.encoder_mode == "process")
+        self.running.set()
+        self.grab_thread = threading.Thread(target=self._grab_loop)
+        self.grab_thread.start()
+
+    def start_recording(self, session_start_ns=None, manifest=None):
+        ring = self.ring
+        height, width = ring.shape[1:3]
+        print(f"📹 Camera {self.cap} recording at {width}x{height} ({self.encoder_mode} encoder)")
+
+        self.start_time_ns = time.time_ns()
+        self.manifest = manifest
+        if self.encoder_mode == "process":
+            ctx = mp_context()
+            self.results = ctx.Queue()
+            self.encoder = ctx.Process(
+                target=encode_process,
+                args=(ring.shm.name, ring.ts_shm.name, ring.shape, ring.dtype.str,
+                      ring.filled, ring.free, self.results,
+                      self.filename, self.fourcc, self.fps,
+                      self.name, self.segment_seconds, session_start_ns),
+                daemon=True)
+            self.collector = threading.Thread(target=self._collect_loop)
+            self.collector.start()
+        else:
+            writer = SegmentWriter(self.filename, self.fourcc, self.fps, (width, height), camera=self.name,
+                                   segment_seconds=self.segment_seconds, session_start_ns=session_start_ns,
+                                   on_segment=self._segment_done)
+            self.encoder = threading.Thread(target=self._write_loop, args=(writer,))
+        self.encoder.start()
+        self.recording.set()
+
+    def stop_recording(self):
+        # the grab thread queues the encoder's stop sentinel itself, after its
+        # last recorded frame, so no slot is left behind in the filled queue
+        self.recording.clear()
+        if self.collector is not None:
+            self.collector.join()
+        self.encoder.join()
+
+    def close(self):
+        self.running.clear()
+        if self.grab_thread is not None:
+            self.grab_thread.join()
+        if self.ring is not None:
+            self.ring.release()
+
+    def _segment_done(self, entry):
+        if self.manifest is not None:
+            self.manifest.add(entry)
+        print(f"💾 Segment finalized: {os.path.basename(entry['video'])} ({entry['frames']} frames)")
+
+    def _collect_loop(self):
+        # forwards the encoder process's segment events into the manifest
+        while True:
+            kind, payload = self.results.get()
+            if kind == "segment":
+                self._segment_done(payload)
+            else:
+                self._collect(payload)
+                break
+
+    def _collect(self, stats):
+        self.frame_count = stats["frame_count"]
+        self.dropped["writer"] += stats["writer"]
+        self.first_ts = stats["first_ts"]
+        self.last_ts = stats["last_ts"]
+        self.encode_seconds = stats["encode_seconds"]
+
+    def _grab_loop(self):
+        ring = self.ring
+        was_recording = False
+        while self.running.is_set():
+            recording = self.recording.is_set()
+            if was_recording and not recording:
+                ring.filled.put(None)
+            was_recording = recording
+            try:
+                idx = ring.acquire_free()
+            except queue.Empty:
+                # encoder is behind: keep draining the driver so capture timing
+                # stays intact, and account the frame as a queue drop
+                if self.cap.grab():
+                    if recording:
+                        self.dropped["queue"] += 1
+                else:
+                    if recording:
+                        self.dropped["capture"] += 1
+                    time.sleep(CAPTURE_RETRY_SLEEP)
+                continue
+
+            slot = ring.slots[idx]
+            # timestamp at grab(), the moment the frame leaves the driver;
+            # retrieve() only decodes it into the slot
+            ret = self.cap.grab()
+            ts = time.monotonic_ns()
+            frame = None
+            if ret:
+                ret, frame = self.cap.retrieve(slot)
+            if not ret or frame is None or frame.shape != slot.shape:
+                if recording:
+                    self.dropped["capture"] += 1
+                ring.free.put(idx)
+                time.sleep(CAPTURE_RETRY_SLEEP)
+                continue
+            if frame.ctypes.data != slot.ctypes.data:
+                np.copyto(slot, frame)
+            ring.timestamps[idx] = ts
+
+            ring.publish(idx)
+            if self._held >= 0:
+                ring.free.put(self._held)
+                self._held = -1
+            if recording:
+                ring.filled.put(idx)
+            else:
+                self._held = idx
+
+        if was_recording:
+            ring.filled.put(None)
+
+    def _write_loop(self, writer):
+        ring = self.ring
+        self._collect(encode_slots(ring.slots, ring.timestamps, ring.filled, ring.free, writer))
+
+    def measured_fps(self):
+        if self.frame_count < 2 or self.last_ts == self.first_ts:
+            return 0.0
+        return (self.frame_count - 1) * 1e9 / (self.last_ts - self.first_ts)
+
+    def encoder_capacity_fps(self):
+        # frames the encoder could sustain if it never waited for the camera
+        if self.encode_seconds <= 0:
+            return 0.0
+        return self.frame_count / self.encode_seconds
+
+    def report(self):
+        print(f"📁 Recording stopped: {self.filename}")
+        print(f"🕒 Start time: {datetime.datetime.fromtimestamp(self.start_time_ns / 1e9).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}")
+        print(f"🎞 Frame count: {self.frame_count} (measured {self.measured_fps():.2f} fps, writer set to {self.fps:.2f})")
+        print(f"⚙ Encoder capacity: {self.encoder_capacity_fps():.1f} fps")
+        print(f"🧮 Dropped frames (capture/queue/writer): "
+              f"{self.dropped['capture']}/{self.dropped['queue']}/{self.dropped['writer']}")
+
+
+# --- PREVIEW (samples the rings, never the capture devices) ---
+class PreviewSampler:
+    def __init__(self, rings, size=PREVIEW_SIZE):
+        self.rings = rings
+        self.size = size
+        self.tiles = [np.zeros((size[1], size[0]) + ring.shape[3:], dtype=ring.dtype)
+                      for ring in rings]
+        self.seen = [0] * len(rings)
+
+    def sample(self):
+        for i, ring in enumerate(self.rings):
+            idx, seq = ring.pin_latest()
+            try:
+                if idx >= 0 and seq != self.seen[i]:
+                    cv2.resize(ring.slots[idx], self.size, dst=self.tiles[i],
+                               interpolation=cv2.INTER_NEAREST)
+                    self.seen[i] = seq
+            finally:
+                ring.unpin()
+        return self.tiles
+
+
+# --- THROUGHPUT REPORT (synthetic cameras, no hardware needed) ---
+class SyntheticCamera:
+    # stands in for cv2.VideoCapture; cycles through a few noisy frames so the
+    # MJPG encoder sees realistic entropy, optionally paced to a target fps
+    def __init__(self, width, height, fps=0.0, n_patterns=8, seed=0):
+        rng = np.random.default_rng(seed)
+        base = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+        self.patterns = [np.clip(base + rng.normal(0, 25, (height, width, 3)), 0, 255).astype(np.uint8)
+                         for _ in range(n_patterns)]
+        self.fps = fps
+        self.count = 0
+        self.next_time = time.perf_counter()
+
+    def get(self, prop):
+        return self.fps if prop == cv2.CAP_PROP_FPS else 0.0
+
+    def grab(self):
+        if self.fps > 0:
+            self.next_time += 1.0 / self.fps
+            delay = self.next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        self.count += 1
+        return True
+
+    def retrieve(self, image=None):
+        frame = self.patterns[self.count % len(self.patterns)]
+        if image is None:
+            return True, frame.copy()
+        np.copyto(image, frame)
+        return True, image
+
+    def read(self, image=None):
+        self.grab()
+        return self.retrieve(image)
+
+    def release(self):
+        pass
+
+
+def throughput_report(n_cameras=3, width=1920, height=1080, seconds=10.0, fps=0.0,
+                      encoder_mode=ENCODER_MODE, out_dir="throughput_test"):
+    # records synthetic frames from n_cameras through the real ring/encoder path
+    # and prints the sustained fps each camera achieved
+    os.makedirs(out_dir, exist_ok=True)
+    fourcc = cv2.VideoWriter_fourcc(*"MJPG")
+    recorders = []
+    for i in range(n_cameras):
+        cap = SyntheticCamera(width, height, fps=fps, seed=i)
+        filename = os.path.join(out_dir, f"throughput_cam{i + 1}.avi")
+        recorder = CameraRecorder(cap, filename, fourcc, fps=fps or DEFAULT_FPS,
+                                  encoder_mode=encoder_mode, segment_seconds=0)
+        recorder.open()
+        recorders.append(recorder)
+
+    print(f"⏱ {n_cameras} cameras at {width}x{height}, {encoder_mode} encoders, {seconds:.0f} s")
+    for recorder in recorders:
+        recorder.start_recording()
+    time.sleep(seconds)
+    for recorder in recorders:
+        recorder.stop_recording()
+    for recorder in recorders:
+        recorder.close()
+
+    rows = []
+    for i, recorder in enumerate(recorders):
+        row = {
+            "camera": i + 1,
+            "frames": recorder.frame_count,
+            "sustained_fps": round(recorder.measured_fps(), 2),
+            "encoder_capacity_fps": round(recorder.encoder_capacity_fps(), 2),
+            "dropped": dict(recorder.dropped),
+        }
+        rows.append(row)
+        print(f"   cam{row['camera']}: {row['sustained_fps']:.1f} fps sustained, "
+              f"encoder capacity {row['encoder_capacity_fps']:.1f} fps, "
+              f"queue drops {row['dropped']['queue']}")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sustained recording throughput with synthetic cameras")
+    parser.add_argument("--cameras", type=int, default=3)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--fps", type=float, default=0.0, help="pace each camera (0 = as fast as possible)")
+    parser.add_argument("--mode", choices=["thread", "process"], default=ENCODER_MODE)
+    parser.add_argument("--out-dir", default="throughput_test")
+    args = parser.parse_args()
+    throughput_report(args.cameras, args.width, args.height, args.seconds, args.fps, args.mode, args.out_dir)
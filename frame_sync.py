@@ -0,0 +1,123 @@
+import os
+
+import numpy as np
+
+from capture_engine import TIMESTAMP_SUFFIX
+
+# --- SYNC SETTINGS ---
+DEFAULT_TOLERANCE_MS = 17   # about half a frame period at 30 fps
+
+
+# --- TIMESTAMP SIDECARS ---
+def read_timestamps(path):
+    return np.fromfile(path, dtype="<i8")
+
+
+def index_timestamp_files(video_dir):
+    # {video base name: sidecar path}, built with one walk of the recordings folder
+    found = {}
+    for root, dirs, files in os.walk(video_dir):
+        for file in files:
+            if file.endswith(TIMESTAMP_SUFFIX):
+                found[file[:-len(TIMESTAMP_SUFFIX)]] = os.path.join(root, file)
+    return found
+
+
+def video_base_from_pose_file(fname):
+    # AlphaPose_output_person_001_x_cam1_<time>_filtered.h5 -> output_person_001_x_cam1_<time>
+    base = os.path.splitext(os.path.basename(fname))[0]
+    if base.startswith("AlphaPose_"):
+        base = base[len("AlphaPose_"):]
+    if base.endswith("_filtered"):
+        base = base[:-len("_filtered")]
+    return base
+
+
+# --- ALIGNMENT INDEX ---
+def nearest_indices(src_ts, dst_ts):
+    # index into src_ts of the nearest sample for every entry of dst_ts
+    pos = np.searchsorted(src_ts, dst_ts)
+    pos = np.clip(pos, 1, len(src_ts) - 1)
+    left = src_ts[pos - 1]
+    right = src_ts[pos]
+    return np.where(dst_ts - left <= right - dst_ts, pos - 1, pos)
+
+
+def build_sync_index(timestamps_list, tolerance_ms=DEFAULT_TOLERANCE_MS, reference=0):
+    # rows follow the reference camera; index[row, cam] is the matched frame or -1
+    ref_ts = timestamps_list[reference]
+    tolerance_ns = int(tolerance_ms * 1e6)
+
+    index = np.full((len(ref_ts), len(timestamps_list)), -1, dtype=np.int64)
+    offsets_ms = np.full(index.shape, np.nan)
+    for cam, ts in enumerate(timestamps_list):
+        if len(ts) == 0:
+            continue
+        if len(ts) == 1:
+            nearest = np.zeros(len(ref_ts), dtype=np.int64)
+        else:
+            nearest = nearest_indices(ts, ref_ts)
+        delta = ts[nearest] - ref_ts
+        ok = np.abs(delta) <= tolerance_ns
+        index[ok, cam] = nearest[ok]
+        offsets_ms[ok, cam] = delta[ok] / 1e6
+
+    return {
+        "reference": reference,
+        "timestamps": ref_ts,
+        "index": index,
+        "offsets_ms": offsets_ms,
+    }
+
+
+def apply_sync_index(points, scores, index):
+    # points: per camera (frames, joints, 2), scores: per camera (frames, joints)
+    n_rows, n_cams = index.shape
+    n_joints = points[0].shape[1]
+    out_points = np.full((n_cams, n_rows, n_joints, 2), np.nan)
+    out_scores = np.zeros((n_cams, n_rows, n_joints))
+    for cam in range(n_cams):
+        rows = index[:, cam]
+        ok = (rows >= 0) & (rows < len(points[cam]))
+        out_points[cam, ok] = points[cam][rows[ok]]
+        out_scores[cam, ok] = scores[cam][rows[ok]]
+    return out_points, out_scores
+
+
+def interpolate_to_timestamps(points, scores, src_ts, dst_ts, tolerance_ms=DEFAULT_TOLERANCE_MS, period=None):
+    # linear interpolation of one camera's 2D points onto dst_ts; samples whose
+    # bracketing frames are further apart than one frame period plus the
+    # tolerance (a dropped frame) or outside the recording stay NaN. Pass the
+    # recording's period when points/src_ts are only a slice of it.
+    n = min(len(points), len(src_ts))
+    points, scores, src_ts = points[:n], scores[:n], src_ts[:n]
+    out_points = np.full((len(dst_ts),) + points.shape[1:], np.nan)
+    out_scores = np.zeros((len(dst_ts),) + scores.shape[1:])
+    if n < 2:
+        return out_points, out_scores
+
+    if period is None:
+        period = np.median(np.diff(src_ts))
+    max_gap = period + tolerance_ms * 1e6
+    right = np.clip(np.searchsorted(src_ts, dst_ts), 1, n - 1)
+    left = right - 1
+    span = (src_ts[right] - src_ts[left]).astype(float)
+    w = np.divide(dst_ts - src_ts[left], span, out=np.zeros(len(dst_ts)), where=span > 0)
+    ok = (dst_ts >= src_ts[0]) & (dst_ts <= src_ts[-1]) & (span <= max_gap)
+
+    w3 = w[:, None, None]
+    interp = (1 - w3) * points[left] + w3 * points[right]
+    out_points[ok] = interp[ok]
+    out_scores[ok] = np.minimum(scores[left], scores[right])[ok]
+    return out_points, out_scores
+
+
+def summarize_sync(sync, cam_names):
+    index = sync["index"]
+    ref_name = cam_names[sync["reference"]]
+    print(f"⏱ Sync reference camera {ref_name}, {len(index)} rows")
+    for cam, name in enumerate(cam_names):
+        matched = index[:, cam] >= 0
+        offsets = np.abs(sync["offsets_ms"][matched, cam])
+        worst = offsets.max() if offsets.size else float("nan")
+        print(f"   cam {name}: {matched.sum()}/{len(index)} matched, max offset {worst:.1f} ms")
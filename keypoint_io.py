@@ -0,0 +1,384 @@
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import tables
+from frame_sync import read_timestamps, video_base_from_pose_file
+from pose_backend import COCO_KEYPOINTS
+from signal_filter import lowpass
+
+# --- SETTINGS ---
+SCORER = "AlphaPose"
+H5_KEY = "df_with_missing"
+OUTPUT_FORMATS = ("store", "csv", "h5")   # "store": session keypoint store; "csv"/"h5": legacy exports
+DETECTION_SELECTION = "score"   # "score": best detection per frame, "track": follow the previous box by IoU
+TRACK_MIN_IOU = 0.3             # below this the tracker falls back to the best-scoring detection
+JSON_READ_CHARS = 1 << 20       # characters read from the result file at a time
+DECODE_CHUNK_ENTRIES = 4096     # detections converted to arrays at a time
+GROW_FRAMES = 4096              # initial rows when the frame count is not known
+CSV_CHUNK_ROWS = 10000
+
+# --- SESSION STORE SETTINGS ---
+# one folder per recording session, one compressed file per camera (and
+# segment): <store>/<person>_<movement>_<time>/cam1[_seg000].h5
+STORE_SUFFIX = ".h5"
+STORE_CHUNK_FRAMES = 1024       # frames per compressed chunk; a frame-range read decodes only the chunks it touches
+STORE_COMPLIB = "blosc2:lz4"    # bit-shuffled LZ4: about 1/3 of the pandas H5 size, decoded faster than it is read
+STORE_COMPLEVEL = 5
+STORE_SIGNIFICANT_DIGIT = None  # e.g. 2: quantize to ~0.01 px for ~30% smaller files (lossy); None = exact float32
+SESSION_PATTERN = re.compile(r'output_(person_\d+_.+?)_(cam\d+)_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})(?:_seg(\d+))?$')
+
+
+# --- DECODING ---
+def frame_number(image_id):
+    # AlphaPose names frames "123.jpg"; some versions write the bare number
+    return int(os.path.splitext(str(image_id))[0])
+
+
+def box_iou(box, boxes):
+    # box [x, y, w, h] against (n, 4) boxes
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[0] + box[2], boxes[:, 0] + boxes[:, 2])
+    y2 = np.minimum(box[1] + box[3], boxes[:, 1] + boxes[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    union = box[2] * box[3] + boxes[:, 2] * boxes[:, 3] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+
+def select_detections(frames, scores, boxes, selection=DETECTION_SELECTION, min_iou=TRACK_MIN_IOU,
+                      prev_box=None):
+    # index of the kept detection for every distinct frame, frames ascending;
+    # prev_box carries the tracked box over from the previous chunk
+    order = np.lexsort((-scores, frames))
+    first = np.unique(frames[order], return_index=True)[1]
+    best = order[first]
+    if selection == "score":
+        return best
+    if selection != "track":
+        raise ValueError(f"unknown detection selection: {selection}")
+
+    # only frames with several people need the sequential tracker
+    bounds = list(first) + [len(order)]
+    kept = best.copy()
+    for k in range(len(first)):
+        candidates = order[bounds[k]:bounds[k + 1]]
+        if prev_box is not None and len(candidates) > 1:
+            iou = box_iou(prev_box, boxes[candidates])
+            if iou.max() >= min_iou:
+                kept[k] = candidates[np.argmax(iou)]
+        prev_box = boxes[kept[k]]
+    return kept
+
+
+def iter_json_array(path, read_chars=JSON_READ_CHARS):
+    # entries of a top-level JSON array, decoded one at a time while the file
+    # is read in fixed-size pieces, so the whole document is never in memory
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf = f.read(read_chars).lstrip()
+        if not buf.startswith("["):
+            raise ValueError(f"not a JSON array: {path}")
+        pos = 1
+        eof = False
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if buf.startswith("]", pos):
+                return
+            try:
+                if pos >= len(buf):
+                    raise json.JSONDecodeError("need more data", buf, pos)
+                entry, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise ValueError(f"truncated JSON array: {path}")
+                more = f.read(read_chars)
+                eof = not more
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            yield entry
+            if pos > read_chars:
+                # drop the text already decoded
+                buf = buf[pos:]
+                pos = 0
+
+
+class DenseKeypointDecoder:
+    # Writes AlphaPose entries (one per detection per image_id) chunk by chunk
+    # into a dense (frames, joints, 3) array; frames without a detection stay
+    # NaN. AlphaPose writes frames in order, so the entries of the last frame
+    # of a chunk are held back until the next one and the tracker always sees
+    # every detection of a frame together. out may be a preallocated array or
+    # np.memmap; without it or n_frames the array grows as frames arrive.
+    def __init__(self, n_frames=None, selection=DETECTION_SELECTION, out=None):
+        self.n_joints = len(COCO_KEYPOINTS)
+        self.selection = selection
+        self.fixed = out is not None or n_frames is not None
+        if out is None:
+            out = np.empty((n_frames or GROW_FRAMES, self.n_joints, 3))
+        out[:] = np.nan
+        self.dense = out
+        self.best_score = np.full(len(out), -np.inf)
+        self.n_seen = 0
+        self.entries = 0
+        self.prev_box = None
+        self.held = []
+
+    def _grow(self, needed):
+        size = max(needed, 2 * len(self.dense))
+        dense = np.full((size, self.n_joints, 3), np.nan)
+        dense[:len(self.dense)] = self.dense
+        best_score = np.full(size, -np.inf)
+        best_score[:len(self.best_score)] = self.best_score
+        self.dense, self.best_score = dense, best_score
+
+    def add(self, entries, final=False):
+        entries = self.held + list(entries)
+        self.held = []
+        if not entries:
+            return
+        frames = np.fromiter((frame_number(e["image_id"]) for e in entries), dtype=np.int64, count=len(entries))
+        if not final:
+            hold = frames == frames[-1]
+            self.held = [e for e, h in zip(entries, hold) if h]
+            entries = [e for e, h in zip(entries, hold) if not h]
+            frames = frames[~hold]
+            if not entries:
+                return
+        self._write(entries, frames)
+
+    def _write(self, entries, frames):
+        keypoints = np.asarray([e["keypoints"] for e in entries], dtype=np.float64)
+        if keypoints.ndim != 2 or keypoints.shape[1] != self.n_joints * 3:
+            raise ValueError("wrong JSON structure")
+        keypoints = keypoints.reshape(len(entries), self.n_joints, 3)
+        scores = np.fromiter((e.get("score", 0.0) for e in entries), dtype=np.float64, count=len(entries))
+        boxes = np.zeros((len(entries), 4))
+        if self.selection == "track":
+            boxes = np.asarray([e.get("box", [0, 0, 0, 0]) for e in entries], dtype=np.float64)
+        self.entries += len(entries)
+
+        kept = select_detections(frames, scores, boxes, self.selection, prev_box=self.prev_box)
+        if self.selection == "track":
+            self.prev_box = boxes[kept[-1]]
+        rows = frames[kept]
+        self.n_seen = max(self.n_seen, int(rows.max()) + 1)
+        if not self.fixed and self.n_seen > len(self.dense):
+            self._grow(self.n_seen)
+        inside = rows < len(self.dense)
+        rows, kept = rows[inside], kept[inside]
+        # a frame split across chunks keeps its best detection
+        better = scores[kept] > self.best_score[rows]
+        self.dense[rows[better]] = keypoints[kept[better]]
+        self.best_score[rows[better]] = scores[kept[better]]
+
+    def result(self):
+        self.add([], final=True)
+        if self.entries == 0:
+            return None
+        return self.dense if self.fixed else self.dense[:self.n_seen]
+
+
+def decode_detections(data, n_frames=None, selection=DETECTION_SELECTION):
+    # in-memory list of entries -> dense (frames, joints, 3) array
+    decoder = DenseKeypointDecoder(n_frames=n_frames, selection=selection)
+    decoder.add(data, final=True)
+    return decoder.result()
+
+
+def load_alphapose_json(path, n_frames=None, selection=DETECTION_SELECTION, out=None,
+                        chunk_entries=DECODE_CHUNK_ENTRIES):
+    # result file -> (frames, joints, 3) array of x, y, score, streamed so
+    # peak memory is one chunk of entries plus the output array
+    decoder = DenseKeypointDecoder(n_frames=n_frames, selection=selection, out=out)
+    chunk = []
+    for entry in iter_json_array(path):
+        chunk.append(entry)
+        if len(chunk) >= chunk_entries:
+            decoder.add(chunk)
+            chunk = []
+    decoder.add(chunk)
+    return decoder.result()
+
+
+# --- FILTER ---
+def lowpass_keypoints(keypoints, cutoff=3, fs=30, order=2, max_gap=0):
+    # x and y of every joint filtered together, each run of detected frames on
+    # its own; the score channel is left as detected
+    filtered = np.array(keypoints)
+    filtered[:, :, :2] = lowpass(keypoints[:, :, :2], cutoff=cutoff, fs=fs, order=order, max_gap=max_gap)
+    return filtered
+
+
+# --- WRITERS ---
+def keypoint_columns():
+    return pd.MultiIndex.from_product([[SCORER], COCO_KEYPOINTS, ["x", "y", "likelihood"]],
+                                      names=["scorer", "bodyparts", "coords"])
+
+
+def write_csv(keypoints, path):
+    columns = [f"{kp}_{axis}" for kp in COCO_KEYPOINTS for axis in ("x", "y")]
+    df = pd.DataFrame(keypoints[:, :, :2].reshape(len(keypoints), -1), columns=columns)
+    df.to_csv(path, index=False, encoding="utf-8-sig", chunksize=CSV_CHUNK_ROWS)
+
+
+def write_h5(keypoints, path):
+    # same layout aniposelib.utils.load_pose2d_fnames reads
+    df = pd.DataFrame(keypoints.reshape(len(keypoints), -1), columns=keypoint_columns())
+    df.to_hdf(path, key=H5_KEY, mode="w")
+
+
+WRITERS = {"csv": write_csv, "h5": write_h5}
+
+
+# --- SESSION STORE ---
+def store_location(pose_file):
+    # AlphaPose_output_person_001_walk_cam1_<time>_seg002.json ->
+    # ("person_001_walk_<time>", "cam1_seg002"); files not named by step1 get
+    # a session of their own
+    video_base = video_base_from_pose_file(pose_file)
+    match = SESSION_PATTERN.match(video_base)
+    if not match:
+        return video_base, "keypoints"
+    subject_movement, cam, recorded, segment = match.groups()
+    return f"{subject_movement}_{recorded}", cam + (f"_seg{segment}" if segment else "")
+
+
+def store_path_for(store_dir, pose_file):
+    session, camera = store_location(pose_file)
+    return os.path.join(store_dir, session, camera + STORE_SUFFIX)
+
+
+def write_store(keypoints, path, timestamps=None, header=None):
+    # one camera's (frames, joints, 3) keypoints as a chunked float32 array,
+    # with its frame timestamps and a JSON header (bodyparts, source, filter);
+    # written next to the target and renamed, so a reader never sees half a file
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    filters = tables.Filters(complevel=STORE_COMPLEVEL, complib=STORE_COMPLIB, shuffle=False, bitshuffle=True,
+                             least_significant_digit=STORE_SIGNIFICANT_DIGIT)
+    keypoints = np.asarray(keypoints, dtype=np.float32)
+    chunk_frames = max(1, min(STORE_CHUNK_FRAMES, len(keypoints)))
+    tmp_path = path + ".tmp"
+    with tables.open_file(tmp_path, mode="w") as f:
+        array = f.create_carray("/", "keypoints", obj=keypoints, filters=filters,
+                                chunkshape=(chunk_frames,) + keypoints.shape[1:])
+        array.attrs.header = json.dumps(dict(header or {}, bodyparts=list(COCO_KEYPOINTS), n_frames=len(keypoints)))
+        if timestamps is not None:
+            f.create_carray("/", "timestamps", obj=np.asarray(timestamps, dtype=np.int64),
+                            filters=tables.Filters(complevel=STORE_COMPLEVEL, complib=STORE_COMPLIB))
+    os.replace(tmp_path, path)
+
+
+# --- READING ---
+class PoseH5Reader:
+    # Frame slices of a 2D pose H5 (the write_h5 / DeepLabCut layout) as the
+    # (frames, joints, 2) points and (frames, joints) scores that
+    # aniposelib.utils.load_pose2d_fnames returns, without loading the file
+    def __init__(self, path, key=H5_KEY):
+        self.store = pd.HDFStore(path, mode="r")
+        self.key = key
+        head = self.store.select(key, start=0, stop=1)
+        columns = head.columns
+        if columns.nlevels > 2:
+            columns = columns.droplevel(0)
+        self.bodyparts = list(columns.get_level_values("bodyparts").unique())
+        self.columns = pd.MultiIndex.from_product([self.bodyparts, ["x", "y", "likelihood"]])
+        storer = self.store.get_storer(key)
+        self.n_frames = int(storer.nrows if storer.is_table else storer.group.axis1.nrows)
+        self.timestamps = None  # legacy files rely on the step1 timestamp sidecar
+
+    def read(self, start, stop):
+        df = self.store.select(self.key, start=start, stop=stop)
+        if df.columns.nlevels > 2:
+            df = df.droplevel(0, axis=1)
+        values = df.reindex(columns=self.columns).to_numpy(dtype=np.float64)
+        values = values.reshape(len(df), len(self.bodyparts), 3)
+        return values[:, :, :2], values[:, :, 2]
+
+    def close(self):
+        self.store.close()
+
+
+class KeypointStoreReader:
+    # Frame slices of one camera in the session store, with the same
+    # interface as PoseH5Reader plus the frame timestamps. read() decodes
+    # only the chunks covering start:stop (into out when given, e.g. a
+    # reused buffer) and returns x/y and scores as views of that block.
+    def __init__(self, path):
+        self.file = tables.open_file(path, mode="r")
+        self.keypoints = self.file.root.keypoints
+        self.header = json.loads(self.keypoints.attrs.header)
+        self.bodyparts = self.header["bodyparts"]
+        self.n_frames = int(self.keypoints.shape[0])
+        self.timestamps = self.file.root.timestamps.read() if "timestamps" in self.file.root else None
+
+    def read(self, start, stop, out=None):
+        start, stop = max(start, 0), min(stop, self.n_frames)
+        if stop <= start:
+            values = np.empty((0,) + self.keypoints.shape[1:], dtype=np.float32)
+        else:
+            values = self.keypoints.read(start, stop, out=out)
+        return values[:, :, :2], values[:, :, 2]
+
+    def close(self):
+        self.file.close()
+
+
+def open_pose_file(path):
+    # a session store file or a legacy pandas H5, told apart by content
+    with tables.open_file(path, mode="r") as f:
+        is_store = "keypoints" in f.root
+    return KeypointStoreReader(path) if is_store else PoseH5Reader(path)
+
+
+# --- CONVERSION ---
+def convert_json(json_path, outputs, cutoff=3, fs=30, order=2, max_gap=0, n_frames=None,
+                 selection=DETECTION_SELECTION, ts_path=None):
+    # outputs: {format: path}; the JSON is decoded and filtered once for all
+    # of them. n_frames (the video's frame count, taken from the timestamp
+    # sidecar ts_path when not given) keeps undetected frames at the end of
+    # the clip. Returns (json_path, outputs written, error or None).
+    try:
+        timestamps = read_timestamps(ts_path) if ts_path else None
+        if n_frames is None and timestamps is not None:
+            n_frames = len(timestamps)
+        keypoints = load_alphapose_json(json_path, n_frames=n_frames, selection=selection)
+        if keypoints is None:
+            return json_path, {}, "empty JSON"
+        keypoints = lowpass_keypoints(keypoints, cutoff=cutoff, fs=fs, order=order, max_gap=max_gap)
+        for fmt, path in outputs.items():
+            if fmt == "store":
+                header = {"source": os.path.basename(json_path), "selection": selection,
+                          "filter": {"cutoff": cutoff, "fs": fs, "order": order, "max_gap": max_gap}}
+                ts = timestamps[:len(keypoints)] if timestamps is not None else None
+                write_store(keypoints, path, timestamps=ts, header=header)
+            else:
+                WRITERS[fmt](keypoints, path)
+        return json_path, outputs, None
+    except Exception as e:
+        return json_path, {}, str(e)
+
+
+def convert_many(jobs, workers=None, **kwargs):
+    # jobs: [(json_path, {format: path}, n_frames or None, timestamp sidecar
+    # or None)]; yields convert_json results as files finish, one file per
+    # worker process
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(jobs) <= 1:
+        for json_path, outputs, n_frames, ts_path in jobs:
+            yield convert_json(json_path, outputs, n_frames=n_frames, ts_path=ts_path, **kwargs)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+        futures = {pool.submit(convert_json, json_path, outputs, n_frames=n_frames, ts_path=ts_path, **kwargs):
+                   json_path for json_path, outputs, n_frames, ts_path in jobs}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                yield futures[future], {}, str(e)
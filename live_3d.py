@@ -0,0 +1,419 @@
+import argparse
+import datetime
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+from aniposelib.cameras import CameraGroup
+
+import step2_2_get_skeleton_video_and_json_csv_h5 as step2_2
+import step3_get_3d_data as step3
+from capture_engine import PREVIEW_SIZE, CameraRecorder
+from keypoint_io import open_pose_file, select_detections
+from pose_backend import COCO_BONES, COCO_KEYPOINTS, ReplayPoseBackend, draw_skeleton, make_backend, read_stamp, stamp_frame
+from signal_filter import CausalLowpass, OneEuroFilter
+from triangulation import load_calibration, project
+from trial_io import save_trial, trial_dir_for
+
+# --- SETTINGS ---
+# 2D detection (AlphaPose paths, person selection) follows step2_2's settings
+# and triangulation (engine, score_threshold) follows step3's, so live and
+# offline results agree.
+calibration_file = 'calibration.toml'
+camera_indexes = [0, 1, 2]      # capture device per camera, in the calibration's camera order
+camera_fps = 30
+smoother = 'one_euro'           # 'one_euro', 'butterworth' (forward-only, assumes the backend keeps up with camera_fps) or None
+one_euro_min_cutoff = 1.0       # Hz, cutoff of a joint at rest
+one_euro_beta = 0.005           # cutoff increase per mm/s of joint speed
+butter_cutoff = 3
+butter_order = 2
+sync_tolerance_ms = 20          # frame sets whose cameras grabbed further apart than this are skipped
+report_seconds = 2.0            # latency printout interval
+show_window = True              # camera views with the detected (red/yellow) and 3D (green) skeletons
+output_folder = 'output_live'   # the session is saved here as a trial folder on exit (None = not saved)
+LATENCY_WINDOW = 300            # frame sets in the rolling latency printout
+TAKE_TIMEOUT = 1.0              # seconds without a complete frame set before the run stops
+STAGES = ("capture_wait", "pose", "triangulate", "smooth", "end_to_end")
+
+
+# --- FRAME SETS ---
+class FrameSetSampler:
+    # Newest frame of every camera, copied out of the capture rings as one set
+    # once every camera has delivered a frame since the previous set. Older
+    # frames are skipped, so a slow backend lowers the rate, not the latency.
+    def __init__(self, rings, poll=0.001):
+        self.rings = rings
+        self.poll = poll
+        self.seen = [0] * len(rings)
+        self.buffers = [np.empty(ring.shape[1:], dtype=ring.dtype) for ring in rings]
+
+    def take(self, timeout=TAKE_TIMEOUT):
+        # (frames, grab timestamps in monotonic ns) or None after timeout
+        deadline = time.monotonic() + timeout
+        while any(ring.latest_seq == seen for ring, seen in zip(self.rings, self.seen)):
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(self.poll)
+        grab_ns = np.zeros(len(self.rings), dtype=np.int64)
+        for i, ring in enumerate(self.rings):
+            idx, seq = ring.pin_latest()
+            try:
+                np.copyto(self.buffers[i], ring.slots[idx])
+                grab_ns[i] = ring.timestamps[idx]
+                self.seen[i] = seq
+            finally:
+                ring.unpin()
+        return self.buffers, grab_ns
+
+
+class ReplayCamera:
+    # cv2.VideoCapture stand-in for offline runs: frames of a recorded video
+    # (or blank frames) paced at fps from a shared start time, each stamped
+    # with the camera and frame number for ReplayPoseBackend. grab() fails
+    # after the last frame, like an unplugged camera.
+    def __init__(self, camera, n_frames, video_path=None, size=(320, 240), fps=30.0, start_time=None):
+        self.camera = camera
+        self.n_frames = n_frames
+        self.video = cv2.VideoCapture(video_path) if video_path else None
+        self.frame = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+        self.fps = fps
+        self.index = -1
+        self.next_time = start_time if start_time is not None else time.perf_counter()
+
+    def get(self, prop):
+        return self.fps if prop == cv2.CAP_PROP_FPS else 0.0
+
+    def grab(self):
+        if self.index + 1 >= self.n_frames:
+            return False
+        delay = self.next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_time += 1.0 / self.fps
+        if self.video is not None and not self.video.grab():
+            return False
+        self.index += 1
+        return True
+
+    def retrieve(self, image=None):
+        frame = self.frame
+        if self.video is not None:
+            ret, frame = self.video.retrieve()
+            if not ret:
+                return False, None
+        stamp_frame(frame, self.camera, self.index)
+        if image is None:
+            return True, frame.copy()
+        np.copyto(image, frame)
+        return True, image
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def release(self):
+        if self.video is not None:
+            self.video.release()
+
+
+# --- LATENCY ---
+class LatencyStats:
+    # per-stage latency (ms) of every processed frame set:
+    #   capture_wait  oldest frame's grab -> frame set copied out of the rings
+    #   pose          backend inference and person selection
+    #   triangulate   step3's triangulation of the one frame set
+    #   smooth        causal smoother
+    #   end_to_end    oldest frame's grab -> smoothed 3D skeleton
+    def __init__(self, window=LATENCY_WINDOW):
+        self.recent = {stage: deque(maxlen=window) for stage in STAGES}
+        self.all = {stage: [] for stage in STAGES}
+
+    def add(self, latency):
+        for stage in STAGES:
+            self.recent[stage].append(latency[stage])
+            self.all[stage].append(latency[stage])
+
+    def line(self):
+        parts = []
+        for stage in STAGES:
+            values = np.asarray(self.recent[stage])
+            if len(values):
+                parts.append(f"{stage} {np.median(values):.1f}/{np.percentile(values, 95):.1f}")
+        return "⏱ ms (median/p95): " + ", ".join(parts)
+
+    def summary(self):
+        summary = {}
+        for stage in STAGES:
+            values = np.asarray(self.all[stage])
+            if len(values):
+                summary[stage] = {"mean_ms": round(float(values.mean()), 2),
+                                  "p50_ms": round(float(np.median(values)), 2),
+                                  "p95_ms": round(float(np.percentile(values, 95)), 2),
+                                  "max_ms": round(float(values.max()), 2)}
+        return summary
+
+
+def make_smoother(kind):
+    if kind == 'one_euro':
+        return OneEuroFilter(min_cutoff=one_euro_min_cutoff, beta=one_euro_beta)
+    if kind == 'butterworth':
+        return CausalLowpass(cutoff=butter_cutoff, fs=camera_fps, order=butter_order)
+    if kind is None:
+        return None
+    raise ValueError(f"unknown smoother: {kind}")
+
+
+# --- LIVE PIPELINE ---
+class LivePipeline:
+    # camera rings -> pose backend -> triangulation of the synchronized frame
+    # set -> causal smoother, one frame set at a time on the newest frames
+    def __init__(self, rings, backend, calib, cgroup, smoother_kind=smoother):
+        self.sampler = FrameSetSampler(rings)
+        self.backend = backend
+        self.calib = calib
+        self.cgroup = cgroup
+        self.smoother_kind = smoother_kind
+        self.smoother = make_smoother(smoother_kind)
+        self.prev_boxes = [None] * len(rings)
+        self.stats = LatencyStats()
+        self.unsynced = 0
+        self.results = {"points": [], "raw_points": [], "grab_ns": [], "frame_index": [],
+                        "reproj_error": [], "n_views": []}
+
+    def select(self, detections):
+        # (cams, 1, joints, 2) points and (cams, 1, joints) scores of the
+        # person step2_2's detection_selection keeps in every camera
+        n_cams, n_joints = len(detections), len(COCO_KEYPOINTS)
+        points = np.full((n_cams, 1, n_joints, 2), np.nan)
+        scores = np.zeros((n_cams, 1, n_joints))
+        for c, dets in enumerate(detections):
+            if not dets:
+                continue
+            boxes = np.array([det["box"] for det in dets], dtype=np.float64)
+            det_scores = np.array([det["score"] for det in dets], dtype=np.float64)
+            k = select_detections(np.zeros(len(dets), dtype=np.int64), det_scores, boxes,
+                                  selection=step2_2.detection_selection, prev_box=self.prev_boxes[c])[0]
+            self.prev_boxes[c] = boxes[k]
+            keypoints = np.asarray(dets[k]["keypoints"], dtype=np.float64)
+            points[c, 0] = keypoints[:, :2]
+            scores[c, 0] = keypoints[:, 2]
+        return points, scores
+
+    def step(self):
+        # one frame set; None once the cameras stopped delivering
+        frame_set = self.sampler.take()
+        if frame_set is None:
+            return None
+        frames, grab_ns = frame_set
+        t_taken = time.monotonic_ns()
+        if (grab_ns.max() - grab_ns.min()) / 1e6 > sync_tolerance_ms:
+            self.unsynced += 1
+            return {"frames": frames, "skipped": True}
+
+        detections = self.backend.infer(frames)
+        points, scores = self.select(detections)
+        t_pose = time.monotonic_ns()
+        raw, quality = step3.triangulate_rows(points, scores, self.cgroup, self.calib)
+        t_triangulated = time.monotonic_ns()
+        smoothed = raw[0] if self.smoother is None else self.smoother.push(raw[0], grab_ns.mean() / 1e9)
+        t_done = time.monotonic_ns()
+
+        latency = {
+            "capture_wait": (t_taken - grab_ns.min()) / 1e6,
+            "pose": (t_pose - t_taken) / 1e6,
+            "triangulate": (t_triangulated - t_pose) / 1e6,
+            "smooth": (t_done - t_triangulated) / 1e6,
+            "end_to_end": (t_done - grab_ns.min()) / 1e6,
+        }
+        self.stats.add(latency)
+        stamp = read_stamp(frames[0])
+        results = self.results
+        results["points"].append(smoothed)
+        results["raw_points"].append(raw[0])
+        results["grab_ns"].append(int(grab_ns.mean()))
+        results["frame_index"].append(-1 if stamp is None else stamp[1])
+        results["reproj_error"].append(quality["reproj_error"][0])
+        results["n_views"].append(quality["n_views"][0])
+        return {"frames": frames, "detections": detections, "points": smoothed, "latency": latency,
+                "skipped": False}
+
+    def run(self, seconds=None, show=False):
+        start = last_report = time.monotonic()
+        while seconds is None or time.monotonic() - start < seconds:
+            result = self.step()
+            if result is None:
+                print("⏹ No new frames, stopping.")
+                break
+            if time.monotonic() - last_report >= report_seconds:
+                print(f"{self.stats.line()} ({len(self.results['points'])} sets, {self.unsynced} unsynced)")
+                last_report = time.monotonic()
+            if show and not result["skipped"]:
+                cv2.imshow("Live 3D", self.render(result))
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+        if show:
+            cv2.destroyAllWindows()
+
+    def render(self, result):
+        # every camera's frame with its 2D detection and the smoothed 3D
+        # skeleton projected back into it
+        reprojected = project(self.calib, result["points"])
+        tiles = []
+        for c, frame in enumerate(result["frames"]):
+            tile = draw_skeleton(frame.copy(), result["detections"][c])
+            kp = np.column_stack([reprojected[c], np.isfinite(reprojected[c]).all(axis=1)])
+            for a, b in COCO_BONES:
+                if kp[a, 2] and kp[b, 2]:
+                    cv2.line(tile, tuple(int(v) for v in kp[a, :2]), tuple(int(v) for v in kp[b, :2]), (0, 255, 0), 2)
+            tiles.append(cv2.resize(tile, PREVIEW_SIZE, interpolation=cv2.INTER_NEAREST))
+        view = np.hstack(tiles)
+        cv2.putText(view, f"{result['latency']['end_to_end']:.0f} ms", (10, 30), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.8, (0, 255, 0), 2)
+        return view
+
+    def arrays(self):
+        return {name: np.asarray(values) for name, values in self.results.items()}
+
+
+def save_session(pipeline, folder, name, extra=None):
+    arrays = pipeline.arrays()
+    points = arrays.pop("points").reshape(-1, len(COCO_KEYPOINTS), 3)
+    header = {"source": "live_3d", "smoother": pipeline.smoother_kind, "latency": pipeline.stats.summary(),
+              "unsynced_sets": pipeline.unsynced}
+    header.update(extra or {})
+    return save_trial(trial_dir_for(folder, name), points, COCO_KEYPOINTS, fps=camera_fps, extra=header, **arrays)
+
+
+# --- SOURCES ---
+def live_cameras(indexes, calib):
+    # the same capture path as step1, at the resolution the calibration was
+    # made at: its intrinsics are in those pixels, so a camera left at its
+    # driver default would silently skew every triangulated point
+    caps = []
+    for c, i in enumerate(indexes):
+        width, height = (int(v) for v in calib["size"][c])
+        cap = cv2.VideoCapture(i, cv2.CAP_DSHOW)
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        caps.append(cap)
+        actual = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        is_open = cap.isOpened()
+        if not is_open or actual != (width, height):
+            for opened in caps:
+                opened.release()
+            if not is_open:
+                raise RuntimeError(f"cannot open camera {i} ({calib['names'][c]})")
+            raise RuntimeError(f"camera {i} ({calib['names'][c]}) runs at {actual[0]}x{actual[1]}, "
+                               f"but calibration.toml expects {width}x{height}")
+    return caps
+
+
+def replay_sources(h5_paths, video_paths=None, fps=camera_fps):
+    # replay cameras and keypoints from step2_2's store or legacy H5 files
+    # (and optionally the recorded videos they came from)
+    keypoints = []
+    for path in h5_paths:
+        reader = open_pose_file(path)
+        try:
+            points, scores = reader.read(0, reader.n_frames)
+        finally:
+            reader.close()
+        keypoints.append(np.concatenate([points, np.nan_to_num(scores)[..., None]], axis=2))
+    n_frames = min(len(k) for k in keypoints)
+    start = time.perf_counter() + 0.5
+    cameras = [ReplayCamera(c, n_frames, video_path=video_paths[c] if video_paths else None, fps=fps,
+                            start_time=start) for c in range(len(h5_paths))]
+    return cameras, keypoints, None
+
+
+def synthetic_sources(calib, n_frames, noise_px, fps=camera_fps, seed=0):
+    # replay cameras and keypoints of pipeline_benchmark's walking skeleton,
+    # plus the true 3D motion
+    from pipeline_benchmark import FRAME_DROPOUT, JOINT_DROPOUT, skeleton_motion, stage_in_view, synthesize_views
+    rng = np.random.default_rng(seed)
+    pose = skeleton_motion(n_frames, fps)
+    body, origin = stage_in_view(calib, pose)
+    truth = pose @ body.T + origin
+    keypoints, detected = synthesize_views(calib, truth, rng, noise_px, JOINT_DROPOUT, FRAME_DROPOUT)
+    keypoints[~detected] = 0.0
+    start = time.perf_counter() + 0.5
+    cameras = [ReplayCamera(c, n_frames, fps=fps, start_time=start) for c in range(len(keypoints))]
+    return cameras, list(keypoints), truth
+
+
+def accuracy(arrays, truth):
+    # error (mm) and jitter (RMS second difference, mm) of the raw and the
+    # smoothed live skeleton against the true motion of a synthetic run
+    index = arrays["frame_index"]
+    keep = (index >= 0) & (index < len(truth))
+    report = {}
+    for name in ("raw_points", "points"):
+        points = arrays[name].reshape(len(index), -1, 3)[keep]
+        error = np.linalg.norm(points - truth[index[keep]], axis=2)
+        jitter = np.linalg.norm(np.diff(points, n=2, axis=0), axis=2)
+        report[name] = {"mean_error_mm": round(float(np.nanmean(error)), 2),
+                        "jitter_mm": round(float(np.sqrt(np.nanmean(jitter ** 2))), 2)}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Live 3D skeleton from the cameras, or a replay of recorded/synthetic data")
+    parser.add_argument("--synthetic", type=int, default=0, help="replay this many frames of a synthetic walk")
+    parser.add_argument("--replay-h5", nargs="+", help="replay step2_2 store or H5 files (one per camera, calibration order)")
+    parser.add_argument("--replay-videos", nargs="+", help="the videos behind --replay-h5")
+    parser.add_argument("--backend", default=None, help="'replay' for replays, else step2_2's pose_backend_name")
+    parser.add_argument("--pose-delay-ms", type=float, default=0.0, help="replay backend: emulated inference time per frame set")
+    parser.add_argument("--noise-px", type=float, default=1.5)
+    parser.add_argument("--smoother", default=smoother, choices=["one_euro", "butterworth", "none"])
+    parser.add_argument("--seconds", type=float, default=None)
+    parser.add_argument("--no-window", action="store_true")
+    parser.add_argument("--output-folder", default=output_folder)
+    args = parser.parse_args()
+
+    calib = load_calibration(calibration_file)
+    cgroup = CameraGroup.load(calibration_file)
+    truth = None
+    if args.synthetic:
+        caps, keypoints, truth = synthetic_sources(calib, args.synthetic, args.noise_px)
+    elif args.replay_h5:
+        caps, keypoints, _ = replay_sources(args.replay_h5, args.replay_videos)
+    else:
+        caps, keypoints = live_cameras(camera_indexes, calib), None
+
+    if keypoints is not None and args.backend in (None, "replay"):
+        backend = ReplayPoseBackend(keypoints, delay_per_batch=args.pose_delay_ms / 1000)
+    else:
+        backend = make_backend(args.backend or step2_2.pose_backend_name, alphapose_dir=step2_2.alphapose_dir,
+                               config_path=step2_2.config_path, checkpoint_path=step2_2.checkpoint_path)
+    backend.load()
+
+    recorders = [CameraRecorder(cap, f"live_cam{c + 1}.avi", cv2.VideoWriter_fourcc(*"MJPG"), fps=camera_fps,
+                                segment_seconds=0) for c, cap in enumerate(caps)]
+    for recorder in recorders:
+        recorder.open()
+    pipeline = LivePipeline([r.ring for r in recorders], backend, calib, cgroup,
+                            smoother_kind=None if args.smoother == "none" else args.smoother)
+    print(f"🎥 {len(recorders)} cameras, {backend.name} backend, {args.smoother} smoother (q in the window to stop)")
+    try:
+        pipeline.run(seconds=args.seconds, show=show_window and not args.no_window)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for recorder in recorders:
+            recorder.close()
+        for cap in caps:
+            cap.release()
+        backend.close()
+
+    print(pipeline.stats.line())
+    extra = {}
+    if truth is not None and pipeline.results["points"]:
+        extra["accuracy"] = accuracy(pipeline.arrays(), truth)
+        for name, values in extra["accuracy"].items():
+            print(f"🎯 {name}: error {values['mean_error_mm']} mm, jitter {values['jitter_mm']} mm")
+    if args.output_folder and pipeline.results["points"]:
+        name = "live_" + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        header_path = save_session(pipeline, args.output_folder, name, extra)
+        print(f"💾 {len(pipeline.results['points'])} frame sets -> {header_path}")
@@ -0,0 +1,398 @@
+import argparse
+import json
+import os
+import queue
+import signal
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import toml
+
+import step2_2_get_skeleton_video_and_json_csv_h5 as step2_2
+import step3_get_3d_data as step3
+import step4_visualization as step4
+from capture_engine import finished_segment_files, is_segment_file
+from frame_sync import index_timestamp_files
+from keypoint_io import convert_json
+from pose_backend import InferenceService, make_backend
+from quality_report import write_dataset_table
+from run_manifest import RunManifest
+from trial_io import HEADER_FILE, load_points
+
+# --- SETTINGS ---
+CONFIG_FILE = "pipeline.toml"
+STATUS_FILE = "pipeline_status.json"    # node counts and failures, in the 3D output folder
+KINDS = ("pose", "convert", "triangulate", "qa")
+
+
+# --- CONFIG ---
+def load_config(path):
+    # the config with every path made absolute (relative to the config file)
+    config = toml.load(path)
+    base = os.path.dirname(os.path.abspath(path))
+    config["paths"] = {k: os.path.join(base, v) if v else "" for k, v in config.get("paths", {}).items()}
+    return config
+
+
+def apply_config(config):
+    # point the step modules at the configured folders and override their
+    # settings by name, so the orchestrator runs the steps' own code
+    paths = config["paths"]
+    step2_2.base_video_dir = paths["videos"]
+    step2_2.skeleton_video_dir = paths["skeleton_videos"]
+    step2_2.json_dir = paths["json"]
+    step2_2.csv_dir = paths["csv"]
+    step2_2.h5_dir = paths["h5"]
+    step2_2.store_dir = paths["store"]
+    step2_2.alphapose_dir = paths["alphapose_dir"]
+    step2_2.checkpoint_path = paths["checkpoint"]
+    step2_2.config_path = paths["alphapose_config"]
+    # not in the JSON folder, where step2_2 would try to convert it
+    step2_2.manifest_path = os.path.join(paths["output_3d"], "step2_2_manifest.json")
+    step3.h5_folder = paths["h5"]
+    step3.store_folder = paths["store"]
+    step3.video_folder = paths["videos"]
+    step3.output_folder = paths["output_3d"]
+    step3.calibration_file = paths["calibration"]
+    step3.manifest_path = os.path.join(paths["output_3d"], "step3_manifest.json")
+    for module, table in ((step2_2, "step2_2"), (step3, "step3"), (step4, "step4")):
+        for name, value in config.get(table, {}).items():
+            if not hasattr(module, name):
+                raise ValueError(f"[{table}] {name}: no such setting in {module.__name__}")
+            setattr(module, name, value)
+    if step3.pose_input not in step2_2.output_formats:
+        raise ValueError(f"step2_2.output_formats must include '{step3.pose_input}', the step3 pose_input")
+
+
+# --- CPU WORKERS ---
+# every worker process applies the config once (spawned workers do not
+# inherit the parent's overrides) and loads the calibration for step3;
+# Ctrl+C is left to the main process, which lets running tasks finish
+def init_cpu_worker(config):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    apply_config(config)
+    step3.init_worker(step3.calibration_file)
+
+
+def cpu_task(kind, args):
+    # error message or None
+    try:
+        if kind == "convert":
+            json_path, outputs, ts_path = args
+            filter_kwargs = step2_2.conversion_params()
+            _, _, error = convert_json(json_path, outputs, ts_path=ts_path, **filter_kwargs)
+            return error
+        if kind == "triangulate":
+            _, error, _ = step3.run_group(args)
+            return error
+        if kind == "qa":
+            trial_dir, html_path = args
+            points, joint_names = load_points(trial_dir)
+            fig = step4.build_figure(points, joint_names, f"3D Joint Animation: {os.path.basename(trial_dir)}",
+                                     decimate=step4.decimate, max_frames=step4.max_frames,
+                                     show_bones=step4.show_bones)
+            step4.export_html(fig, html_path)
+            return None
+        return f"unknown task kind {kind}"
+    except Exception as e:
+        where = traceback.extract_tb(e.__traceback__)[-1]
+        return f"{type(e).__name__}: {e} ({os.path.basename(where.filename)}:{where.lineno})"
+
+
+# --- TRIAL DAG ---
+class Node:
+    # one unit of work: pose (video -> JSON, GPU), convert (JSON -> H5/CSV),
+    # triangulate (3 H5 -> 3D trial) or qa (dataset table, HTML export)
+    def __init__(self, key, kind, deps=(), **info):
+        self.key = key
+        self.kind = kind
+        self.deps = list(deps)
+        self.info = info
+        self.state = "waiting"      # waiting -> running -> done | skipped (up to date) | failed
+        self.error = None
+        self.started = None
+        self.seconds = 0.0
+
+
+class Orchestrator:
+    # Builds a DAG per trial from the files on disk and runs every node as
+    # soon as its inputs exist: pose inference through one long-lived
+    # InferenceService (the GPU slot), everything else in a process pool of
+    # cpu_workers. Freshness is checked with the steps' own run manifests and
+    # keys when a node becomes ready, and every finished node is recorded at
+    # once, so a rerun after a crash (or the standalone step scripts) picks up
+    # exactly where this left off.
+    def __init__(self, config, force=False):
+        self.config = config
+        self.paths = config["paths"]
+        self.force = force
+        self.settle_seconds = config.get("watch", {}).get("settle_seconds", 10)
+        self.poll_seconds = config.get("watch", {}).get("poll_seconds", 10)
+        workers = config.get("resources", {}).get("cpu_workers", 0) or os.cpu_count() or 1
+        for key in ("videos", "skeleton_videos", "json", "csv", "h5", "store", "output_3d"):
+            os.makedirs(self.paths[key], exist_ok=True)
+        self.pose_manifest = RunManifest(step2_2.manifest_path)
+        self.step3_manifest = RunManifest(step3.manifest_path)
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=init_cpu_worker, initargs=(config,))
+        self.workers = workers
+        self.service = None
+        self.events = queue.Queue()
+        self.nodes = {}
+        self.ts_index = {}
+        self.seen_sizes = {}
+        self.t_start = time.perf_counter()
+
+    # --- discovery ---
+    def finished_videos(self):
+        # recordings step1 has finished: segments listed in a segments.json,
+        # single files once their size has not changed for settle_seconds
+        videos_dir = self.paths["videos"]
+        finished = finished_segment_files(videos_dir)
+        videos = []
+        now = time.time()
+        for root, _, files in os.walk(videos_dir):
+            for file in sorted(files):
+                if not file.endswith(".avi"):
+                    continue
+                path = os.path.join(root, file)
+                if is_segment_file(file):
+                    if file in finished:
+                        videos.append(path)
+                    continue
+                st = os.stat(path)
+                previous = self.seen_sizes.get(path)
+                self.seen_sizes[path] = st.st_size
+                settled = now - st.st_mtime >= self.settle_seconds
+                if settled and (previous is None or previous == st.st_size):
+                    videos.append(path)
+        return videos
+
+    def add(self, node):
+        if node.key not in self.nodes:
+            self.nodes[node.key] = node
+        return self.nodes[node.key]
+
+    def discover(self):
+        self.ts_index = index_timestamp_files(self.paths["videos"])
+        pose_providers = {}
+        for video in self.finished_videos():
+            json_path, skeleton_path = step2_2.inference_outputs(video)
+            pose = self.add(Node(f"pose:{video}", "pose", video=video, json=json_path, skeleton=skeleton_path))
+            self.add_convert(json_path, [pose.key], pose_providers)
+        # JSON converted elsewhere or left by an earlier run without its video
+        for file in sorted(os.listdir(self.paths["json"])):
+            if file.endswith(".json") and file.startswith("AlphaPose_"):
+                self.add_convert(os.path.join(self.paths["json"], file), [], pose_providers)
+        for path in step3.pose_files():
+            pose_providers.setdefault(path, None)
+
+        groups = {}
+        for path, provider in pose_providers.items():
+            key, cam_name, _ = step3.parse_pose_path(path)
+            if key and cam_name:
+                groups.setdefault(key, {})[cam_name] = (path, provider)
+        cameras = sorted(set(step3.CAM_MAPPING.values()))
+        for (person, movement, segment), cams in groups.items():
+            if any(cam not in cams for cam in cameras):
+                continue
+            name = step3.group_name(person, movement, segment)
+            fname_dict = {cam: cams[cam][0] for cam in cameras}
+            deps = [cams[cam][1] for cam in cameras if cams[cam][1]]
+            tri = self.add(Node(f"3d:{name}", "triangulate", deps, name=name, fname_dict=fname_dict))
+            self.add(Node(f"qa:{name}", "qa", [tri.key], name=name))
+
+    def add_convert(self, json_path, deps, pose_providers):
+        json_file = os.path.basename(json_path)
+        targets = step2_2.conversion_targets(json_file)
+        node = self.add(Node(f"convert:{json_path}", "convert", deps, json=json_path, targets=targets))
+        # the file step3 reads is what the triangulation node waits for
+        pose_providers[targets[step3.pose_input]] = node.key
+
+    # --- scheduling ---
+    def schedule(self):
+        # start every ready node; repeated because up-to-date nodes finish at
+        # once and make their dependents ready in turn
+        changed = True
+        while changed:
+            changed = False
+            for node in self.nodes.values():
+                if node.state != "waiting":
+                    continue
+                states = [self.nodes[d].state for d in node.deps]
+                if "failed" in states:
+                    node.state, node.error = "failed", "upstream failed"
+                    changed = True
+                elif all(s in ("done", "skipped") for s in states):
+                    self.start(node)
+                    changed = True
+
+    def start(self, node):
+        node.started = time.perf_counter()
+        node.state = "running"
+        if node.kind == "pose":
+            outputs = [p for p in (node.info["json"], node.info["skeleton"]) if p]
+            params = step2_2.pose_params(self.pose_manifest)
+            node.info["record"] = (self.pose_manifest, [(node.key, [node.info["video"]], params, outputs)])
+            if not self.force and self.pose_manifest.is_fresh(node.key, [node.info["video"]], params, outputs):
+                return self.finish(node, None, skipped=True)
+            if self.service is None:
+                backend = make_backend(step2_2.pose_backend_name, alphapose_dir=step2_2.alphapose_dir,
+                                       config_path=step2_2.config_path, checkpoint_path=step2_2.checkpoint_path,
+                                       gpus="0")
+                print(f"🚀 Loading {backend.name} pose backend (one GPU slot)")
+                self.service = InferenceService(backend, batch_size=step2_2.inference_batch_size,
+                                                on_job_done=lambda job: self.events.put((f"pose:{job.video_path}",
+                                                                                         job.error))).start()
+            self.service.submit(node.info["video"], node.info["json"], node.info["skeleton"])
+
+        elif node.kind == "convert":
+            json_path = node.info["json"]
+            params = step2_2.conversion_params()
+            ts_path = step2_2.sidecar_path(self.ts_index, os.path.basename(json_path))
+            inputs = [json_path] + ([ts_path] if ts_path else [])
+            outputs, records = {}, []
+            for fmt in step2_2.output_formats:
+                target = node.info["targets"][fmt]
+                records.append((f"{fmt}:{json_path}", inputs, params, [target]))
+                if self.force or not self.pose_manifest.is_fresh(f"{fmt}:{json_path}", inputs, params, [target]):
+                    outputs[fmt] = target
+            node.info["record"] = (self.pose_manifest, records)
+            if not outputs:
+                return self.finish(node, None, skipped=True)
+            self.submit(node, "convert", (json_path, outputs, ts_path))
+
+        elif node.kind == "triangulate":
+            task, key, inputs, outputs = step3.plan_group(node.info["name"], node.info["fname_dict"], self.ts_index)
+            params = step3.run_params()
+            node.info["record"] = (self.step3_manifest, [(key, inputs, params, outputs)])
+            node.info["paths"] = task[2]
+            if not self.force and self.step3_manifest.is_fresh(key, inputs, params, outputs):
+                return self.finish(node, None, skipped=True)
+            self.submit(node, "triangulate", task)
+
+        elif node.kind == "qa":
+            # the quality report is written by step3 itself; this node adds the
+            # trial to the dataset table and exports its HTML animation
+            paths = self.nodes[f"3d:{node.info['name']}"].info["paths"]
+            source = paths["npy"] if os.path.isdir(paths["npy"]) else paths["csv"]
+            stamp = os.path.join(source, HEADER_FILE) if os.path.isdir(source) else source
+            html_dir = self.paths.get("html")
+            if not html_dir or not os.path.exists(stamp):
+                return self.finish(node, None)
+            os.makedirs(html_dir, exist_ok=True)
+            html_path = os.path.join(html_dir, f"{node.info['name']}.html")
+            if not self.force and os.path.exists(html_path) and os.path.getmtime(html_path) >= os.path.getmtime(stamp):
+                return self.finish(node, None, skipped=True)
+            self.submit(node, "qa", (source, html_path))
+
+    def submit(self, node, kind, args):
+        def done(future):
+            # a worker that died (e.g. out of memory) fails only its node
+            error = future.exception()
+            self.events.put((node.key, f"worker died: {error}" if error else future.result()))
+        self.pool.submit(cpu_task, kind, args).add_done_callback(done)
+
+    def finish(self, node, error, skipped=False):
+        node.seconds = time.perf_counter() - node.started if node.started else 0.0
+        if error:
+            node.state, node.error = "failed", error
+            print(f"❌ {node.key}: {error}")
+        else:
+            node.state = "skipped" if skipped else "done"
+            manifest, records = node.info.get("record", (None, []))
+            if not skipped and manifest is not None:
+                # an output the step did not write (e.g. no skeleton video) is not recorded
+                for key, inputs, params, outputs in records:
+                    if all(os.path.exists(p) for p in outputs):
+                        manifest.record(key, inputs, params, outputs)
+                manifest.save()
+            if node.kind == "qa" and not skipped:
+                write_dataset_table(self.paths["output_3d"])
+            if not skipped:
+                print(f"✅ {node.key} ({node.seconds:.1f}s)")
+        self.write_status()
+
+    def write_status(self):
+        counts = {kind: {} for kind in KINDS}
+        for node in self.nodes.values():
+            counts[node.kind][node.state] = counts[node.kind].get(node.state, 0) + 1
+        status = {
+            "updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "elapsed_seconds": round(time.perf_counter() - self.t_start, 1),
+            "nodes": counts,
+            "failed": {n.key: n.error for n in self.nodes.values() if n.state == "failed"},
+        }
+        path = os.path.join(self.paths["output_3d"], STATUS_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(status, f, indent=4)
+        os.replace(path + ".tmp", path)
+
+    def active(self):
+        return any(n.state in ("waiting", "running") for n in self.nodes.values())
+
+    def run(self, watch=False):
+        # until every node has finished; with watch, keep scanning for new
+        # recordings until Ctrl+C
+        self.discover()
+        last_scan = time.monotonic()
+        try:
+            while True:
+                self.schedule()
+                if not watch and not self.active():
+                    break
+                self.handle_events(timeout=self.poll_seconds if watch else 1.0)
+                if watch and time.monotonic() - last_scan >= self.poll_seconds:
+                    self.discover()
+                    last_scan = time.monotonic()
+        except KeyboardInterrupt:
+            print("🛑 Stopping: finishing the nodes already running...")
+        finally:
+            self.close()
+
+    def handle_events(self, timeout=None):
+        # wait up to timeout for one finished node, then take any others queued
+        try:
+            event = self.events.get(timeout=timeout) if timeout else self.events.get_nowait()
+            while True:
+                key, error = event
+                self.finish(self.nodes[key], error)
+                event = self.events.get_nowait()
+        except queue.Empty:
+            pass
+
+    def close(self):
+        # queued pose jobs and running CPU tasks finish and are recorded;
+        # nodes not started yet are picked up by the next run
+        if self.service is not None:
+            self.service.close()
+        self.pool.shutdown(wait=True)
+        self.handle_events()
+        self.write_status()
+
+    def summary(self):
+        print(f"\n📊 Pipeline finished in {time.perf_counter() - self.t_start:.1f}s")
+        for kind in KINDS:
+            nodes = [n for n in self.nodes.values() if n.kind == kind]
+            states = {s: sum(n.state == s for n in nodes) for s in ("done", "skipped", "failed", "waiting", "running")}
+            print(f"   {kind:<12} {states['done']} done, {states['skipped']} up to date, {states['failed']} failed"
+                  + (f", {states['waiting'] + states['running']} unfinished" if states['waiting'] + states['running'] else ""))
+        for node in self.nodes.values():
+            if node.state == "failed" and node.error != "upstream failed":
+                print(f"   ❌ {node.key}: {node.error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run steps 2.2-4 as one DAG per trial, resumable and incremental")
+    parser.add_argument("--config", default=CONFIG_FILE)
+    parser.add_argument("--watch", action="store_true", help="keep processing new recordings until Ctrl+C")
+    parser.add_argument("--force", action="store_true", help="redo every node even when up to date")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    apply_config(config)
+    orchestrator = Orchestrator(config, force=args.force)
+    print(f"🧭 {args.config}: videos in {config['paths']['videos']}, {orchestrator.workers} CPU worker(s)"
+          + (", watching for new recordings" if args.watch else ""))
+    orchestrator.run(watch=args.watch)
+    orchestrator.summary()
@@ -0,0 +1,381 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from aniposelib.cameras import CameraGroup
+
+import step3_get_3d_data as step3
+from keypoint_io import convert_many, load_alphapose_json, lowpass_keypoints, open_pose_file, store_path_for
+from pose_backend import COCO_KEYPOINTS
+from signal_filter import lowpass
+from step4_visualization import build_figure
+from triangulation import load_calibration, project, triangulate_dlt
+from trial_io import load_trial
+
+# --- SETTINGS ---
+SIZES = (300, 1800, 9000)       # trial lengths in frames (10 s, 1 min, 5 min at 30 fps)
+FPS = 30
+NOISE_PX = 1.5                  # 2D detection noise (standard deviation, pixels)
+JOINT_DROPOUT = 0.03            # (frame, joint, camera) detections replaced by a low-score guess
+FRAME_DROPOUT = 0.02            # frames in which a camera detects nobody
+OCCLUSIONS_PER_MINUTE = 4       # per camera: runs of 5-30 frames in which one arm is hidden
+SECOND_PERSON = 0.1             # frames with an extra, less confident detection
+STEP4_MAX_FRAMES = 1800         # the per-frame plotly build is only timed up to this length
+RESULTS_FILE = "benchmark_results.json"
+REGRESSION_TOLERANCE = 0.25     # --compare flags stages this much slower than the baseline
+REGRESSION_MIN_SECONDS = 0.05   # ... and slower by at least this much, so timer noise is not flagged
+STAGES = ("json_to_store", "json_to_h5", "json_decode", "group_pose_files", "load_2d_store", "load_2d_h5",
+          "process_group", "filter_2d", "filter_3d", "step4_figure")
+DISK_FORMATS = ("json", "store", "h5")
+
+# rest pose in mm, in body coordinates: x to the subject's left, y up, z forward
+REST_POSE = np.array([
+    [0, 1600, 80],                          # Nose
+    [35, 1635, 60], [-35, 1635, 60],        # LEye, REye
+    [75, 1615, 0], [-75, 1615, 0],          # LEar, REar
+    [190, 1420, 0], [-190, 1420, 0],        # LShoulder, RShoulder
+    [220, 1130, 0], [-220, 1130, 0],        # LElbow, RElbow
+    [230, 860, 30], [-230, 860, 30],        # LWrist, RWrist
+    [100, 950, 0], [-100, 950, 0],          # LHip, RHip
+    [105, 520, 20], [-105, 520, 20],        # LKnee, RKnee
+    [110, 90, 0], [-110, 90, 0],            # LAnkle, RAnkle
+], dtype=np.float64)
+LEFT_ARM = [7, 9]
+RIGHT_ARM = [8, 10]
+
+
+# --- SYNTHETIC MOTION ---
+def skeleton_motion(n_frames, fps=FPS):
+    # (frames, 17, 3) body coordinates: walking in place with swinging limbs,
+    # bobbing and a slow turn while drifting around the capture area
+    t = np.arange(n_frames) / fps
+    phase = 2 * np.pi * 0.9 * t
+    pose = np.repeat(REST_POSE[None], n_frames, axis=0)
+    swing = np.sin(phase)
+    for side, sign in ((0, 1), (1, -1)):
+        knee, ankle = 13 + side, 15 + side
+        elbow, wrist = 7 + side, 9 + side
+        pose[:, knee, 2] += sign * 120 * swing
+        pose[:, ankle, 2] += sign * 220 * swing
+        pose[:, ankle, 1] += 80 * np.clip(sign * np.cos(phase), 0, None)
+        pose[:, elbow, 2] -= sign * 90 * swing
+        pose[:, wrist, 2] -= sign * 180 * swing
+    pose[:, :, 1] += 20 * np.sin(2 * phase)[:, None]
+
+    yaw = 0.5 * np.sin(0.1 * t)
+    c, s = np.cos(yaw)[:, None], np.sin(yaw)[:, None]
+    x, z = pose[:, :, 0].copy(), pose[:, :, 2].copy()
+    pose[:, :, 0] = c * x + s * z
+    pose[:, :, 2] = -s * x + c * z
+    pose[:, :, 0] += (300 * np.sin(0.2 * t))[:, None]
+    pose[:, :, 2] += (200 * np.sin(0.13 * t))[:, None]
+    return pose
+
+
+def stage_in_view(calib, pose):
+    # world placement of the body frame: facing the cameras, upright in their
+    # average "up", at the depth where most joints are seen by every camera
+    rotations = calib["extrinsics"][:, :, :3]
+    centers = -np.einsum("cji,cj->ci", rotations, calib["tvec"])
+    up = -rotations[:, 1, :].mean(axis=0)
+    up /= np.linalg.norm(up)
+    principal = np.array([[[s[0] / 2, s[1] / 2]] for s in calib["size"]])
+    focus = triangulate_dlt(calib, principal)[0]
+    if not np.isfinite(focus).all():
+        focus = centers.mean(axis=0) + 2500 * rotations[:, 2, :].mean(axis=0)
+    facing = centers.mean(axis=0) - focus
+    facing -= up * (facing @ up)
+    facing /= np.linalg.norm(facing)
+    body = np.stack([np.cross(up, facing), up, facing], axis=1)
+
+    sample = pose[::max(len(pose) // 60, 1)].reshape(-1, 3)
+    best = None
+    for distance in np.arange(0, 5001, 250):
+        origin = focus - facing * distance - up * 900
+        pixels = project(calib, sample @ body.T + origin)
+        inside = ((pixels >= 0) & (pixels < calib["size"][:, None, :])).all(axis=2).all(axis=0).mean()
+        if best is None or inside > best[0] + 1e-9:
+            best = (inside, origin)
+    return body, best[1]
+
+
+def synthesize_views(calib, p3ds, rng, noise_px, joint_dropout, frame_dropout):
+    # (cams, frames, 17, 3) AlphaPose-like x, y, score and a (cams, frames)
+    # mask of frames with a detection
+    n_frames, n_joints, _ = p3ds.shape
+    pixels = project(calib, p3ds.reshape(-1, 3)).reshape(len(calib["names"]), n_frames, n_joints, 2)
+    n_cams = len(pixels)
+    scores = rng.uniform(0.75, 0.98, pixels.shape[:3])
+    pixels = pixels + rng.normal(0, noise_px, pixels.shape)
+
+    guessed = rng.random(scores.shape) < joint_dropout
+    for cam in range(n_cams):
+        bursts = max(int(round(OCCLUSIONS_PER_MINUTE * n_frames / (60 * FPS))), 0)
+        for start in rng.integers(0, n_frames, bursts):
+            arm = LEFT_ARM if rng.random() < 0.5 else RIGHT_ARM
+            guessed[cam, start:start + rng.integers(5, 31), arm] = True
+    outside = ~((pixels >= 0) & (pixels < calib["size"][:, None, None, :])).all(axis=3)
+    guessed |= outside
+    scores[guessed] = rng.uniform(0.02, 0.2, guessed.sum())
+    pixels[guessed] += rng.normal(0, 40, (guessed.sum(), 2))
+    pixels = np.clip(pixels, 0, calib["size"][:, None, None, :] - 1)
+
+    detected = rng.random((n_cams, n_frames)) >= frame_dropout
+    return np.concatenate([pixels, scores[..., None]], axis=3), detected
+
+
+def write_alphapose_json(path, keypoints, detected, rng, second_person=SECOND_PERSON):
+    # one entry per detection per image_id, as AlphaPose writes its results
+    entries = []
+    flat = np.round(keypoints.reshape(len(keypoints), -1), 3)
+    for frame in np.flatnonzero(detected):
+        xy = keypoints[frame, :, :2]
+        box = [float(xy[:, 0].min()), float(xy[:, 1].min()), float(np.ptp(xy[:, 0])), float(np.ptp(xy[:, 1]))]
+        score = float(keypoints[frame, :, 2].mean()) + 2.0
+        entries.append({"image_id": f"{frame}.jpg", "category_id": 1, "keypoints": flat[frame].tolist(),
+                        "score": round(score, 4), "box": box})
+        if rng.random() < second_person:
+            other = keypoints[frame].copy()
+            other[:, 0] += rng.choice([-1, 1]) * rng.uniform(250, 450)
+            other[:, 2] *= 0.6
+            entries.append({"image_id": f"{frame}.jpg", "category_id": 1,
+                            "keypoints": np.round(other, 3).ravel().tolist(),
+                            "score": round(score - 1.0, 4), "box": box})
+    with open(path, "w") as f:
+        json.dump(entries, f)
+
+
+def generate_trial(calib, folder, name, n_frames, noise_px, joint_dropout, frame_dropout, seed):
+    # AlphaPose JSON for every camera plus the true 3D motion; file names
+    # follow step1/step2_2 so step3's grouping picks them up
+    rng = np.random.default_rng(seed)
+    pose = skeleton_motion(n_frames)
+    body, origin = stage_in_view(calib, pose)
+    truth = pose @ body.T + origin
+    keypoints, detected = synthesize_views(calib, truth, rng, noise_px, joint_dropout, frame_dropout)
+    json_paths = []
+    for cam in range(len(keypoints)):
+        path = os.path.join(folder, f"AlphaPose_output_person_001_{name}_cam{cam + 1}_2025-01-01_10-00-00.json")
+        write_alphapose_json(path, keypoints[cam], detected[cam], rng)
+        json_paths.append(path)
+    return truth, json_paths
+
+
+# --- TIMING ---
+def timed(fn, repeat):
+    # best wall time of repeat calls and the last call's result
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def run_size(calibration_path, workdir, n_frames, args):
+    name = f"bench{n_frames}"
+    json_dir = os.path.join(workdir, name, "json")
+    h5_dir = os.path.join(workdir, name, "h5")
+    store_dir = os.path.join(workdir, name, "store")
+    out_dir = os.path.join(workdir, name, "out")
+    for d in (json_dir, h5_dir, store_dir, out_dir):
+        os.makedirs(d, exist_ok=True)
+
+    calib = load_calibration(calibration_path)
+    t0 = time.perf_counter()
+    truth, json_paths = generate_trial(calib, json_dir, name, n_frames, args.noise_px, args.joint_dropout,
+                                       args.frame_dropout, args.seed)
+    generate_seconds = time.perf_counter() - t0
+
+    seconds = {}
+    outputs = {
+        "store": [store_path_for(store_dir, p) for p in json_paths],
+        "h5": [os.path.join(h5_dir, os.path.basename(p).replace(".json", "_filtered.h5")) for p in json_paths],
+    }
+
+    def convert(fmt):
+        jobs = [(p, {fmt: path}, n_frames, None) for p, path in zip(json_paths, outputs[fmt])]
+        results = list(convert_many(jobs, workers=args.workers, cutoff=3, fs=FPS, order=2))
+        errors = [error for _, _, error in results if error]
+        if errors:
+            raise RuntimeError(errors[0])
+
+    def load_2d(paths):
+        for path in paths:
+            reader = open_pose_file(path)
+            try:
+                reader.read(0, reader.n_frames)
+            finally:
+                reader.close()
+    seconds["json_to_store"], _ = timed(lambda: convert("store"), args.repeat)
+    seconds["json_to_h5"], _ = timed(lambda: convert("h5"), args.repeat)
+    seconds["json_decode"], keypoints = timed(lambda: load_alphapose_json(json_paths[0], n_frames=n_frames),
+                                              args.repeat)
+    seconds["load_2d_store"], _ = timed(lambda: load_2d(outputs["store"]), args.repeat)
+    seconds["load_2d_h5"], _ = timed(lambda: load_2d(outputs["h5"]), args.repeat)
+    disk_bytes = {fmt: sum(os.path.getsize(p) for p in paths)
+                  for fmt, paths in (("json", json_paths), ("store", outputs["store"]), ("h5", outputs["h5"]))}
+
+    # step3 with this run's folders, reading the store; its progress prints are dropped
+    step3.pose_input = 'store'
+    step3.store_folder = store_dir
+    seconds["group_pose_files"], groups = timed(lambda: step3.group_pose_files(step3.pose_files()), args.repeat)
+    step3.output_folder = out_dir
+    step3.sync_mode = 'none'
+    (person, movement, segment), cams = next(iter(groups.items()))
+    fname_dict = {cam: cams[cam] for cam in calib["names"]}
+    paths = step3.output_paths(name)
+    cgroup = CameraGroup.load(calibration_path)
+
+    def triangulate_trial():
+        with contextlib.redirect_stdout(io.StringIO()):
+            step3.process_group(name, fname_dict, cgroup, calib, paths)
+    seconds["process_group"], _ = timed(triangulate_trial, args.repeat)
+
+    trial = load_trial(paths["npy"], mmap=False)
+    points = trial["points"]
+    error = np.linalg.norm(points - truth, axis=2)
+
+    seconds["filter_2d"], _ = timed(lambda: lowpass_keypoints(keypoints, cutoff=3, fs=FPS, order=2), args.repeat)
+    seconds["filter_3d"], _ = timed(lambda: lowpass(points, cutoff=3, fs=FPS, order=4, padlen=10), args.repeat)
+    seconds["step4_figure"] = None
+    if n_frames <= args.step4_max_frames:
+        seconds["step4_figure"], _ = timed(lambda: build_figure(points, COCO_KEYPOINTS, name), args.repeat)
+
+    return {
+        "frames": n_frames,
+        "cameras": len(calib["names"]),
+        "generate_seconds": round(generate_seconds, 4),
+        "seconds": {k: None if v is None else round(v, 5) for k, v in seconds.items()},
+        "frames_per_second": {k: None if v is None else round(n_frames / v, 1) for k, v in seconds.items()},
+        "disk_bytes": disk_bytes,
+        "accuracy": {
+            "mean_error_mm": round(float(np.nanmean(error)), 3),
+            "p95_error_mm": round(float(np.nanpercentile(error, 95)), 3),
+            "nan_fraction": round(float(np.isnan(error).mean()), 4),
+        },
+    }
+
+
+def environment():
+    info = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "git_commit": None,
+    }
+    try:
+        info["git_commit"] = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+# --- REGRESSION CHECK ---
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    # stages slower than the baseline by more than tolerance (and by more than
+    # REGRESSION_MIN_SECONDS), matched by trial length
+    base_runs = {run["frames"]: run for run in baseline["results"]}
+    regressions = []
+    for run in results["results"]:
+        base = base_runs.get(run["frames"])
+        if base is None:
+            continue
+        for stage, seconds in run["seconds"].items():
+            before = base["seconds"].get(stage)
+            if seconds is None or not before:
+                continue
+            ratio = seconds / before
+            if ratio > 1 + tolerance and seconds - before > REGRESSION_MIN_SECONDS:
+                regressions.append({"frames": run["frames"], "stage": stage, "baseline": before,
+                                    "seconds": seconds, "ratio": round(ratio, 2)})
+    return regressions
+
+
+def print_results(results):
+    print(f"📊 {results['settings']['calibration']}, {results['results'][0]['cameras'] if results['results'] else 0} "
+          f"cameras, best of {results['settings']['repeat']}")
+    print("   " + f"{'stage':<16}" + "".join(f"{run['frames']:>12}" for run in results["results"]))
+    for stage in STAGES:
+        cells = []
+        for run in results["results"]:
+            s = run["seconds"].get(stage)
+            cells.append(f"{'-':>12}" if s is None else f"{s * 1000:>10.1f}ms")
+        print(f"   {stage:<16}" + "".join(cells))
+    for fmt in DISK_FORMATS:
+        print(f"   {'MB ' + fmt:<16}" + "".join(f"{'-':>12}" if fmt not in run.get("disk_bytes", {})
+                                               else f"{run['disk_bytes'][fmt] / 1e6:>12.2f}"
+                                               for run in results["results"]))
+    print("   " + f"{'error (mm)':<16}" + "".join(f"{run['accuracy']['mean_error_mm']:>12.2f}"
+                                                  for run in results["results"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic multi-camera benchmark of the pipeline stages")
+    parser.add_argument("--calibration", default="calibration.toml")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="trial lengths in frames")
+    parser.add_argument("--noise-px", type=float, default=NOISE_PX)
+    parser.add_argument("--joint-dropout", type=float, default=JOINT_DROPOUT)
+    parser.add_argument("--frame-dropout", type=float, default=FRAME_DROPOUT)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=None, help="JSON conversion processes (None = one per core)")
+    parser.add_argument("--step4-max-frames", type=int, default=STEP4_MAX_FRAMES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=RESULTS_FILE)
+    parser.add_argument("--workdir", default=None, help="keep the generated files here (default: a temporary folder)")
+    parser.add_argument("--compare", default=None, help="earlier results file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="pipeline_benchmark_")
+    try:
+        runs = []
+        for n_frames in args.sizes:
+            print(f"⏱ {n_frames} frames...")
+            runs.append(run_size(args.calibration, workdir, n_frames, args))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "environment": environment(),
+        "settings": {
+            "calibration": args.calibration,
+            "noise_px": args.noise_px,
+            "joint_dropout": args.joint_dropout,
+            "frame_dropout": args.frame_dropout,
+            "repeat": args.repeat,
+            "workers": args.workers,
+            "seed": args.seed,
+            "triangulation_engine": step3.triangulation_engine,
+        },
+        "results": runs,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    print_results(results)
+    print(f"💾 {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            print(f"   ❌ {r['stage']} at {r['frames']} frames: {r['baseline'] * 1000:.1f} -> "
+                  f"{r['seconds'] * 1000:.1f} ms (x{r['ratio']})")
+        print("✅ no regressions" if not regressions else f"❌ {len(regressions)} regressions")
+        raise SystemExit(1 if regressions else 0)
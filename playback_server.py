@@ -0,0 +1,354 @@
+import argparse
+import json
+import os
+import threading
+import webbrowser
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+from plotly.offline import get_plotlyjs
+
+from quality_report import REPORT_SUFFIX
+from step4_visualization import FPS, X_LIMITS, Y_LIMITS, Z_LIMITS, bone_order, bone_pairs
+from trial_io import HEADER_FILE, TRIAL_SUFFIX, find_trials, load_trial, trial_dir_for
+
+# --- SETTINGS ---
+HOST = "127.0.0.1"          # local only; the server has no authentication
+PORT = 8050
+WINDOW_FRAMES = 256         # frames per request (17 joints: 52 kB of float32)
+MAX_WINDOW_FRAMES = 4096    # largest window a request may ask for
+CLIENT_WINDOWS = 8          # windows the browser keeps around the playhead, least recently used dropped
+OPEN_TRIALS = 16            # memory-mapped trials the server keeps open
+
+
+# --- TRIAL LIBRARY ---
+class TrialLibrary:
+    # The trial folders step3 wrote under one output folder. Trials are
+    # memory-mapped on first use and frames are sliced straight from the
+    # mapping, so serving a 20-minute trial reads only the requested windows.
+    # A trial rewritten by step3 (new header.json) is mapped again.
+    def __init__(self, folder, max_open=OPEN_TRIALS):
+        self.folder = folder
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.open_trials = OrderedDict()
+
+    def names(self):
+        return [os.path.basename(path)[:-len(TRIAL_SUFFIX)] for path in find_trials(self.folder)]
+
+    def index(self):
+        # one entry per trial from its header and quality report, without
+        # touching the arrays
+        entries = []
+        for name in self.names():
+            with open(os.path.join(trial_dir_for(self.folder, name), HEADER_FILE), "r") as f:
+                header = json.load(f)
+            entry = {"name": name, "n_frames": header["n_frames"], "fps": header.get("fps") or FPS,
+                     "joints": len(header["bodyparts"]), "flags": [], "p95_error_px": None}
+            report_path = os.path.join(self.folder, f"{name}{REPORT_SUFFIX}")
+            if os.path.isfile(report_path):
+                with open(report_path, "r") as f:
+                    report = json.load(f)
+                entry["flags"] = report.get("flags", [])
+                entry["p95_error_px"] = report.get("p95_error_px")
+            entries.append(entry)
+        return entries
+
+    def get(self, name):
+        # the memory-mapped trial, or None for names that are not trials here
+        if name not in self.names():
+            return None
+        trial_dir = trial_dir_for(self.folder, name)
+        stamp = os.path.getmtime(os.path.join(trial_dir, HEADER_FILE))
+        with self.lock:
+            cached = self.open_trials.pop(name, None)
+            if cached is None or cached[0] != stamp:
+                cached = (stamp, load_trial(trial_dir, mmap=True))
+            self.open_trials[name] = cached
+            while len(self.open_trials) > self.max_open:
+                self.open_trials.popitem(last=False)
+        return cached[1]
+
+    def meta(self, name):
+        trial = self.get(name)
+        if trial is None:
+            return None
+        return {
+            "name": name,
+            "n_frames": int(trial["n_frames"]),
+            "fps": trial.get("fps") or FPS,
+            "bodyparts": trial["bodyparts"],
+            "bone_order": bone_order(bone_pairs(trial["bodyparts"])),
+            "limits": {"x": X_LIMITS, "y": Y_LIMITS, "z": Z_LIMITS},
+            "window": WINDOW_FRAMES,
+        }
+
+    def frames(self, name, start, count):
+        # (start, count, bytes): little-endian float32 (count, joints, 3)
+        trial = self.get(name)
+        if trial is None:
+            return None
+        points = trial["points"]
+        start = min(max(int(start), 0), len(points))
+        stop = min(start + min(max(int(count), 0), MAX_WINDOW_FRAMES), len(points))
+        return start, stop - start, np.ascontiguousarray(points[start:stop], dtype="<f4").tobytes()
+
+
+# --- HTTP ---
+class PlaybackHandler(BaseHTTPRequestHandler):
+    # /                             session index and player (one page)
+    # /plotly.min.js                plotly.js from the installed plotly package
+    # /api/trials                   trial list
+    # /api/trials/<name>            trial metadata
+    # /api/trials/<name>/frames     ?start=&count= window of float32 points
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [unquote(p) for p in url.path.strip("/").split("/") if p]
+        library = self.server.library
+        if not parts:
+            return self.send(200, "text/html; charset=utf-8", PLAYER_PAGE)
+        if parts == ["plotly.min.js"]:
+            return self.send(200, "application/javascript", self.server.plotly_js, cache=True)
+        if parts[:2] != ["api", "trials"]:
+            return self.send(404, "text/plain", b"not found")
+        if len(parts) == 2:
+            return self.send_json(library.index())
+        if len(parts) == 3:
+            meta = library.meta(parts[2])
+            return self.send_json(meta) if meta else self.send(404, "text/plain", b"unknown trial")
+        if len(parts) == 4 and parts[3] == "frames":
+            query = parse_qs(url.query)
+            try:
+                start = int(query.get("start", ["0"])[0])
+                count = int(query.get("count", [str(WINDOW_FRAMES)])[0])
+            except ValueError:
+                return self.send(400, "text/plain", b"start and count must be integers")
+            window = library.frames(parts[2], start, count)
+            if window is None:
+                return self.send(404, "text/plain", b"unknown trial")
+            start, count, body = window
+            return self.send(200, "application/octet-stream", body,
+                             headers={"X-Start": str(start), "X-Count": str(count)})
+        return self.send(404, "text/plain", b"not found")
+
+    def send_json(self, data):
+        self.send(200, "application/json", json.dumps(data).encode("utf-8"))
+
+    def send(self, status, content_type, body, headers=None, cache=False):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "max-age=86400" if cache else "no-store")
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(folder, host=HOST, port=PORT):
+    server = ThreadingHTTPServer((host, port), PlaybackHandler)
+    server.daemon_threads = True
+    server.library = TrialLibrary(folder)
+    server.plotly_js = get_plotlyjs().encode("utf-8")
+    return server
+
+
+def serve(folder, host=HOST, port=PORT, open_browser=True):
+    server = make_server(folder, host, port)
+    url = f"http://{host}:{server.server_address[1]}/"
+    print(f"🎬 {len(server.library.names())} trials in {folder} at {url} (Ctrl+C to stop)")
+    if open_browser:
+        webbrowser.open(url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("🛑 Playback server stopped.")
+    finally:
+        server.server_close()
+
+
+# --- PLAYER PAGE ---
+# The browser keeps at most CLIENT_WINDOWS windows of frames and draws the
+# current frame by restyling two traces (joints, bones), so its memory does
+# not grow with the trial either. The next window is fetched halfway through
+# the current one; a frame whose window has not arrived holds the clock.
+PLAYER_PAGE = """<!doctype html>
+<html><head><meta charset="utf-8"><title>3D sessions</title>
+<script src="/plotly.min.js"></script>
+<style>
+body { margin: 0; font-family: sans-serif; display: flex; height: 100vh; }
+#index { width: 280px; overflow-y: auto; border-right: 1px solid #ccc; }
+#index > div { padding: 6px 10px; cursor: pointer; border-bottom: 1px solid #eee; font-size: 13px; }
+#index > div.active { background: #def; }
+#index span { display: block; }
+#index .info { color: #666; font-size: 11px; }
+#index .flags { color: #c00; font-size: 11px; }
+#main { flex: 1; display: flex; flex-direction: column; }
+#plot { flex: 1; }
+#controls { display: flex; align-items: center; gap: 8px; padding: 6px 10px; }
+#scrub { flex: 1; }
+#clock { font-variant-numeric: tabular-nums; font-size: 13px; }
+</style></head>
+<body>
+<div id="index"></div>
+<div id="main">
+  <div id="plot"></div>
+  <div id="controls"><button id="play">Play</button><input id="scrub" type="range" min="0" max="0" value="0"><span id="clock"></span></div>
+</div>
+<script>
+const CLIENT_WINDOWS = __CLIENT_WINDOWS__;
+const playButton = document.getElementById("play"), scrub = document.getElementById("scrub"), clock = document.getElementById("clock");
+let meta = null, windows = new Map(), pending = new Map(), token = 0;
+let frame = 0, playing = false, t0 = 0, f0 = 0;
+
+function fmt(seconds) {
+  const m = Math.floor(seconds / 60), s = Math.floor(seconds % 60);
+  return m + ":" + String(s).padStart(2, "0");
+}
+
+function fetchWindow(w) {
+  if (windows.has(w)) return Promise.resolve();
+  if (pending.has(w)) return pending.get(w);
+  const mine = token, start = w * meta.window;
+  const url = "/api/trials/" + encodeURIComponent(meta.name) + "/frames?start=" + start + "&count=" + meta.window;
+  const request = fetch(url).then(r => r.arrayBuffer()).then(buffer => {
+    if (mine !== token) return;
+    pending.delete(w);
+    windows.set(w, new Float32Array(buffer));
+    while (windows.size > CLIENT_WINDOWS) windows.delete(windows.keys().next().value);
+  }).catch(() => { if (mine === token) pending.delete(w); });
+  pending.set(w, request);
+  return request;
+}
+
+function draw(f) {
+  const w = Math.floor(f / meta.window), data = windows.get(w);
+  if (!data) {
+    fetchWindow(w).then(() => { if (frame === f) draw(f); });
+    return false;
+  }
+  windows.delete(w);
+  windows.set(w, data);
+  const n = meta.bodyparts.length, offset = (f - w * meta.window) * n * 3;
+  const x = [], y = [], z = [];
+  for (let j = 0; j < n; j++) {
+    for (const [axis, out] of [[0, x], [1, y], [2, z]]) {
+      const v = data[offset + 3 * j + axis];
+      out.push(Number.isNaN(v) ? null : v);
+    }
+  }
+  const bx = [], by = [], bz = [];
+  for (const j of meta.bone_order) {
+    bx.push(j < 0 ? null : x[j]);
+    by.push(j < 0 ? null : y[j]);
+    bz.push(j < 0 ? null : z[j]);
+  }
+  Plotly.restyle("plot", {x: [x, bx], y: [y, by], z: [z, bz]}, [0, 1]);
+  scrub.value = f;
+  clock.textContent = fmt(f / meta.fps) + " / " + fmt(meta.n_frames / meta.fps) + "  frame " + f;
+  if (f - w * meta.window >= meta.window / 2 && (w + 1) * meta.window < meta.n_frames) fetchWindow(w + 1);
+  return true;
+}
+
+function tick(now) {
+  if (!playing) return;
+  const target = f0 + Math.floor((now - t0) / 1000 * meta.fps);
+  if (target >= meta.n_frames) { setPlaying(false); return; }
+  if (target !== frame) {
+    frame = target;
+    if (!draw(frame)) { t0 = now; f0 = frame; }
+  }
+  requestAnimationFrame(tick);
+}
+
+function setPlaying(on) {
+  playing = on && meta !== null;
+  playButton.textContent = playing ? "Pause" : "Play";
+  if (playing) {
+    if (frame >= meta.n_frames - 1) frame = 0;
+    t0 = performance.now(); f0 = frame;
+    requestAnimationFrame(tick);
+  }
+}
+
+async function openTrial(name) {
+  setPlaying(false);
+  const mine = ++token;
+  windows.clear(); pending.clear();
+  const response = await fetch("/api/trials/" + encodeURIComponent(name));
+  if (!response.ok || mine !== token) return;
+  meta = await response.json();
+  frame = 0;
+  scrub.max = Math.max(meta.n_frames - 1, 0);
+  scrub.value = 0;
+  for (const row of document.querySelectorAll("#index > div")) row.classList.toggle("active", row.dataset.name === name);
+  history.replaceState(null, "", "?trial=" + encodeURIComponent(name));
+  Plotly.react("plot", [
+    {type: "scatter3d", mode: "markers", x: [], y: [], z: [], marker: {size: 4}, name: "joints", text: meta.bodyparts, hoverinfo: "text"},
+    {type: "scatter3d", mode: "lines", x: [], y: [], z: [], line: {width: 4}, name: "bones", hoverinfo: "skip"},
+  ], {
+    title: {text: meta.name},
+    uirevision: "keep",
+    scene: {xaxis: {title: {text: "X"}, range: meta.limits.x}, yaxis: {title: {text: "Y"}, range: meta.limits.y},
+            zaxis: {title: {text: "Z"}, range: meta.limits.z}, aspectmode: "cube"},
+    margin: {l: 0, r: 0, t: 40, b: 0},
+  });
+  if (meta.n_frames > 0) draw(0);
+}
+
+playButton.onclick = () => setPlaying(!playing);
+scrub.oninput = () => {
+  if (!meta) return;
+  frame = Number(scrub.value);
+  draw(frame);
+  t0 = performance.now(); f0 = frame;
+};
+document.addEventListener("keydown", e => {
+  if (e.code === "Space" && e.target === document.body) { e.preventDefault(); setPlaying(!playing); }
+});
+
+fetch("/api/trials").then(r => r.json()).then(trials => {
+  const index = document.getElementById("index");
+  for (const t of trials) {
+    const row = document.createElement("div");
+    row.dataset.name = t.name;
+    const title = document.createElement("span");
+    title.textContent = t.name;
+    const info = document.createElement("span");
+    info.className = "info";
+    info.textContent = fmt(t.n_frames / t.fps) + ", " + t.n_frames + " frames" +
+      (t.p95_error_px === null ? "" : ", p95 " + t.p95_error_px + " px");
+    row.append(title, info);
+    if (t.flags.length) {
+      const flags = document.createElement("span");
+      flags.className = "flags";
+      flags.textContent = t.flags.join(", ");
+      row.append(flags);
+    }
+    row.onclick = () => openTrial(t.name);
+    index.append(row);
+  }
+  const wanted = new URLSearchParams(location.search).get("trial");
+  const first = trials.find(t => t.name === wanted) || trials[0];
+  if (first) openTrial(first.name);
+});
+</script>
+</body></html>
+""".replace("__CLIENT_WINDOWS__", str(CLIENT_WINDOWS))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Browse and play step3's 3D trials in a local streaming viewer")
+    parser.add_argument("folder", nargs="?", default="output_3d_data")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--no-browser", action="store_true")
+    args = parser.parse_args()
+    serve(args.folder, args.host, args.port, open_browser=not args.no_browser)
@@ -0,0 +1,449 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+# --- COCO-17 LAYOUT (AlphaPose output order) ---
+COCO_KEYPOINTS = [
+    "Nose", "LEye", "REye", "LEar", "REar",
+    "LShoulder", "RShoulder", "LElbow", "RElbow",
+    "LWrist", "RWrist", "LHip", "RHip",
+    "LKnee", "RKnee", "LAnkle", "RAnkle"
+]
+COCO_BONES = [
+    (0, 1), (0, 2), (1, 3), (2, 4),
+    (5, 6), (5, 7), (7, 9), (6, 8), (8, 10),
+    (5, 11), (6, 12), (11, 12),
+    (11, 13), (13, 15), (12, 14), (14, 16),
+]
+
+# --- SERVICE SETTINGS ---
+INFERENCE_BATCH_SIZE = 32   # frames per backend call, packed across clip boundaries
+PREFETCH_FRAMES = 128       # decoded frames buffered ahead of the backend
+IDLE_FLUSH_SECONDS = 0.5    # a partial batch runs once no frame has arrived for this long
+
+
+# --- BACKEND INTERFACE ---
+# A backend turns a list of BGR frames into, for every frame, a list of
+# detections {"keypoints": (17, 3) array of x, y, score, "score": float,
+# "box": [x, y, w, h]}. load() runs once per service, not once per video.
+class PoseBackend:
+    name = "base"
+
+    def load(self):
+        pass
+
+    def infer(self, frames):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FakePoseBackend(PoseBackend):
+    # CPU-only stand-in: one person whose skeleton sways with the frame
+    # brightness, so queueing, batching and file output can be exercised
+    # without a GPU or AlphaPose. Records every batch size it receives.
+    name = "fake"
+
+    def __init__(self, delay_per_batch=0.0, delay_per_frame=0.0):
+        self.delay_per_batch = delay_per_batch
+        self.delay_per_frame = delay_per_frame
+        self.batch_sizes = []
+        self.loads = 0
+        template = np.array([
+            [0.50, 0.15], [0.48, 0.13], [0.52, 0.13], [0.46, 0.14], [0.54, 0.14],
+            [0.42, 0.25], [0.58, 0.25], [0.38, 0.37], [0.62, 0.37],
+            [0.36, 0.48], [0.64, 0.48], [0.45, 0.52], [0.55, 0.52],
+            [0.45, 0.70], [0.55, 0.70], [0.45, 0.88], [0.55, 0.88],
+        ])
+        self.template = template
+
+    def load(self):
+        self.loads += 1
+
+    def infer(self, frames):
+        self.batch_sizes.append(len(frames))
+        time.sleep(self.delay_per_batch + self.delay_per_frame * len(frames))
+        results = []
+        for frame in frames:
+            height, width = frame.shape[:2]
+            sway = (float(frame[::16, ::16].mean()) / 255.0 - 0.5) * 0.1
+            xy = (self.template + [sway, 0.0]) * [width, height]
+            keypoints = np.column_stack([xy, np.full(len(xy), 0.9)])
+            x0, y0 = xy.min(axis=0)
+            x1, y1 = xy.max(axis=0)
+            results.append([{"keypoints": keypoints, "score": 2.5,
+                             "box": [float(x0), float(y0), float(x1 - x0), float(y1 - y0)]}])
+        return results
+
+
+# --- REPLAY (offline runs of the live pipeline) ---
+STAMP_MAGIC = 0xA5
+
+
+def stamp_frame(frame, camera, index):
+    # camera and frame number written into the first six pixels of row 0
+    frame[0, :6, ...] = np.array([STAMP_MAGIC, camera] + [(int(index) >> s) & 0xFF for s in (24, 16, 8, 0)],
+                                 dtype=frame.dtype).reshape((6,) + (1,) * (frame.ndim - 2))
+    return frame
+
+
+def read_stamp(frame):
+    # (camera, frame number) or None for an unstamped frame
+    v = frame[0, :6, 0] if frame.ndim == 3 else frame[0, :6]
+    if int(v[0]) != STAMP_MAGIC:
+        return None
+    return int(v[1]), (int(v[2]) << 24) | (int(v[3]) << 16) | (int(v[4]) << 8) | int(v[5])
+
+
+class ReplayPoseBackend(PoseBackend):
+    # Returns recorded or synthetic 2D keypoints instead of running a model:
+    # keypoints[camera] is a (frames, 17, 3) x, y, score array, looked up by
+    # the stamp the replay cameras write into every frame. A frame without
+    # any usable joint gets no detection, like an empty AlphaPose frame.
+    name = "replay"
+
+    def __init__(self, keypoints, delay_per_batch=0.0, delay_per_frame=0.0):
+        self.keypoints = keypoints
+        self.delay_per_batch = delay_per_batch
+        self.delay_per_frame = delay_per_frame
+
+    def infer(self, frames):
+        time.sleep(self.delay_per_batch + self.delay_per_frame * len(frames))
+        results = []
+        for frame in frames:
+            stamp = read_stamp(frame)
+            if stamp is None or stamp[0] >= len(self.keypoints) or stamp[1] >= len(self.keypoints[stamp[0]]):
+                results.append([])
+                continue
+            keypoints = np.nan_to_num(self.keypoints[stamp[0]][stamp[1]])
+            valid = keypoints[:, 2] > 0
+            if not valid.any():
+                results.append([])
+                continue
+            x0, y0 = keypoints[valid, :2].min(axis=0)
+            x1, y1 = keypoints[valid, :2].max(axis=0)
+            results.append([{"keypoints": keypoints, "score": float(keypoints[valid, 2].mean()) + 2.0,
+                             "box": [float(x0), float(y0), float(x1 - x0), float(y1 - y0)]}])
+        return results
+
+
+class AlphaPoseBackend(PoseBackend):
+    # Runs AlphaPose in-process with the same building blocks as its
+    # scripts/demo_api.py (YOLO detector, SimpleTransform crops, SPPE pose
+    # network, pose NMS), but detection and pose estimation are batched
+    # over the frames handed in, which may come from several clips.
+    name = "alphapose"
+
+    def __init__(self, alphapose_dir, config_path, checkpoint_path, detector="yolo",
+                 gpus="0", pose_batch=64, min_box_area=0):
+        self.alphapose_dir = alphapose_dir
+        self.config_path = config_path
+        self.checkpoint_path = checkpoint_path
+        self.detector_name = detector
+        self.gpus = [int(g) for g in gpus.split(",")] if gpus else [-1]
+        self.pose_batch = pose_batch
+        self.min_box_area = min_box_area
+
+    def load(self):
+        if self.alphapose_dir not in sys.path:
+            sys.path.append(self.alphapose_dir)
+        # detector weights are resolved relative to the AlphaPose checkout
+        os.chdir(self.alphapose_dir)
+
+        import torch
+        from alphapose.models import builder
+        from alphapose.utils.config import update_config
+        from alphapose.utils.presets import SimpleTransform
+        from alphapose.utils.transforms import get_func_heatmap_to_coord
+        from alphapose.utils.pPose_nms import pose_nms
+        from detector.apis import get_detector
+
+        self.torch = torch
+        self.pose_nms = pose_nms
+        use_gpu = self.gpus[0] >= 0 and torch.cuda.is_available()
+        device = torch.device(f"cuda:{self.gpus[0]}" if use_gpu else "cpu")
+        cfg = update_config(self.config_path)
+        opt = SimpleNamespace(detector=self.detector_name, gpus=self.gpus if use_gpu else [-1],
+                              device=device, tracking=False, detbatch=len(self.gpus), posebatch=self.pose_batch,
+                              min_box_area=self.min_box_area)
+
+        self.detector = get_detector(opt)
+        self.detector.load_model()
+
+        self.pose_model = builder.build_sppe(cfg.MODEL, preset_cfg=cfg.DATA_PRESET)
+        self.pose_model.load_state_dict(torch.load(self.checkpoint_path, map_location=device))
+        self.pose_model.to(device)
+        self.pose_model.eval()
+
+        pose_dataset = builder.retrieve_dataset(cfg.DATASET.TRAIN)
+        self.transform = SimpleTransform(
+            pose_dataset, scale_factor=0,
+            input_size=cfg.DATA_PRESET.IMAGE_SIZE,
+            output_size=cfg.DATA_PRESET.HEATMAP_SIZE,
+            rot=0, sigma=cfg.DATA_PRESET.SIGMA,
+            train=False, add_dpg=False, gpu_device=device)
+        self.input_size = cfg.DATA_PRESET.IMAGE_SIZE
+        self.hm_size = cfg.DATA_PRESET.HEATMAP_SIZE
+        self.heatmap_to_coord = get_func_heatmap_to_coord(cfg)
+        self.device = device
+
+    def infer(self, frames):
+        torch = self.torch
+        results = [[] for _ in frames]
+        with torch.no_grad():
+            imgs = []
+            dims = []
+            for frame in frames:
+                img = self.detector.image_preprocess(frame)
+                if isinstance(img, np.ndarray):
+                    img = torch.from_numpy(img)
+                if img.dim() == 3:
+                    img = img.unsqueeze(0)
+                imgs.append(img)
+                dims.append([frame.shape[1], frame.shape[0]])
+            imgs = torch.cat(imgs)
+            im_dim_list = torch.FloatTensor(dims).repeat(1, 2)
+
+            dets = self.detector.images_detection(imgs, im_dim_list)
+            if isinstance(dets, int) or dets.shape[0] == 0:
+                return results
+            if isinstance(dets, np.ndarray):
+                dets = torch.from_numpy(dets)
+            dets = dets.cpu()
+            frame_ids = dets[:, 0].long()
+            boxes = dets[:, 1:5]
+            scores = dets[:, 5:6]
+            ids = torch.zeros(scores.shape)
+
+            inps = torch.zeros(len(boxes), 3, *self.input_size)
+            cropped_boxes = torch.zeros(len(boxes), 4)
+            for i, box in enumerate(boxes):
+                inps[i], cropped_box = self.transform.test_transform(frames[int(frame_ids[i])], box)
+                cropped_boxes[i] = torch.FloatTensor(cropped_box)
+
+            heatmaps = []
+            for start in range(0, len(inps), self.pose_batch):
+                heatmaps.append(self.pose_model(inps[start:start + self.pose_batch].to(self.device)).cpu())
+            heatmaps = torch.cat(heatmaps)
+
+            for f in range(len(frames)):
+                sel = (frame_ids == f).nonzero().flatten()
+                if len(sel) == 0:
+                    continue
+                coords, kp_scores = [], []
+                for i in sel.tolist():
+                    coord, kp_score = self.heatmap_to_coord(
+                        heatmaps[i][:len(COCO_KEYPOINTS)], cropped_boxes[i].tolist(),
+                        hm_shape=self.hm_size, norm_type=None)
+                    coords.append(torch.from_numpy(coord).unsqueeze(0))
+                    kp_scores.append(torch.from_numpy(kp_score).unsqueeze(0))
+                f_boxes, f_scores, f_ids, f_coords, f_kp_scores, _ = self.pose_nms(
+                    boxes[sel], scores[sel], ids[sel], torch.cat(coords), torch.cat(kp_scores),
+                    self.min_box_area)
+                for k in range(len(f_coords)):
+                    kp = f_coords[k].numpy()
+                    kp_score = f_kp_scores[k].numpy().reshape(-1)
+                    x0, y0, x1, y1 = [float(v) for v in f_boxes[k]]
+                    results[f].append({
+                        "keypoints": np.column_stack([kp, kp_score]),
+                        "score": float(kp_score.mean() + float(f_scores[k]) + 1.5 * kp_score.max()),
+                        "box": [x0, y0, x1 - x0, y1 - y0],
+                    })
+        return results
+
+    def close(self):
+        self.pose_model = None
+        self.detector = None
+        if getattr(self, "torch", None) is not None and self.torch.cuda.is_available():
+            self.torch.cuda.empty_cache()
+
+
+def make_backend(name, **alphapose_kwargs):
+    if name == "alphapose":
+        return AlphaPoseBackend(**alphapose_kwargs)
+    if name == "fake":
+        return FakePoseBackend()
+    raise ValueError(f"unknown pose backend: {name}")
+
+
+# --- ALPHAPOSE-FORMAT OUTPUT ---
+def detections_to_json(frame_results):
+    # same schema as alphapose-results.json: one entry per detection per frame
+    entries = []
+    for frame_idx, detections in enumerate(frame_results):
+        for det_idx, det in enumerate(detections):
+            entries.append({
+                "image_id": f"{frame_idx}.jpg",
+                "category_id": 1,
+                "keypoints": [round(float(v), 4) for v in np.asarray(det["keypoints"]).reshape(-1)],
+                "score": float(det["score"]),
+                "box": [float(v) for v in det["box"]],
+                "idx": [det_idx],
+            })
+    return entries
+
+
+def draw_skeleton(frame, detections, score_threshold=0.05):
+    for det in detections:
+        kp = np.asarray(det["keypoints"])
+        for a, b in COCO_BONES:
+            if kp[a, 2] > score_threshold and kp[b, 2] > score_threshold:
+                cv2.line(frame, (int(kp[a, 0]), int(kp[a, 1])), (int(kp[b, 0]), int(kp[b, 1])), (0, 255, 255), 2)
+        for x, y, s in kp:
+            if s > score_threshold:
+                cv2.circle(frame, (int(x), int(y)), 3, (0, 0, 255), -1)
+    return frame
+
+
+# --- LONG-LIVED INFERENCE SERVICE ---
+class InferenceJob:
+    def __init__(self, video_path, json_path, skeleton_path=None):
+        self.video_path = video_path
+        self.json_path = json_path
+        self.skeleton_path = skeleton_path
+        self.results = []
+        self.writer = None
+        self.fps = 30.0
+        self.error = None
+
+
+class InferenceService:
+    # Loads the backend once, then a reader thread decodes the queued videos
+    # back to back while the service thread packs their frames into
+    # fixed-size batches, so short clips share batches instead of each paying
+    # for model startup and a half-empty last batch.
+    def __init__(self, backend, batch_size=INFERENCE_BATCH_SIZE, prefetch=PREFETCH_FRAMES, on_job_done=None):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.jobs = queue.Queue()
+        self.frames = queue.Queue(maxsize=prefetch)
+        self.on_job_done = on_job_done
+        self.done = []
+        self.reader = threading.Thread(target=self._read_loop)
+        self.worker = threading.Thread(target=self._infer_loop)
+
+    def start(self):
+        self.backend.load()
+        self.reader.start()
+        self.worker.start()
+        return self
+
+    def submit(self, video_path, json_path, skeleton_path=None):
+        job = InferenceJob(video_path, json_path, skeleton_path)
+        self.jobs.put(job)
+        return job
+
+    def close(self):
+        # finishes every queued video before returning
+        self.jobs.put(None)
+        self.reader.join()
+        self.worker.join()
+        self.backend.close()
+
+    def _read_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.frames.put(None)
+                break
+            cap = None
+            try:
+                cap = cv2.VideoCapture(job.video_path)
+                if not cap.isOpened():
+                    job.error = f"cannot open video {job.video_path}"
+                else:
+                    fps = cap.get(cv2.CAP_PROP_FPS)
+                    job.fps = fps if fps and fps > 0 else job.fps
+                    while True:
+                        ret, frame = cap.read()
+                        if not ret:
+                            break
+                        self.frames.put((job, frame))
+            except Exception as e:
+                # a failed decode ends this clip only; the marker below still
+                # goes out so the worker finalizes the job and close() returns
+                job.error = f"decode failed: {e}"
+            finally:
+                if cap is not None:
+                    cap.release()
+                # end-of-clip marker: the job is finalized once its frames are inferred
+                self.frames.put((job, None))
+
+    def _infer_loop(self):
+        batch = []
+        finished = []
+        while True:
+            try:
+                item = self.frames.get(timeout=IDLE_FLUSH_SECONDS if batch else None)
+            except queue.Empty:
+                # nothing left to pack with: a long-running service must not
+                # hold the last clip's frames until the next video is queued
+                self._run_batch(batch, finished)
+                batch = []
+                finished = []
+                continue
+            if item is None:
+                self._run_batch(batch, finished)
+                break
+            job, frame = item
+            if frame is None:
+                if batch:
+                    finished.append(job)
+                else:
+                    self._finish(job)
+                continue
+            batch.append((job, frame))
+            if len(batch) >= self.batch_size:
+                self._run_batch(batch, finished)
+                batch = []
+                finished = []
+
+    def _run_batch(self, batch, finished):
+        if batch:
+            try:
+                results = self.backend.infer([frame for _, frame in batch])
+            except Exception as e:
+                results = [[] for _ in batch]
+                for job in {job for job, _ in batch}:
+                    job.error = f"inference failed: {e}"
+            for (job, frame), detections in zip(batch, results):
+                job.results.append(detections)
+                if job.skeleton_path and job.error is None:
+                    try:
+                        self._write_overlay(job, frame, detections)
+                    except Exception as e:
+                        job.error = f"skeleton video failed: {e}"
+        for job in finished:
+            self._finish(job)
+
+    def _write_overlay(self, job, frame, detections):
+        if job.writer is None:
+            height, width = frame.shape[:2]
+            job.writer = cv2.VideoWriter(job.skeleton_path, cv2.VideoWriter_fourcc(*"MJPG"), job.fps, (width, height))
+        job.writer.write(draw_skeleton(frame, detections))
+
+    def _finish(self, job):
+        # errors are kept on the job: an exception here would stop the worker
+        # thread and leave close() waiting forever
+        try:
+            if job.writer is not None:
+                job.writer.release()
+            if job.error is None:
+                with open(job.json_path, "w") as f:
+                    json.dump(detections_to_json(job.results), f)
+        except Exception as e:
+            job.error = f"writing results failed: {e}"
+        self.done.append(job)
+        if self.on_job_done is not None:
+            try:
+                self.on_job_done(job)
+            except Exception as e:
+                print(f"⚠ on_job_done failed for {job.video_path}: {e}")
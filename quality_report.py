@@ -0,0 +1,167 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# --- SETTINGS ---
+REPORT_SUFFIX = "_quality.json"          # <trial>_quality.json next to the trial's outputs
+DATASET_TABLE = "quality_summary.csv"    # one row per trial, worst first
+ERROR_BIN_PX = 0.1                       # resolution of the reported error percentiles
+ERROR_MAX_PX = 200.0                     # errors above this share one overflow bin
+FLAG_NAN_FRACTION = 0.2                  # a trial is flagged above these
+FLAG_P95_ERROR_PX = 15.0
+FLAG_CAMERA_ERROR_PX = 10.0
+
+
+# --- PER-TRIAL ACCUMULATOR ---
+class TrialQuality:
+    # Per-joint statistics gathered chunk by chunk as step3 triangulates, so
+    # a trial of any length is summarized without keeping its arrays. Error
+    # percentiles come from fixed-width histograms (ERROR_BIN_PX resolution).
+    def __init__(self, bodyparts, cam_names):
+        self.bodyparts = list(bodyparts)
+        self.cam_names = list(cam_names)
+        n_joints, n_cams = len(self.bodyparts), len(self.cam_names)
+        self.n_bins = int(np.ceil(ERROR_MAX_PX / ERROR_BIN_PX)) + 1
+        self.n_frames = 0
+        self.missing = np.zeros(n_joints, dtype=np.int64)
+        self.views = np.zeros(n_joints, dtype=np.int64)
+        self.error_hist = np.zeros((n_joints, self.n_bins), dtype=np.int64)
+        self.error_max = np.full(n_joints, np.nan)
+        self.camera_sum = np.zeros((n_joints, n_cams))
+        self.camera_count = np.zeros((n_joints, n_cams), dtype=np.int64)
+
+    def add(self, points, reproj_error, camera_error, n_views):
+        # points (frames, joints, 3), reproj_error and n_views (frames, joints),
+        # camera_error (frames, joints, cams)
+        n_joints = len(self.bodyparts)
+        self.n_frames += len(points)
+        self.missing += np.isnan(points).any(axis=2).sum(axis=0)
+        self.views += np.asarray(n_views, dtype=np.int64).sum(axis=0)
+
+        finite = np.isfinite(reproj_error)
+        joint = np.broadcast_to(np.arange(n_joints), reproj_error.shape)[finite]
+        bins = np.minimum((reproj_error[finite] / ERROR_BIN_PX).astype(np.int64), self.n_bins - 1)
+        self.error_hist += np.bincount(joint * self.n_bins + bins,
+                                       minlength=n_joints * self.n_bins).reshape(n_joints, self.n_bins)
+        if finite.any():
+            self.error_max = np.fmax(self.error_max, np.fmax.reduce(np.where(finite, reproj_error, np.nan), axis=0))
+
+        seen = np.isfinite(camera_error)
+        self.camera_sum += np.where(seen, camera_error, 0).sum(axis=0)
+        self.camera_count += seen.sum(axis=0)
+
+    def percentile(self, hist, q):
+        # upper edge of the bin holding the q-th fraction of the samples
+        total = hist.sum(axis=-1)
+        rank = np.ceil(q * total)[..., None]
+        index = (np.cumsum(hist, axis=-1) < np.maximum(rank, 1)).sum(axis=-1)
+        return np.where(total > 0, (index + 1) * ERROR_BIN_PX, np.nan)
+
+    def summary(self, name):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            nan_fraction = self.missing / max(self.n_frames, 1)
+            mean_views = self.views / max(self.n_frames, 1)
+            camera_mean = self.camera_sum.sum(axis=0) / self.camera_count.sum(axis=0)
+        median = self.percentile(self.error_hist, 0.5)
+        p95 = self.percentile(self.error_hist, 0.95)
+        total = self.error_hist.sum(axis=0)
+
+        joints = {}
+        for j, joint in enumerate(self.bodyparts):
+            joints[joint] = {
+                "nan_fraction": round(float(nan_fraction[j]), 4),
+                "mean_views": round(float(mean_views[j]), 3),
+                "median_error_px": none_if_nan(median[j]),
+                "p95_error_px": none_if_nan(p95[j]),
+                "max_error_px": none_if_nan(self.error_max[j]),
+            }
+        worst = int(np.nanargmax(np.nan_to_num(p95, nan=-1)))
+        report = {
+            "trial": name,
+            "n_frames": int(self.n_frames),
+            "cameras": self.cam_names,
+            "nan_fraction": round(float(self.missing.sum() / max(self.n_frames * len(self.bodyparts), 1)), 4),
+            "mean_views": round(float(self.views.sum() / max(self.n_frames * len(self.bodyparts), 1)), 3),
+            "median_error_px": none_if_nan(self.percentile(total, 0.5)),
+            "p95_error_px": none_if_nan(self.percentile(total, 0.95)),
+            "max_error_px": none_if_nan(np.nanmax(self.error_max) if np.isfinite(self.error_max).any() else np.nan),
+            "camera_error_px": {cam: none_if_nan(e) for cam, e in zip(self.cam_names, camera_mean)},
+            "worst_joint": self.bodyparts[worst],
+            "joints": joints,
+        }
+        report["flags"] = quality_flags(report)
+        return report
+
+
+def none_if_nan(value):
+    value = float(value)
+    return None if np.isnan(value) else round(value, 3)
+
+
+def quality_flags(report):
+    flags = []
+    if report["nan_fraction"] > FLAG_NAN_FRACTION:
+        flags.append(f"nan_fraction>{FLAG_NAN_FRACTION}")
+    if (report["p95_error_px"] or 0) > FLAG_P95_ERROR_PX:
+        flags.append(f"p95_error>{FLAG_P95_ERROR_PX}px")
+    for cam, error in report["camera_error_px"].items():
+        if (error or 0) > FLAG_CAMERA_ERROR_PX:
+            flags.append(f"camera_{cam}_error>{FLAG_CAMERA_ERROR_PX}px")
+    return flags
+
+
+def write_report(path, report):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(report, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+# --- DATASET TABLE ---
+def find_reports(folder):
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(REPORT_SUFFIX))
+
+
+def dataset_table(report_paths):
+    # one row per trial, flagged and high-error trials first
+    rows = []
+    for path in report_paths:
+        with open(path, "r") as f:
+            report = json.load(f)
+        row = {key: report[key] for key in ("trial", "n_frames", "nan_fraction", "mean_views",
+                                            "median_error_px", "p95_error_px", "max_error_px")}
+        for cam, error in report["camera_error_px"].items():
+            row[f"error_{cam}_px"] = error
+        worst = report["worst_joint"]
+        row["worst_joint"] = worst
+        row["worst_joint_p95_px"] = report["joints"][worst]["p95_error_px"]
+        row["flags"] = ";".join(report["flags"])
+        row["n_flags"] = len(report["flags"])
+        rows.append(row)
+    table = pd.DataFrame(rows)
+    if len(table):
+        table = table.sort_values(["n_flags", "p95_error_px"], ascending=False, na_position="first")
+        table = table.drop(columns="n_flags").reset_index(drop=True)
+    return table
+
+
+def write_dataset_table(folder):
+    table = dataset_table(find_reports(folder))
+    path = os.path.join(folder, DATASET_TABLE)
+    table.to_csv(path, index=False)
+    return path, table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the dataset quality table from step3's per-trial reports")
+    parser.add_argument("folder", nargs="?", default="output_3d_data")
+    parser.add_argument("--top", type=int, default=20, help="worst trials to print")
+    args = parser.parse_args()
+    path, table = write_dataset_table(args.folder)
+    print(f"📋 {len(table)} trials -> {path}")
+    if len(table):
+        with pd.option_context("display.width", 200, "display.max_columns", None):
+            print(table.head(args.top).to_string(index=False))
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+import threading
+
+HASH_CHUNK = 1 << 20
+
+
+def hash_file(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# --- INCREMENTAL RUN MANIFEST ---
+class RunManifest:
+    # Persistent record of every artifact a stage produced: the content hash of
+    # each input, the parameters used and the outputs written. A stage asks
+    # is_fresh() before doing the work and calls record() afterwards.
+    # File hashes are cached by (size, mtime), so unchanged videos are not
+    # re-read on every run.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {"hashes": {}, "artifacts": {}}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self.data = json.load(f)
+            except json.JSONDecodeError:
+                print(f"⚠ manifest {path} was broken, every artifact will be rebuilt")
+
+    def file_hash(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self.lock:
+            cached = self.data["hashes"].get(path)
+        if cached and cached["size"] == st.st_size and cached["mtime_ns"] == st.st_mtime_ns:
+            return cached["hash"]
+        digest = hash_file(path)
+        with self.lock:
+            self.data["hashes"][path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": digest}
+        return digest
+
+    def _signature(self, inputs, params):
+        return {
+            "inputs": {os.path.abspath(p): self.file_hash(p) for p in inputs},
+            "params": json.loads(json.dumps(params, sort_keys=True, default=str)),
+        }
+
+    def _output_state(self, outputs):
+        state = {}
+        for p in outputs:
+            st = os.stat(p)
+            state[os.path.abspath(p)] = [st.st_size, st.st_mtime_ns]
+        return state
+
+    def is_fresh(self, key, inputs, params, outputs):
+        with self.lock:
+            entry = self.data["artifacts"].get(key)
+        if entry is None:
+            return False
+        if any(not os.path.exists(p) for p in list(inputs) + list(outputs)):
+            return False
+        if self._signature(inputs, params) != entry["signature"]:
+            return False
+        # an output rewritten by hand or by another run is stale too
+        return self._output_state(outputs) == entry["outputs"]
+
+    def record(self, key, inputs, params, outputs):
+        entry = {"signature": self._signature(inputs, params), "outputs": self._output_state(outputs)}
+        with self.lock:
+            self.data["artifacts"][key] = entry
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.data, f, indent=1)
+            os.replace(tmp_path, self.path)
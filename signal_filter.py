@@ -0,0 +1,279 @@
+import argparse
+import time
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import butter, filtfilt, lfilter, lfilter_zi
+
+
+# --- FILTER DESIGN ---
+@lru_cache(maxsize=None)
+def butter_lowpass(cutoff, fs, order):
+    # (b, a, zi) designed once per setting, not once per column
+    b, a = butter(order, cutoff / (0.5 * fs), btype='low', analog=False)
+    return b, a, lfilter_zi(b, a)
+
+
+def valid_runs(valid):
+    # (start, stop) of every run of True in a 1D mask
+    edges = np.diff(np.concatenate(([0], valid.astype(np.int8), [0])))
+    return zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))
+
+
+def mask_groups(finite):
+    # channel rows sharing the same NaN pattern (X/Y/Z of a joint, or every
+    # channel when whole frames are missing) are handled as one block
+    if finite.all():
+        return [np.arange(len(finite))]
+    groups = {}
+    for row, mask in enumerate(np.packbits(finite, axis=1)):
+        groups.setdefault(mask.tobytes(), []).append(row)
+    return [np.array(rows) for rows in groups.values()]
+
+
+def zero_phase_runs(b, a, zi, series, padlen):
+    # filtfilt (odd extension, steady-state initial conditions) of every valid
+    # run of every channel, in place. Runs of similar length are stacked as
+    # rows of one array, so each length bucket costs two lfilter calls however
+    # many gaps there are.
+    finite = np.isfinite(series)
+    runs = []
+    for rows in mask_groups(finite):
+        if np.all(np.diff(rows) == 1):
+            rows = slice(int(rows[0]), int(rows[-1]) + 1)
+        for start, stop in valid_runs(finite[rows][0]):
+            if stop - start > padlen:
+                runs.append((rows, int(start), int(stop)))
+    if not runs:
+        return
+    ext = np.array([stop - start + 2 * padlen for _, start, stop in runs])
+    buckets = np.ceil(np.log2(ext)).astype(int)
+    for bucket in np.unique(buckets):
+        block = [runs[i] for i in np.flatnonzero(buckets == bucket)]
+        offsets = np.cumsum([0] + [len(series[rows, 0]) for rows, _, _ in block])
+        x = np.empty((offsets[-1], int(ext[buckets == bucket].max())))
+        for (rows, start, stop), r0, r1 in zip(block, offsets[:-1], offsets[1:]):
+            seg = series[rows, start:stop]
+            e = stop - start + 2 * padlen
+            x[r0:r1, :padlen] = 2 * seg[:, :1] - seg[:, padlen:0:-1]
+            x[r0:r1, padlen:e - padlen] = seg
+            x[r0:r1, e - padlen:e] = 2 * seg[:, -1:] - seg[:, -2:-padlen - 2:-1]
+            # rows are left-aligned; the tail after a row's own length never
+            # reaches back into it because each pass is causal
+            x[r0:r1, e:] = x[r0:r1, e - 1:e]
+        y = lfilter(b, a, x, axis=-1, zi=zi * x[:, :1])[0]
+        for (rows, start, stop), r0, r1 in zip(block, offsets[:-1], offsets[1:]):
+            e = stop - start + 2 * padlen
+            y[r0:r1, :e] = y[r0:r1, e - 1::-1].copy()
+            y[r0:r1, e:] = y[r0:r1, e - 1:e]
+        y = lfilter(b, a, y, axis=-1, zi=zi * y[:, :1])[0]
+        for (rows, start, stop), r0, r1 in zip(block, offsets[:-1], offsets[1:]):
+            series[rows, start:stop] = y[r0:r1, stop - start + padlen - 1:padlen - 1:-1]
+
+
+# --- GAP FILLING ---
+def fill_gaps(flat, max_gap):
+    # linear interpolation across interior NaN gaps of at most max_gap samples;
+    # longer gaps and the ends of each column stay NaN
+    missing = np.isnan(flat)
+    t = np.arange(len(flat))
+    for col in np.flatnonzero(missing.any(axis=0)):
+        valid = ~missing[:, col]
+        if valid.sum() < 2:
+            continue
+        for start, stop in valid_runs(missing[:, col]):
+            if start > 0 and stop < len(flat) and stop - start <= max_gap:
+                flat[start:stop, col] = np.interp(t[start:stop], t[valid], flat[valid, col])
+    return flat
+
+
+# --- LOWPASS ---
+def lowpass(data, cutoff=3, fs=30, order=4, padlen=None, max_gap=0):
+    # Zero-phase Butterworth along axis 0 of a (frames, ...) array. Channels
+    # with the same NaN pattern are filtered together, one filtfilt call per
+    # contiguous valid run, so samples on both sides of a gap are never
+    # joined. Runs too short for the filter's padding are left as they are.
+    data = np.asarray(data, dtype=np.float64)
+    flat = data.reshape(len(data), -1).copy()
+    if max_gap:
+        flat = fill_gaps(flat, max_gap)
+    b, a, zi = butter_lowpass(cutoff, fs, order)
+    if padlen is None:
+        padlen = 3 * max(len(a), len(b))
+
+    # channels as contiguous rows, filtered along the last axis
+    series = np.ascontiguousarray(flat.T)
+    zero_phase_runs(b, a, zi, series, max(padlen, 1))
+    return series.T.reshape(data.shape)
+
+
+# --- CHUNKED LOWPASS ---
+@lru_cache(maxsize=None)
+def settle_frames(cutoff, fs, order, tol=1e-12):
+    # samples after which the filter's impulse response stays below tol of
+    # its peak: an edge this far away no longer changes a filtered sample
+    b, a, _ = butter_lowpass(cutoff, fs, order)
+    n = 64
+    while True:
+        impulse = np.zeros(n)
+        impulse[0] = 1.0
+        h = np.abs(lfilter(b, a, impulse))
+        above = np.flatnonzero(h > tol * h.max())
+        if above[-1] < n // 2:
+            return int(above[-1]) + 1
+        n *= 2
+
+
+class ChunkedLowpass:
+    # lowpass() over a stream of (frames, ...) chunks. The last `margin`
+    # frames are held back until enough later frames have arrived, and each
+    # chunk is filtered together with `margin` frames of the one before, so
+    # the result matches filtering the whole series at once to within tol of
+    # the signal while memory depends only on the chunk size.
+    def __init__(self, cutoff=3, fs=30, order=4, padlen=None, max_gap=0, tol=1e-12):
+        self.kwargs = dict(cutoff=cutoff, fs=fs, order=order, padlen=padlen, max_gap=max_gap)
+        b, a, _ = butter_lowpass(cutoff, fs, order)
+        if padlen is None:
+            padlen = 3 * max(len(a), len(b))
+        self.margin = settle_frames(cutoff, fs, order, tol) + padlen + max_gap
+        self.buffer = None
+        self.offset = 0     # first buffered frame not returned yet
+
+    def push(self, chunk, final=False):
+        # filtered frames that are now final, in order
+        chunk = np.asarray(chunk, dtype=np.float64)
+        buffer = chunk if self.buffer is None else np.concatenate([self.buffer, chunk])
+        ready = len(buffer) if final else max(len(buffer) - self.margin, self.offset)
+        out = lowpass(buffer, **self.kwargs)[self.offset:ready] if ready > self.offset else buffer[:0]
+        keep = max(ready - self.margin, 0)
+        self.buffer = buffer[keep:]
+        self.offset = ready - keep
+        return out
+
+
+# --- CAUSAL FILTERS (live mode: one sample at a time, no look-ahead) ---
+class OneEuroFilter:
+    # One-euro filter over every channel of a (joints, dims) sample: an
+    # exponential smoother whose cutoff rises with the channel's speed, so a
+    # still joint is smoothed hard and a moving one follows with little lag.
+    # Samples may arrive at any interval (t in seconds); a channel that was
+    # NaN restarts from its next value.
+    def __init__(self, min_cutoff=1.0, beta=0.005, d_cutoff=1.0):
+        self.min_cutoff = min_cutoff
+        self.beta = beta            # cutoff increase per unit/s of speed (mm/s for 3D points)
+        self.d_cutoff = d_cutoff
+        self.x = None
+        self.dx = None
+        self.t = None
+
+    @staticmethod
+    def alpha(cutoff, dt):
+        tau = 1.0 / (2 * np.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+    def push(self, sample, t):
+        sample = np.asarray(sample, dtype=np.float64)
+        if self.x is None:
+            self.x = sample.copy()
+            self.dx = np.zeros_like(sample)
+            self.t = t
+            return self.x.copy()
+        dt = max(t - self.t, 1e-6)
+        self.t = t
+        fresh = np.isnan(self.x) & ~np.isnan(sample)
+        a_d = self.alpha(self.d_cutoff, dt)
+        self.dx = np.where(fresh, 0.0, a_d * (sample - self.x) / dt + (1 - a_d) * self.dx)
+        a = self.alpha(self.min_cutoff + self.beta * np.abs(self.dx), dt)
+        self.x = np.where(fresh, sample, a * sample + (1 - a) * self.x)
+        return self.x.copy()
+
+
+class CausalLowpass:
+    # Forward-only Butterworth over a stream of samples: lfilter's direct
+    # form II transposed step with the state carried between calls, started
+    # at steady state on a channel's first value and again after a NaN gap.
+    # Unlike lowpass() it adds the filter's group delay (a few frames at
+    # 3 Hz), but needs no future samples.
+    def __init__(self, cutoff=3, fs=30, order=2):
+        self.b, self.a, self.zi = butter_lowpass(cutoff, fs, order)
+        self.state = None   # (order, channels)
+
+    def push(self, sample, t=None):
+        sample = np.asarray(sample, dtype=np.float64)
+        x = sample.ravel()
+        if self.state is None:
+            self.state = np.full((len(self.zi), x.size), np.nan)
+        state, b, a = self.state, self.b, self.a
+        restart = np.isnan(state[0]) & ~np.isnan(x)
+        state[:, restart] = self.zi[:, None] * x[restart]
+        y = b[0] * x + state[0]
+        for i in range(len(state) - 1):
+            state[i] = b[i + 1] * x - a[i + 1] * y + state[i + 1]
+        state[-1] = b[-1] * x - a[-1] * y
+        state[:, np.isnan(x)] = np.nan
+        return y.reshape(sample.shape)
+
+
+# --- BENCHMARK (against the per-column loops step2_2 and step3 used) ---
+def per_column_step2_2(keypoints, cutoff=3, fs=30, order=2):
+    out = keypoints.copy()
+    for joint in range(keypoints.shape[1]):
+        for axis in range(2):
+            b, a = butter(order, cutoff / (0.5 * fs), btype='low', analog=False)
+            out[:, joint, axis] = filtfilt(b, a, list(keypoints[:, joint, axis]))
+    return out
+
+
+def per_column_step3(p3ds, cutoff=3, fs=30, order=4):
+    import pandas as pd
+    df = pd.DataFrame(p3ds.reshape(len(p3ds), -1))
+    for col in df.columns:
+        valid_idx = ~df[col].isna()
+        if valid_idx.sum() > 5:
+            b, a = butter(order, cutoff / (0.5 * fs), btype='low', analog=False)
+            df.loc[valid_idx, col] = filtfilt(b, a, df.loc[valid_idx, col].values, axis=0, padlen=10)
+    return df.values.reshape(p3ds.shape)
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def benchmark(frames, joints, gap_fraction, repeat):
+    rng = np.random.default_rng(0)
+    t = np.arange(frames)[:, None, None] / 30.0
+    keypoints = np.sin(t + rng.random((1, joints, 3))) * 100 + rng.normal(0, 2, (frames, joints, 3))
+    p3ds = np.sin(t + rng.random((1, joints, 3))) + rng.normal(0, 0.01, (frames, joints, 3))
+    # a few gaps per joint, shared by X/Y/Z as triangulation produces them
+    for joint in range(joints):
+        for start in rng.integers(0, frames, int(frames * gap_fraction / 10)):
+            p3ds[start:start + 10, joint] = np.nan
+
+    xy = keypoints[:, :, :2]
+    results = {
+        "2d per-column": timed(lambda: per_column_step2_2(keypoints), repeat),
+        "2d vectorized": timed(lambda: lowpass(xy, order=2), repeat),
+        "3d per-column": timed(lambda: per_column_step3(p3ds), repeat),
+        "3d vectorized": timed(lambda: lowpass(p3ds, order=4, padlen=10), repeat),
+    }
+    print(f"📊 {frames} frames x {joints} joints, {gap_fraction:.0%} of 3D samples in gaps (best of {repeat})")
+    for name, seconds in results.items():
+        print(f"   {name:<16} {seconds * 1000:9.2f} ms")
+    print(f"   2D speed-up x{results['2d per-column'] / results['2d vectorized']:.1f}, "
+          f"3D speed-up x{results['3d per-column'] / results['3d vectorized']:.1f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vectorized lowpass against the old per-column loops")
+    parser.add_argument("--frames", type=int, default=54000, help="30 minutes at 30 fps")
+    parser.add_argument("--joints", type=int, default=17)
+    parser.add_argument("--gaps", type=float, default=0.05, help="fraction of 3D samples inside NaN gaps")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    benchmark(args.frames, args.joints, args.gaps, args.repeat)
@@ -6,6 +6,8 @@ import time
 import re
 import gc
 import json
+from capture_engine import (CameraRecorder, PreviewSampler, SegmentManifest, PREVIEW_HZ, PREVIEW_SIZE,
+                            SEGMENT_MANIFEST, timestamp_path_for)
 
 """
 record_video_0:chess_board
@@ -27,23 +29,25 @@ video_dictionary = {
     }
 
 
-print("OpenCV version:", cv2.__version__)
-# Check available cameras
-print("Checking available camera indexes...")
-camera_indices = []
+# --- SETTINGS ---
+camera_probe_count = 8      # camera indexes checked at startup (4–6 cameras are supported)
+encoder_mode = "thread"     # "thread" or "process"; "process" gives every camera its own MJPG encoder process
+segment_seconds = 30        # rotate every camera into fixed-length segments; 0 writes one AVI per trial
 
-for i in range(4):
-    cap = cv2.VideoCapture(i, cv2.CAP_DSHOW)
-    if cap.isOpened():
-        print(f"✅ Camera detected at index {i}")
-        camera_indices.append(i)
-    else:
-        print(f"❌ No camera found at index {i}")
-    cap.release()
 
-if not camera_indices:
-    print("⚠ No cameras detected. Exiting...")
-    exit()
+def detect_cameras():
+    # Check available cameras
+    print("Checking available camera indexes...")
+    found = []
+    for i in range(camera_probe_count):
+        cap = cv2.VideoCapture(i, cv2.CAP_DSHOW)
+        if cap.isOpened():
+            print(f"✅ Camera detected at index {i}")
+            found.append(i)
+        else:
+            print(f"❌ No camera found at index {i}")
+        cap.release()
+    return found
 
 
 def sanitize_filename(name):
@@ -96,82 +100,99 @@ def start_recording(vt, person_id):
         cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
 
     frame_counts_list = [0] * len(camera_indices)  # ← 預先建立固定長度 list
-
-    def record_video(cap, filename, index):
-        ret, frame = cap.read()
-        height, width, _ = frame.shape
-        print(f"📹 Camera {cap} recording at {width}x{height}")
-
-        out = cv2.VideoWriter(filename, fourcc, 30.0, (width, height))
-        start_time_ns = time.time_ns()
-        frame_count = 0
-
-        while recording_flag.is_set():
-            ret, frame = cap.read()
-            out.write(frame)
-            frame_count += 1
-
-        frame_counts_list[index] = frame_count  # ← 放到對應 index
-        cap.release()
-        out.release()
-
-        print(f"📁 Recording stopped")
-        print(f"🕒 Start time: {datetime.datetime.fromtimestamp(start_time_ns / 1e9).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}")
-        print(f"🎞 Frame count: {frame_count}")
+    measured_fps_list = [0.0] * len(camera_indices)
+    encoder_fps_list = [0.0] * len(camera_indices)
+    dropped_frames = {"capture": [0] * len(camera_indices),
+                      "queue": [0] * len(camera_indices),
+                      "writer": [0] * len(camera_indices)}
+
+    # every camera is read only by its own grab thread; the preview samples
+    # the latest decoded frame from the recorder's ring buffer
+    manifest_path = os.path.join(save_folder, SEGMENT_MANIFEST)
+    manifest = None
+    recorders = []
+    for i, (cap, filename) in enumerate(zip(caps, video_filenames_list)):
+        recorder = CameraRecorder(cap, filename, fourcc, encoder_mode=encoder_mode,
+                                  segment_seconds=segment_seconds, name=f"cam{i+1}")
+        try:
+            recorder.open()
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            continue
+        recorders.append((i, recorder))
+    preview = PreviewSampler([recorder.ring for _, recorder in recorders], size=PREVIEW_SIZE)
 
     cv2.namedWindow("Webcam concatenate", cv2.WINDOW_NORMAL)
     cv2.resizeWindow("Webcam concatenate", 1500, 400)
     print("🎥 Press 'r' to start recording, 's' to stop.")
 
-    threads = []
-
     while True:
-        frames = []
-
-        for cap in caps:
-            ret, frame = cap.read()
-            if ret:
-                frame_resized = cv2.resize(frame, (640, 480))
-                line_color = (0, 255, 255)
-                line_thickness = 2
-                height, width, _ = frame_resized.shape
-                mid_x = width // 2
-                cv2.line(frame_resized, (mid_x, 0), (mid_x, height), line_color, line_thickness)
-                frames.append(frame_resized)
-            else:
-                frames.append(None)
-
-        valid_frames = [f for f in frames if f is not None]
-        if valid_frames:
-            combined_frame = cv2.hconcat(valid_frames) if len(valid_frames) > 1 else valid_frames[0]
+        frames = preview.sample()
+        line_color = (0, 255, 255)
+        line_thickness = 2
+        for frame_resized in frames:
+            height, width = frame_resized.shape[:2]
+            mid_x = width // 2
+            cv2.line(frame_resized, (mid_x, 0), (mid_x, height), line_color, line_thickness)
+
+        if frames:
+            combined_frame = cv2.hconcat(frames) if len(frames) > 1 else frames[0]
             cv2.imshow("Webcam concatenate", combined_frame)
 
-        key = cv2.waitKey(1) & 0xFF
+        key = cv2.waitKey(max(1, int(1000 / PREVIEW_HZ))) & 0xFF
 
         if key == ord('r') and not recording_flag.is_set():
             print("🔴 Recording")
             recording_flag.set()
-            threads = []
-            for i, (cap, filename) in enumerate(zip(caps, video_filenames_list)):
-                thread = threading.Thread(target=record_video, args=(cap, filename, i))
-                threads.append(thread)
-                thread.start()
+            # one session clock for all cameras keeps segment k aligned across views
+            session_start_ns = time.monotonic_ns()
+            if segment_seconds:
+                manifest = SegmentManifest(manifest_path, {
+                    "person_id": person_id,
+                    "folder_name": folder_name,
+                    "timestamp": timestamp,
+                    "session_start_ns": session_start_ns,
+                }, segment_seconds=segment_seconds)
+            for i, recorder in recorders:
+                recorder.start_recording(session_start_ns, manifest)
 
         elif key == ord('s') and recording_flag.is_set():
             print("🛑 Stopping")
             recording_flag.clear()
-            for thread in threads:
-                thread.join()
+            for i, recorder in recorders:
+                recorder.stop_recording()
+                recorder.report()
+                frame_counts_list[i] = recorder.frame_count  # ← 放到對應 index
+                measured_fps_list[i] = round(recorder.measured_fps(), 3)
+                encoder_fps_list[i] = round(recorder.encoder_capacity_fps(), 1)
+                for stage, count in recorder.dropped.items():
+                    dropped_frames[stage][i] = count
+            if manifest is not None:
+                manifest.finish()
+                # segmented trials: list the segment files actually written
+                segments = sorted(manifest.data["segments"], key=lambda e: (e["camera"], e["segment"]))
+                video_files = [e["video"] for e in segments]
+                timestamp_files = [e["timestamps"] for e in segments]
+            else:
+                video_files = video_filenames_list
+                timestamp_files = [timestamp_path_for(f) for f in video_filenames_list]
 
             entry = {
                 "person_id": person_id,
                 "folder_name": folder_name,
                 "timestamp": timestamp,
                 "camera_count": len(camera_indices),
-                "video_files": video_filenames_list,
+                "video_files": video_files,
+                "timestamp_files": timestamp_files,
+                "segment_seconds": segment_seconds,
+                "segment_manifest": manifest_path if segment_seconds else None,
                 "frame_counts": frame_counts_list,  # ✅ 新增這一行
+                "dropped_frames": dropped_frames,
                 "resolution": "1920x1080",
                 "fps": 30,
+                "measured_fps": measured_fps_list,
+                "encoder_mode": encoder_mode,
+                "encoder_capacity_fps": encoder_fps_list,
             }
 
             metadata_path = os.path.join(base_folder, "metadata.json")
@@ -193,6 +214,8 @@ def start_recording(vt, person_id):
 
             break
 
+    for i, recorder in recorders:
+        recorder.close()
     for cap in caps:
         cap.release()
         del cap
@@ -203,17 +226,26 @@ def start_recording(vt, person_id):
 
 
 
-vt,person_id = choose_video_type_and_id()
-start_recording(vt,person_id)
+# the encoder processes re-import this module under spawn, so the
+# interactive session only runs in the parent
+if __name__ == "__main__":
+    print("OpenCV version:", cv2.__version__)
+    camera_indices = detect_cameras()
+    if not camera_indices:
+        print("⚠ No cameras detected. Exiting...")
+        exit()
+
+    vt,person_id = choose_video_type_and_id()
+    start_recording(vt,person_id)
 
-while True:
-    print("record same subject or not？(y/n)")
-    choice = input().strip().lower()
-    if choice == 'y':
-        vt2= choose_video_type_only()
-        start_recording(vt2,person_id)
-    elif choice == 'n':
-        print(person_id+",recording finish")
-        break
-    else:
-        print("⚠failed input, 'y' or 'n' only 'y' 或 'n'。")
+    while True:
+        print("record same subject or not？(y/n)")
+        choice = input().strip().lower()
+        if choice == 'y':
+            vt2= choose_video_type_only()
+            start_recording(vt2,person_id)
+        elif choice == 'n':
+            print(person_id+",recording finish")
+            break
+        else:
+            print("⚠failed input, 'y' or 'n' only 'y' 或 'n'。")
@@ -1,33 +1,83 @@
-import numpy as np
-from aniposelib.boards import CharucoBoard, Checkerboard
-from aniposelib.cameras import Camera, CameraGroup
-from aniposelib.utils import load_pose2d_fnames
-import datetime
+import json
+import os
+import shutil
+import time
+from aniposelib.cameras import CameraGroup
+from calibration_frontend import make_board, detect_boards, refine_calibration, print_refinement
 
+# --- SETTINGS ---
 vidnames = [['output_person_001_chess_board_cam1_2025-08-25_17-08-06.avi'],
            ['output_person_001_chess_board_cam2_2025-08-25_17-08-06.avi'],
            ['output_person_001_chess_board_cam3_2025-08-25_17-08-06.avi']]
 
 cam_names = ['A', 'B', 'C']
 
-n_cams = len(vidnames)
+board_spec = dict(kind='charuco', squaresX=10, squaresY=7,
+                  square_length=59,  # here, in mm but any unit works
+                  marker_length=44,
+                  marker_bits=4, dict_size=50)
 
-board = CharucoBoard(10, 7,
-                     square_length=59, # here, in mm but any unit works
-                    marker_length=44,
-                    marker_bits=4, dict_size=50)
+frame_sampling = 'stride'   # 'all', 'stride' (every frame_stride-th frame) or 'motion' (only frames where the view changed)
+frame_stride = 5
+motion_threshold = 4.0      # 'motion': mean gray-level change on a 1/8-size frame since the last frame used
+detection_workers = None    # processes detecting boards; None = one per CPU core
+detection_cache = 'calibration_cache'  # detections per video; delete it to detect again
+output_file = 'calibration.toml'
 
+# incremental mode: instead of calibrating from scratch, start from
+# base_calibration and adjust it to a short new board clip (e.g. after a
+# camera was bumped)
+calibration_mode = 'full'   # 'full': calibrate from vidnames, 'refine': warm-started bundle adjustment
+base_calibration = 'calibration.toml'
+refine_vidnames = [['output_person_001_board_check_cam1.avi'],
+                   ['output_person_001_board_check_cam2.avi'],
+                   ['output_person_001_board_check_cam3.avi']]
+refine_only_extrinsics = True   # keep the lens intrinsics of base_calibration
+refine_reference_camera = 'A'   # keeps its pose, so the 3D coordinate frame does not move
+refine_report = 'calibration_refine.json'
 
-# the videos provided are fisheye, so we need the fisheye option
-cgroup = CameraGroup.from_names(cam_names, fisheye=False)
+def calibrate_full(board):
+    # the videos are not fisheye; set fisheye=True for fisheye lenses
+    cgroup = CameraGroup.from_names(cam_names, fisheye=False)
 
-# this will take a few minutes
-# it will detect the charuco board in the videos,
-# then calibrate the cameras based on the detections, using iterative bundle adjustment
-cgroup.calibrate_videos(vidnames, board)
+    # detect the charuco board in every camera's frames in a process pool; a
+    # rerun with the same videos, board and sampling reads the cached
+    # detections, so changing a bundle-adjustment setting costs seconds
+    t0 = time.perf_counter()
+    all_rows = detect_boards(vidnames, board_spec, sampling=frame_sampling, stride=frame_stride,
+                             motion_threshold=motion_threshold, workers=detection_workers,
+                             cache_dir=detection_cache)
+    print(f"⏱ Board detection: {time.perf_counter() - t0:.1f}s")
 
-# if you need to save and load
-# example saving and loading for later
+    # then calibrate the cameras based on the detections, using iterative bundle adjustment
+    cgroup.set_camera_sizes_videos(vidnames)
+    t0 = time.perf_counter()
+    error = cgroup.calibrate_rows(all_rows, board, init_intrinsics=True, init_extrinsics=True, verbose=True)
+    print(f"⏱ Bundle adjustment: {time.perf_counter() - t0:.1f}s, error {error:.3f}")
+    return cgroup
 
-cgroup.dump(f'calibration.toml')
+def calibrate_refine(board):
+    cgroup = CameraGroup.load(base_calibration)
+    all_rows = detect_boards(refine_vidnames, board_spec, sampling=frame_sampling, stride=frame_stride,
+                             motion_threshold=motion_threshold, workers=detection_workers,
+                             cache_dir=detection_cache)
+    report = refine_calibration(cgroup, all_rows, board, reference=cgroup.get_names().index(refine_reference_camera),
+                                only_extrinsics=refine_only_extrinsics)
+    print_refinement(report)
+    with open(refine_report, 'w') as f:
+        json.dump(report, f, indent=4)
+    if report['error_after'] >= report['error_before']:
+        print(f"⚠️ Refinement did not lower the error, keeping {base_calibration}")
+        return None
+    if os.path.abspath(output_file) == os.path.abspath(base_calibration):
+        backup = os.path.splitext(base_calibration)[0] + '_before_refine.toml'
+        shutil.copyfile(base_calibration, backup)
+        print(f"🗂 Previous calibration kept as {backup}")
+    return cgroup
 
+if __name__ == "__main__":
+    board = make_board(board_spec)
+    cgroup = calibrate_refine(board) if calibration_mode == 'refine' else calibrate_full(board)
+    if cgroup is not None:
+        cgroup.dump(output_file)
+        print(f"✅ Saved {output_file}")
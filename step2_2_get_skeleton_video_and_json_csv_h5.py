@@ -2,27 +2,47 @@ import os
 import sys
 import subprocess
 import shutil
-import json
-import csv
-import pandas as pd
-from scipy.signal import butter, filtfilt
 import cv2
 import time
-
-print("opencv_version", cv2.__version__)
+from capture_engine import finished_segment_files, is_segment_file
+from pose_backend import InferenceService, make_backend
+from run_manifest import RunManifest
+from keypoint_io import convert_many, store_path_for
+from frame_sync import index_timestamp_files, video_base_from_pose_file
 
 # Set AlphaPose directory as working directory
 alphapose_dir = r"C:\AlphaPose"
 checkpoint_path = r"C:\AlphaPose\pretrained_models\pose_model.pth"
 config_path = r"C:\AlphaPose\configs\coco\resnet\256x192_res50_lr1e-3_1x.yaml"
-os.chdir(alphapose_dir)
-sys.path.append(alphapose_dir)
+
+# --- INFERENCE SETTINGS ---
+inference_mode = "service"      # "service": load the model once for all videos, "subprocess": one demo_inference.py per video
+pose_backend_name = "alphapose" # "alphapose" or "fake" (CPU stand-in for testing the queue without a GPU)
+inference_batch_size = 32       # frames per forward pass, packed across clips
+save_skeleton_video = True
 
 base_video_dir = r"C:\Users\USER\OneDrive\Desktop_20250211_after_reset\github_repository\3d_motion_capture_system\recorded_videos"
 skeleton_video_dir = r"C:\Users\USER\OneDrive\Desktop_20250211_after_reset\github_repository\3d_motion_capture_system\skeleton_videos"
 json_dir = r"C:\Users\USER\OneDrive\Desktop_20250211_after_reset\github_repository\3d_motion_capture_system\joints_json_files"
 csv_dir = r"C:\Users\USER\OneDrive\Desktop_20250211_after_reset\github_repository\3d_motion_capture_system\joints_csv_files"
 h5_dir = r"C:\Users\USER\OneDrive\Desktop_20250211_after_reset\github_repository\3d_motion_capture_system\joints_h5_files"
+store_dir = r"C:\Users\USER\OneDrive\Desktop_20250211_after_reset\github_repository\3d_motion_capture_system\joints_store"
+
+# --- INCREMENTAL RUN SETTINGS ---
+# inputs, parameters and outputs of every artifact are recorded here; a rerun
+# only redoes videos/JSON files whose content or parameters changed
+manifest_path = r"C:\Users\USER\OneDrive\Desktop_20250211_after_reset\github_repository\3d_motion_capture_system\step2_2_manifest.json"
+force_rerun = False
+filter_cutoff = 3
+filter_fs = 30
+filter_order = 2
+filter_max_gap = 0              # undetected frames bridged by linear interpolation before filtering (0 = off)
+
+# --- CONVERSION SETTINGS ---
+output_formats = ["store"]       # written from one decode of each JSON: "store" (session keypoint store step3 reads),
+                                 # "csv" and "h5" (legacy pandas H5) only as extra exports
+conversion_workers = None        # processes converting JSON files in parallel, None = one per core
+detection_selection = "score"    # person kept when a frame has several: "score" (most confident) or "track" (IoU with previous frame)
 
 # --- 初始化資料夾結構 ---
 output_dirs = {
@@ -30,13 +50,15 @@ output_dirs = {
     "skeleton": skeleton_video_dir,
     "json": json_dir,
     "csv": csv_dir,
-    "h5": h5_dir
+    "h5": h5_dir,
+    "store": store_dir
 }
 
-for name, path in output_dirs.items():
-    os.makedirs(path, exist_ok=True)
-    print(f"📁 {name} all folders have be prepared：{path}")
 
+def prepare_output_dirs():
+    for name, path in output_dirs.items():
+        os.makedirs(path, exist_ok=True)
+        print(f"📁 {name} all folders have be prepared：{path}")
 
 
 def build_output_paths_from_video(video_path):
@@ -53,241 +75,246 @@ def build_output_paths_from_video(video_path):
     return output_paths
 
 def find_all_avi_files(base_dir):
+    # segments still being recorded are not in any segments.json yet; skip them
+    # so inference can run on finished segments while step1 keeps recording
+    finished = finished_segment_files(base_dir)
     avi_files = []
     for root, dirs, files in os.walk(base_dir):
         for file in files:
             if file.endswith(".avi"):
+                if is_segment_file(file) and file not in finished:
+                    print(f"⏳ segment still recording, skipped: {file}")
+                    continue
                 full_path = os.path.join(root, file)
                 avi_files.append(full_path)
     return avi_files
 
-video_paths_list = find_all_avi_files(base_video_dir)
-print(f"✅ find {len(video_paths_list)} videos：")
+def inference_outputs(video_path):
+    output_file_name = os.path.splitext(os.path.basename(video_path))[0]
+    json_dst = os.path.join(json_dir, f"AlphaPose_{output_file_name}.json")
+    skeleton_dst = os.path.join(skeleton_video_dir, f"AlphaPose_{output_file_name}.avi") if save_skeleton_video else None
+    return json_dst, skeleton_dst
+
+def file_param(manifest, path):
+    # model files are identified by content when they are on this machine
+    return manifest.file_hash(path) if os.path.isfile(path) else path
+
+
+def pose_params(manifest):
+    return {
+        "mode": inference_mode,
+        "backend": pose_backend_name,
+        "config": file_param(manifest, config_path),
+        "checkpoint": file_param(manifest, checkpoint_path),
+        "save_skeleton_video": save_skeleton_video,
+    }
+
 
 # --- Run AlphaPose on each video ---
-for video_path in video_paths_list:
-    output_file_name = os.path.splitext(os.path.basename(video_path))[0]
-    output_json_path = os.path.join(json_dir, f"AlphaPose_{output_file_name}")
-
-    command = [
-        "python", os.path.join(alphapose_dir, "scripts", "demo_inference.py"),
-        "--video", video_path,
-        "--outdir", output_json_path,
-        "--checkpoint", checkpoint_path,
-        "--cfg", config_path,
-        "--save_video",
-        "--vis_fast",
-        "--gpus", "0"
-    ]
-
-    try:
-        print(f"\n🚀 Running AlphaPose on: {video_path}")
-        subprocess.run(command, check=True)
-
-        if os.path.exists(output_json_path):
-            print(f"✅ JSON folder created: {output_json_path}")
+def run_pose_inference(manifest):
+    video_paths_list = find_all_avi_files(base_video_dir)
+    print(f"✅ find {len(video_paths_list)} videos：")
+
+    inference_params = pose_params(manifest)
+    pending_videos = []
+    for video_path in video_paths_list:
+        outputs = [p for p in inference_outputs(video_path) if p]
+        if not force_rerun and manifest.is_fresh(f"pose:{video_path}", [video_path], inference_params, outputs):
+            print(f"⏭ up to date, skipped: {video_path}")
+            continue
+        pending_videos.append(video_path)
+    print(f"🔁 {len(pending_videos)} videos need pose inference")
+    failed_videos = set()
+
+    def on_inference_done(job):
+        if job.error:
+            failed_videos.add(job.video_path)
+            print(f"❌ AlphaPose error on {job.video_path}: {job.error}")
         else:
-            print(f"⚠️ JSON result folder not found for: {output_json_path}")
-    except subprocess.CalledProcessError as e:
-        print(f"❌ AlphaPose error on {video_path}: {e}")
-        continue
+            print(f"✅ JSON created: {job.json_path} ({len(job.results)} frames)")
+
+    if inference_mode == "service":
+        # the service writes JSON and skeleton videos straight to their final
+        # folders, so the tidy step has nothing left to move
+        backend = make_backend(pose_backend_name, alphapose_dir=alphapose_dir, config_path=config_path,
+                               checkpoint_path=checkpoint_path, gpus="0")
+        print(f"\n🚀 Loading {backend.name} pose backend once for {len(pending_videos)} videos")
+        service = InferenceService(backend, batch_size=inference_batch_size, on_job_done=on_inference_done).start()
+        for video_path in pending_videos:
+            json_dst, skeleton_dst = inference_outputs(video_path)
+            service.submit(video_path, json_dst, skeleton_dst)
+        service.close()
+    else:
+        for video_path in pending_videos:
+            output_file_name = os.path.splitext(os.path.basename(video_path))[0]
+            output_json_path = os.path.join(json_dir, f"AlphaPose_{output_file_name}")
+
+            command = [
+                "python", os.path.join(alphapose_dir, "scripts", "demo_inference.py"),
+                "--video", video_path,
+                "--outdir", output_json_path,
+                "--checkpoint", checkpoint_path,
+                "--cfg", config_path,
+                "--save_video",
+                "--vis_fast",
+                "--gpus", "0"
+            ]
+
+            try:
+                print(f"\n🚀 Running AlphaPose on: {video_path}")
+                subprocess.run(command, check=True)
+
+                if os.path.exists(output_json_path):
+                    print(f"✅ JSON folder created: {output_json_path}")
+                else:
+                    print(f"⚠️ JSON result folder not found for: {output_json_path}")
+            except subprocess.CalledProcessError as e:
+                failed_videos.add(video_path)
+                print(f"❌ AlphaPose error on {video_path}: {e}")
+                continue
+
+    return pending_videos, failed_videos, inference_params
 
 
 """
 moving the videos and json files to the designated folders
 and delete the original folders
 """
+def tidy_output_folders():
+    print("\n📦 tidy the output folders...")
+    failed_folders = []
 
-
-# --- 初始化資料夾結構 ---
-output_dirs = {
-    "videos": base_video_dir,
-    "skeleton": skeleton_video_dir,
-    "json": json_dir,
-    "csv": csv_dir,
-    "h5": h5_dir
-}
-
-for name, path in output_dirs.items():
-    os.makedirs(path, exist_ok=True)
-    print(f"📁 {name} all folders have be prepared：{path}")
-
-print("\n📦 tidy the output folders...")
-failed_folders = []
-
-for folder_name in os.listdir(json_dir):
-    folder_path = os.path.join(json_dir, folder_name)
-    if not os.path.isdir(folder_path):
-        continue
-
-    print(f"\n🔍 process the folder：{folder_path}")
-    base_name = folder_name.replace("AlphaPose_output_", "")
-    json_src = os.path.join(folder_path, "alphapose-results.json")
-    json_dst = os.path.join(json_dir, f"AlphaPose_output_{base_name}.json")
-
-    # 預期的 avi 檔名
-    expected_avi = os.path.join(folder_path, f"{folder_name}.avi")
-    avi_dst = os.path.join(skeleton_video_dir, f"AlphaPose_output_{base_name}.avi")
-
-    # 檢查 avi 存在與否,若找不到就 fallback 掃描所有 avi
-    avi_src = None
-    if os.path.exists(expected_avi):
-        avi_src = expected_avi
-        print(f"✅ find the expected avi：{avi_src}")
-    else:
-        print(f"⚠️ cannot find the expected avi：{expected_avi}, searching the folder...")
-        for f in os.listdir(folder_path):
-            if f.lower().endswith(".avi"):
-                avi_src = os.path.join(folder_path, f)
-                print(f"🔁 find other avi：{avi_src}")
-                break
-
-    try:
-        if avi_src and os.path.exists(avi_src) and os.path.getsize(avi_src) > 0:
-            os.rename(avi_src, avi_dst)
-            print(f"🎥 move avi to：{avi_dst}")
-        else:
-            print(f"⚠️ connot process avi：{avi_src}（does not exist）")
-
-        if os.path.exists(json_src):
-            os.rename(json_src, json_dst)
-            print(f"📄 move JSON to：{json_dst}")
-        else:
-            print(f"⚠️ connot find JSON：{json_src}")
-
-        time.sleep(0.5)
-        shutil.rmtree(folder_path)
-        print(f"🧹 delete the folder：{folder_path}")
-
-    except Exception as e:
-        print(f"❌ connot process：{folder_path},error：{e}")
-        failed_folders.append(folder_path)
-
-
-
-
-
-
-
-"""
-transform json to csv
-"""
-coco_keypoints = [
-    "Nose", "LEye", "REye", "LEar", "REar",
-    "LShoulder", "RShoulder", "LElbow", "RElbow",
-    "LWrist", "RWrist", "LHip", "RHip",
-    "LKnee", "RKnee", "LAnkle", "RAnkle"
-]
-
-# --- Apply Butterworth Filter ---
-def butterworth_filter(data, cutoff=3, fs=30, order=2):
-    if len(data) < order * 3:
-        return data
-    nyq = 0.5 * fs
-    norm_cutoff = cutoff / nyq
-    b, a = butter(order, norm_cutoff, btype='low', analog=False)
-    return filtfilt(b, a, data)
-
-# --- 轉換所有 JSON 檔為 CSV ---
-print("\n📄 start transform JSON to CSV...")
-
-for file in os.listdir(json_dir):
-    if not file.endswith(".json"):
-        continue
-
-    json_path = os.path.join(json_dir, file)
-    csv_path = os.path.join(csv_dir, file.replace(".json", ".csv"))
-    print(f"\n🔍 process file：{json_path}")
-
-    try:
-        with open(json_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-        if not data:
-            print(f"⚠️ empty JSON：{json_path}")
+    for folder_name in os.listdir(json_dir):
+        folder_path = os.path.join(json_dir, folder_name)
+        if not os.path.isdir(folder_path):
             continue
 
-        # 建立一個 dict：key 為 joint 名,值為 (x序列, y序列)
-        keypoint_series = {kp: {"x": [], "y": []} for kp in coco_keypoints}
-
-        for item in data:
-            kp_list = item["keypoints"]
-            for i, kp in enumerate(coco_keypoints):
-                x = kp_list[i * 3]
-                y = kp_list[i * 3 + 1]
-                keypoint_series[kp]["x"].append(x)
-                keypoint_series[kp]["y"].append(y)
-
-        # 濾波處理後建立 dataframe
-        filtered_data = {}
-        for kp in coco_keypoints:
-            filtered_x = butterworth_filter(keypoint_series[kp]["x"])
-            filtered_y = butterworth_filter(keypoint_series[kp]["y"])
-            filtered_data[f"{kp}_x"] = filtered_x
-            filtered_data[f"{kp}_y"] = filtered_y
-
-        df = pd.DataFrame(filtered_data)
-        df.to_csv(csv_path, index=False, encoding="utf-8-sig")
-        print(f"✅ have output CSV：{csv_path}")
-
-    except Exception as e:
-        print(f"❌ process fail：{json_path}, error：{e}")
+        print(f"\n🔍 process the folder：{folder_path}")
+        base_name = folder_name.replace("AlphaPose_output_", "")
+        json_src = os.path.join(folder_path, "alphapose-results.json")
+        json_dst = os.path.join(json_dir, f"AlphaPose_output_{base_name}.json")
 
+        # 預期的 avi 檔名
+        expected_avi = os.path.join(folder_path, f"{folder_name}.avi")
+        avi_dst = os.path.join(skeleton_video_dir, f"AlphaPose_output_{base_name}.avi")
 
+        # 檢查 avi 存在與否,若找不到就 fallback 掃描所有 avi
+        avi_src = None
+        if os.path.exists(expected_avi):
+            avi_src = expected_avi
+            print(f"✅ find the expected avi：{avi_src}")
+        else:
+            print(f"⚠️ cannot find the expected avi：{expected_avi}, searching the folder...")
+            for f in os.listdir(folder_path):
+                if f.lower().endswith(".avi"):
+                    avi_src = os.path.join(folder_path, f)
+                    print(f"🔁 find other avi：{avi_src}")
+                    break
+
+        try:
+            if avi_src and os.path.exists(avi_src) and os.path.getsize(avi_src) > 0:
+                os.rename(avi_src, avi_dst)
+                print(f"🎥 move avi to：{avi_dst}")
+            else:
+                print(f"⚠️ connot process avi：{avi_src}（does not exist）")
+
+            if os.path.exists(json_src):
+                os.rename(json_src, json_dst)
+                print(f"📄 move JSON to：{json_dst}")
+            else:
+                print(f"⚠️ connot find JSON：{json_src}")
+
+            time.sleep(0.5)
+            shutil.rmtree(folder_path)
+            print(f"🧹 delete the folder：{folder_path}")
+
+        except Exception as e:
+            print(f"❌ connot process：{folder_path},error：{e}")
+            failed_folders.append(folder_path)
+    return failed_folders
+
+
+def record_inference(manifest, pending_videos, failed_videos, inference_params):
+    # record the videos whose outputs are now in their final folders
+    for video_path in pending_videos:
+        outputs = [p for p in inference_outputs(video_path) if p]
+        if video_path not in failed_videos and all(os.path.exists(p) for p in outputs):
+            manifest.record(f"pose:{video_path}", [video_path], inference_params, outputs)
+    manifest.save()
 
 
 """
-transform json to h5
+transform json to csv and h5
 """
-print("\n📁 start transform JSON to HDF5...")
-
-# 定義 COCO keypoints 順序與 HDF5 MultiIndex 結構
-
-scorer = "AlphaPose"
-coords = ["x", "y", "likelihood"]
-multi_index = pd.MultiIndex.from_product([[scorer], coco_keypoints, coords], names=["scorer", "bodyparts", "coords"])
+def conversion_targets(json_file):
+    return {
+        "csv": os.path.join(csv_dir, json_file.replace(".json", ".csv")),
+        "h5": os.path.join(h5_dir, json_file.replace(".json", "_filtered.h5")),
+        "store": store_path_for(store_dir, json_file),
+    }
 
 
+def conversion_params():
+    return {"cutoff": filter_cutoff, "fs": filter_fs, "order": filter_order, "max_gap": filter_max_gap,
+            "selection": detection_selection}
 
-# 處理每個 JSON 檔案
-for json_file in os.listdir(json_dir):
-    if not json_file.endswith(".json"):
-        continue
 
-    json_path = os.path.join(json_dir, json_file)
-    h5_output_path = os.path.join(h5_dir, json_file.replace(".json", "_filtered.h5"))
+def sidecar_path(ts_index, json_file):
+    # the timestamp sidecar holds one entry per video frame, so outputs keep
+    # exactly one row per recorded frame (and the store keeps the timestamps)
+    return ts_index.get(video_base_from_pose_file(json_file))
 
-    print(f"\n🔍 process file：{json_path}")
 
-    try:
-        with open(json_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+def convert_json_outputs(manifest):
+    print(f"\n📄 start transform JSON to {' / '.join(fmt.upper() for fmt in output_formats)}...")
+    filter_params = conversion_params()
+    ts_index = index_timestamp_files(base_video_dir)
 
-        if not data:
-            print(f"⚠️ empty JSON：{json_path}")
+    # only the formats whose output is missing or stale are rebuilt
+    jobs = []
+    inputs = {}
+    for json_file in sorted(os.listdir(json_dir)):
+        if not json_file.endswith(".json"):
             continue
-
-        keypoints_list = [entry["keypoints"] for entry in data]
-        num_joints = len(coco_keypoints)
-
-        # 基本驗證
-        assert len(keypoints_list[0]) == num_joints * 3, f"❌ wrong JSON structure ：{json_file}"
-
-        # 建立 DataFrame（MultiIndex）
-        df = pd.DataFrame(keypoints_list, columns=multi_index)
-
-        # 套用濾波
-        for kp in coco_keypoints:
-            for axis in ["x", "y"]:
-                df[(scorer, kp, axis)] = butterworth_filter(df[(scorer, kp, axis)])
-
-        # 寫入 HDF5
-        df.to_hdf(h5_output_path, key="df_with_missing", mode="w")
-        print(f"✅ have saved HDF5：{h5_output_path}")
-
-    except Exception as e:
-        print(f"❌ transform fail ：{json_path},error：{e}")
-
-print("\n🎉 all JSON files have transform to HDF5！")
-
-
+        json_path = os.path.join(json_dir, json_file)
+        targets = conversion_targets(json_file)
+        ts_path = sidecar_path(ts_index, json_file)
+        inputs[json_path] = [json_path] + ([ts_path] if ts_path else [])
+        outputs = {}
+        for fmt in output_formats:
+            if force_rerun or not manifest.is_fresh(f"{fmt}:{json_path}", inputs[json_path], filter_params,
+                                                    [targets[fmt]]):
+                outputs[fmt] = targets[fmt]
+        if outputs:
+            jobs.append((json_path, outputs, None, ts_path))
+    print(f"🔁 {len(jobs)} JSON files need conversion")
+
+    failed = []
+    for json_path, outputs, error in convert_many(jobs, workers=conversion_workers, cutoff=filter_cutoff,
+                                                  fs=filter_fs, order=filter_order, max_gap=filter_max_gap,
+                                                  selection=detection_selection):
+        if error:
+            print(f"❌ transform fail：{json_path}, error：{error}")
+            failed.append(json_path)
+            continue
+        for fmt, path in outputs.items():
+            manifest.record(f"{fmt}:{json_path}", inputs[json_path], filter_params, [path])
+            print(f"✅ have saved {fmt.upper()}：{path}")
+    manifest.save()
+    return failed
+
+
+if __name__ == "__main__":
+    print("opencv_version", cv2.__version__)
+
+    # Set AlphaPose directory as working directory
+    os.chdir(alphapose_dir)
+    sys.path.append(alphapose_dir)
+    prepare_output_dirs()
+
+    manifest = RunManifest(manifest_path)
+    pending_videos, failed_videos, inference_params = run_pose_inference(manifest)
+    tidy_output_folders()
+    record_inference(manifest, pending_videos, failed_videos, inference_params)
+    convert_json_outputs(manifest)
+    print("\n🎉 all JSON files have been converted！")
@@ -1,108 +1,420 @@
 import os
 import re
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
-import pandas as pd
 from collections import defaultdict
-from scipy.signal import butter, filtfilt
 from aniposelib.cameras import CameraGroup
-from aniposelib.utils import load_pose2d_fnames
+from frame_sync import (index_timestamp_files, video_base_from_pose_file, read_timestamps,
+                        build_sync_index, apply_sync_index, interpolate_to_timestamps, summarize_sync)
+from keypoint_io import open_pose_file, STORE_SUFFIX
+from quality_report import TrialQuality, REPORT_SUFFIX, write_report, write_dataset_table
+from run_manifest import RunManifest
+from signal_filter import ChunkedLowpass
+from triangulation import load_calibration, triangulate_dlt, triangulate_ransac, camera_errors, mean_view_error
+from trial_io import trial_dir_for, TrialWriter, append_csv, HEADER_FILE
 
 # --- SETTINGS ---
+pose_input = 'store'        # 'store': step2_2's session keypoint store in store_folder, 'h5': legacy pandas H5 files in h5_folder
+store_folder = r"C:\Users\USER\OneDrive\Desktop_20250211_after_reset\github_repository\3d_motion_capture_system\joints_store"
 h5_folder = r"C:\Users\USER\OneDrive\Desktop_20250211_after_reset\github_repository\3d_motion_capture_system\joints_h5_files"
 calibration_file = 'calibration.toml'
 output_folder = 'output_3d_data'
 score_threshold = 0.5
+triangulation_engine = 'dlt'   # 'dlt': batched solve in triangulation.py, 'ransac': dlt on the best camera subset, 'aniposelib': cgroup.triangulate
+weight_views_by_score = True   # dlt/ransac: each view counts in proportion to its 2D likelihood
+ransac_threshold_px = 15       # ransac: every view of the kept subset must reproject within this many pixels
+video_folder = r"C:\Users\USER\OneDrive\Desktop_20250211_after_reset\github_repository\3d_motion_capture_system\recorded_videos"
+sync_mode = 'nearest'       # 'nearest', 'interpolate' or 'none' (frame i of every camera is the same instant)
+sync_tolerance_ms = 17      # max timestamp offset accepted when matching frames across cameras
+filter_cutoff = 3
+filter_fs = 30
+filter_order = 4
+filter_padlen = 10
+filter_max_gap = 0          # missing frames bridged by linear interpolation before filtering (0 = off)
+manifest_path = os.path.join(output_folder, 'step3_manifest.json')
+output_formats = ['npy', 'csv']  # 'npy': memory-mappable trial folder, 'csv': the table step4 used to parse
+force_rerun = False         # True rebuilds every group even when inputs and settings are unchanged
+n_workers = 1               # processes triangulating groups in parallel; None = one per CPU core
+stream_chunk_frames = 18000 # frames read, triangulated and written at a time (None = whole trial at once)
 
-# --- FILTER FUNCTION ---
-def butter_lowpass_filter(data, cutoff=3, fs=30, order=4):
-    nyquist = 0.5 * fs
-    normal_cutoff = cutoff / nyquist
-    b, a = butter(order, normal_cutoff, btype='low', analog=False)
-    return filtfilt(b, a, data, axis=0, padlen=10)
-
-# --- GROUPING H5 FILES ---
-def group_h5_files(h5_dir):
-    pattern = re.compile(
-        r'AlphaPose_output_(person_\d+)_(.+?)_(cam\d)_\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}(?:_filtered)?\.h5'
-    )
-
-    cam_mapping = {
-        'cam1': 'A',
-        'cam2': 'B',
-        'cam3': 'C'
-    }
+# --- GROUPING POSE FILES ---
+H5_NAME_PATTERN = re.compile(
+    r'AlphaPose_output_(person_\d+)_(.+?)_(cam\d)_\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}(?:_seg(\d+))?(?:_filtered)?\.h5'
+)
+STORE_SESSION_PATTERN = re.compile(r'(person_\d+)_(.+?)_\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}$')
+STORE_CAMERA_PATTERN = re.compile(r'(cam\d)(?:_seg(\d+))?\.h5$')
+CAM_MAPPING = {
+    'cam1': 'A',
+    'cam2': 'B',
+    'cam3': 'C'
+}
+
+def parse_h5_name(fname):
+    # ((person, movement, segment), camera name, camera key); None parts
+    # when the name does not match or the camera is unknown
+    match = H5_NAME_PATTERN.match(fname)
+    if not match:
+        return None, None, None
+    pid, movement, cam_key, segment = match.groups()
+    return (pid, movement, segment), CAM_MAPPING.get(cam_key), cam_key
+
+def parse_store_path(path):
+    # <store>/person_001_walk_<time>/cam1_seg000.h5 -> same parts as parse_h5_name
+    session = STORE_SESSION_PATTERN.match(os.path.basename(os.path.dirname(path)))
+    camera = STORE_CAMERA_PATTERN.match(os.path.basename(path))
+    if not session or not camera:
+        return None, None, None
+    pid, movement = session.groups()
+    cam_key, segment = camera.groups()
+    return (pid, movement, segment), CAM_MAPPING.get(cam_key), cam_key
+
+def parse_pose_path(path):
+    if pose_input == 'store':
+        return parse_store_path(path)
+    return parse_h5_name(os.path.basename(path))
+
+def pose_files():
+    # every 2D pose file of the configured input
+    if pose_input == 'store':
+        return [os.path.join(root, fname) for root, dirs, files in os.walk(store_folder)
+                for fname in sorted(files) if fname.endswith(STORE_SUFFIX)]
+    return [os.path.join(h5_folder, fname) for fname in sorted(os.listdir(h5_folder))]
 
+def group_pose_files(paths):
     groups = defaultdict(dict)
 
-    for fname in os.listdir(h5_dir):
-        match = pattern.match(fname)
-        if match:
-            pid, movement, cam_key = match.groups()
-            cam_name = cam_mapping.get(cam_key)
+    for path in paths:
+        key, cam_name, cam_key = parse_pose_path(path)
+        if key:
             if cam_name:
-                key = (pid, movement)
-                groups[key][cam_name] = os.path.join(h5_dir, fname)
+                # rolling recordings are triangulated segment by segment
+                groups[key][cam_name] = path
             else:
-                print(f"[!] Unknown camera key '{cam_key}' in filename: {fname}")
+                print(f"[!] Unknown camera key '{cam_key}' in filename: {path}")
         else:
-            print(f"[!] Filename doesn't match pattern: {fname}")
+            print(f"[!] Filename doesn't match pattern: {path}")
     return groups
 
+def group_name(person, movement, segment):
+    seg_tag = f"_seg{segment}" if segment else ""
+    return f"{person}_{movement}{seg_tag}"
+
+# --- TIMESTAMP ALIGNMENT ---
+def open_pose_source(fname_dict, cam_names, ts_index):
+    # one reader per camera plus the plan tying output rows to camera
+    # frames: row i is frame i of every camera (sync None) or the sync index
+    readers = [open_pose_file(fname_dict[name]) for name in cam_names]
+    source = {
+        'readers': readers,
+        'bodyparts': readers[0].bodyparts,
+        'n_rows': min(r.n_frames for r in readers),
+        'sync': None,
+    }
+    # store files carry their camera's timestamps; legacy H5 files use the sidecar
+    ts_paths = [ts_index.get(video_base_from_pose_file(fname_dict[name])) for name in cam_names]
+    timestamps = [r.timestamps if r.timestamps is not None else read_timestamps(p) if p is not None else None
+                  for r, p in zip(readers, ts_paths)]
+    timestamps = [ts for ts in timestamps if ts is not None]
+    if sync_mode == 'none' or len(timestamps) < len(cam_names) or min(len(ts) for ts in timestamps) == 0:
+        if sync_mode != 'none':
+            print("[!] Missing timestamp sidecar, falling back to frame-index alignment")
+        return source
+
+    # every camera keeps all its frames, no view is cut to the shortest one
+    timestamps = [ts[:r.n_frames] for ts, r in zip(timestamps, readers)]
+    sync = build_sync_index(timestamps, sync_tolerance_ms)
+    summarize_sync(sync, cam_names)
+    source.update(sync=sync, n_rows=len(sync['index']), timestamps=timestamps,
+                  periods=[np.median(np.diff(ts)) if len(ts) > 1 else 0 for ts in timestamps])
+    return source
+
+def read_pose_rows(source, start, stop):
+    # (cams, rows, joints, 2) points and (cams, rows, joints) scores of output
+    # rows start:stop; only the camera frames those rows need are read
+    readers, sync = source['readers'], source['sync']
+    if sync is None:
+        reads = [r.read(start, stop) for r in readers]
+        return np.stack([p for p, _ in reads]), np.stack([sc for _, sc in reads])
+
+    if sync_mode == 'interpolate':
+        dst_ts = sync['timestamps'][start:stop]
+        points, scores = [], []
+        for r, ts, period in zip(readers, source['timestamps'], source['periods']):
+            lo, hi = 0, len(ts)
+            if len(ts) > 1:
+                right = np.clip(np.searchsorted(ts, dst_ts), 1, len(ts) - 1)
+                lo, hi = int(right.min()) - 1, int(right.max()) + 1
+            p, sc = r.read(lo, hi)
+            p, sc = interpolate_to_timestamps(p, sc, ts[lo:hi], dst_ts, sync_tolerance_ms, period=period)
+            points.append(p)
+            scores.append(sc)
+        return np.stack(points), np.stack(scores)
+
+    index = sync['index'][start:stop].copy()
+    points, scores = [], []
+    for cam, r in enumerate(readers):
+        rows = index[:, cam]
+        ok = (rows >= 0) & (rows < r.n_frames)
+        lo, hi = (int(rows[ok].min()), int(rows[ok].max()) + 1) if ok.any() else (0, 0)
+        p, sc = r.read(lo, hi)
+        index[:, cam] = np.where(ok, rows - lo, -1)
+        points.append(p)
+        scores.append(sc)
+    return apply_sync_index(points, scores, index)
+
 # --- PROCESS EACH TRIO ---
-def process_group(fname_dict, cgroup, output_csv):
-    d = load_pose2d_fnames(fname_dict, cam_names=cgroup.get_names())
-    n_cams, n_frames, n_joints, _ = d['points'].shape
-    points = d['points']
-    scores = d['scores']
-    bodyparts = d['bodyparts']
+def output_paths(name):
+    return {
+        'npy': trial_dir_for(output_folder, name),
+        'csv': os.path.join(output_folder, f"{name}_3d.csv"),
+        'sync': os.path.join(output_folder, f"{name}_sync.npz"),
+        'quality': os.path.join(output_folder, f"{name}{REPORT_SUFFIX}"),
+    }
+
+def manifest_outputs(paths):
+    outputs = [paths['quality']]
+    if 'npy' in output_formats:
+        outputs.append(os.path.join(paths['npy'], HEADER_FILE))
+    if 'csv' in output_formats:
+        outputs.append(paths['csv'])
+    return outputs
+
+
+def run_params():
+    return {
+        'score_threshold': score_threshold,
+        'triangulation': [triangulation_engine, weight_views_by_score, ransac_threshold_px],
+        'sync_mode': sync_mode,
+        'sync_tolerance_ms': sync_tolerance_ms,
+        'filter': [filter_cutoff, filter_fs, filter_order, filter_padlen, filter_max_gap],
+        'output_formats': output_formats,
+    }
+
+def plan_group(name, fname_dict, ts_index):
+    # (worker task, manifest key, inputs, outputs) of one complete group
+    paths = output_paths(name)
+    # only this group's sidecars travel to the worker
+    group_ts = {b: ts_index[b] for b in map(video_base_from_pose_file, fname_dict.values()) if b in ts_index}
+    inputs = list(fname_dict.values()) + [calibration_file] + list(group_ts.values())
+    return (name, fname_dict, paths, group_ts), f"3d:{name}", inputs, manifest_outputs(paths)
+
+def triangulate_rows(points, scores, cgroup, calib):
+    # (cams, frames, joints, 2) -> unfiltered (frames, joints, 3) points and
+    # the per-point quality arrays stored with the trial
+    n_cams, n_frames, n_joints, _ = points.shape
 
     # Drop low-confidence points
-    points[scores < score_threshold] = np.nan
+    low = scores < score_threshold
+    points[low] = np.nan
+    used_scores = np.where(low | np.isnan(points[..., 0]), np.nan, scores)
 
     points_flat = points.reshape(n_cams, -1, 2)
-    p3ds_flat = cgroup.triangulate(points_flat, progress=False)
-    p3ds = p3ds_flat.reshape(n_frames, n_joints, 3)
+    weights = used_scores.reshape(n_cams, -1) if weight_views_by_score else None
+    if triangulation_engine == 'ransac':
+        p3ds_flat, reproj_error, views_used = triangulate_ransac(calib, points_flat, weights,
+                                                                 threshold_px=ransac_threshold_px)
+    elif triangulation_engine == 'dlt':
+        p3ds_flat = triangulate_dlt(calib, points_flat, weights)
+    else:
+        p3ds_flat = cgroup.triangulate(points_flat, progress=False)
+    # every camera's pixel error, including views ransac left out
+    camera_error = camera_errors(calib, p3ds_flat, points_flat)
+    if triangulation_engine != 'ransac':
+        reproj_error = mean_view_error(camera_error)
+        # every view with a usable 2D point, as a bitmask (bit c = camera c)
+        views_used = np.zeros(points_flat.shape[1], dtype=np.uint8)
+        for c in range(n_cams):
+            views_used |= (~np.isnan(points_flat[c, :, 0])).astype(np.uint8) << c
+    views_used = views_used.reshape(n_frames, n_joints)
+
+    # views and scores of the cameras that went into each 3D point
+    in_use = (views_used[None] >> np.arange(n_cams)[:, None, None]) & 1 == 1
+    used_scores = np.where(in_use, used_scores, np.nan)
+    n_views = np.sum(in_use, axis=0)
+    with np.errstate(invalid='ignore'):
+        mean_scores = np.nansum(used_scores, axis=0) / n_views
+
+    quality = {
+        'reproj_error': reproj_error.reshape(n_frames, n_joints),
+        'scores': mean_scores,
+        'n_views': n_views.astype(np.int8),
+        'views_used': views_used,
+        'camera_error': camera_error.reshape(n_cams, n_frames, n_joints).transpose(1, 2, 0).astype(np.float32),
+    }
+    return p3ds_flat.reshape(n_frames, n_joints, 3), quality
+
+def process_group(name, fname_dict, cgroup, calib, paths, ts_index=None):
+    source = open_pose_source(fname_dict, cgroup.get_names(), ts_index or {})
+    try:
+        stream_group(name, source, fname_dict, cgroup, calib, paths)
+    finally:
+        for reader in source['readers']:
+            reader.close()
+
+def stream_group(name, source, fname_dict, cgroup, calib, paths):
+    # Chunk by chunk: read the 2D rows, triangulate, and write the quality
+    # arrays at once; the Butterworth filter holds back the end of each chunk
+    # until the next one arrives, so the stored points match filtering the
+    # whole trial and memory does not grow with the trial's length
+    n_rows, bodyparts, sync = source['n_rows'], source['bodyparts'], source['sync']
+    if n_rows == 0:
+        raise ValueError("no frames to triangulate")
+    n_joints, cam_names = len(bodyparts), list(cgroup.get_names())
+    chunk_frames = stream_chunk_frames or n_rows
+    smoother = ChunkedLowpass(cutoff=filter_cutoff, fs=filter_fs, order=filter_order,
+                              padlen=filter_padlen, max_gap=filter_max_gap)
+    writer = None
+    if 'npy' in output_formats:
+        writer = TrialWriter(paths['npy'], n_rows, bodyparts, {
+            'points': ((n_joints, 3), np.float64),
+            'reproj_error': ((n_joints,), np.float64),
+            'scores': ((n_joints,), np.float64),
+            'n_views': ((n_joints,), np.int8),
+            'views_used': ((n_joints,), np.uint8),
+            'camera_error': ((n_joints, len(cam_names)), np.float32),
+        })
+    tracker = TrialQuality(bodyparts, cam_names)
+
+    written = 0
+    for start in range(0, n_rows, chunk_frames):
+        stop = min(start + chunk_frames, n_rows)
+        points, scores = read_pose_rows(source, start, stop)
+        p3ds, quality = triangulate_rows(points, scores, cgroup, calib)
+        tracker.add(p3ds, quality['reproj_error'], quality['camera_error'], quality['n_views'])
+        p3ds = smoother.push(p3ds, final=stop == n_rows)
+        if writer is not None:
+            writer.write(start, **quality)
+            writer.write(written, points=p3ds)
+        if 'csv' in output_formats and len(p3ds):
+            append_csv(p3ds, bodyparts, paths['csv'], written)
+        written += len(p3ds)
 
-    columns = ["Frame"] + [f"{bp}_{axis}" for bp in bodyparts for axis in ["X", "Y", "Z"]]
-    data = []
-    for frame in range(n_frames):
-        row = [frame]
-        for joint in range(n_joints):
-            row.extend(p3ds[frame, joint, :])
-        data.append(row)
+    if writer is not None:
+        fps = None
+        if sync is not None and len(sync['timestamps']) > 1:
+            fps = float(1e9 / np.median(np.diff(sync['timestamps'])))
+        writer.close(fps=fps, extra={'cameras': cam_names, 'sources': dict(fname_dict)})
+        print(f"[✓] Saved 3D trial: {paths['npy']}")
+    if 'csv' in output_formats:
+        print(f"[✓] Saved 3D CSV: {paths['csv']}")
 
-    df = pd.DataFrame(data, columns=columns)
+    if sync is not None:
+        np.savez(paths['sync'], **sync)
+        print(f"[✓] Saved sync index: {paths['sync']}")
 
-    # Apply Butterworth filter
-    for col in df.columns[1:]:
-        valid_idx = ~df[col].isna()
-        if valid_idx.sum() > 5:
-            df.loc[valid_idx, col] = butter_lowpass_filter(df.loc[valid_idx, col].values)
+    report = tracker.summary(name)
+    write_report(paths['quality'], report)
+    print(f"[✓] Quality: median {report['median_error_px']} px, p95 {report['p95_error_px']} px, "
+          f"{report['nan_fraction']:.1%} NaN joints, {report['mean_views']:.2f} views"
+          + (f", flagged: {', '.join(report['flags'])}" if report['flags'] else ""))
 
-    df.to_csv(output_csv, index=False)
-    print(f"[✓] Saved 3D CSV: {output_csv}")
+# --- WORKERS ---
+# each worker process loads the calibration once and then takes groups from
+# the pool's queue; the sequential mode runs the same code in this process
+worker_cgroup = None
+worker_calib = None
+
+def init_worker(calib_path):
+    global worker_cgroup, worker_calib
+    worker_cgroup = CameraGroup.load(calib_path)
+    worker_calib = load_calibration(calib_path)
+
+def run_group(task):
+    # failures are returned instead of raised so one bad trial does not stop the batch
+    name, fname_dict, paths, ts_index = task
+    t0 = time.perf_counter()
+    try:
+        process_group(name, fname_dict, worker_cgroup, worker_calib, paths, ts_index)
+        return name, None, time.perf_counter() - t0
+    except Exception as e:
+        where = traceback.extract_tb(e.__traceback__)[-1]
+        message = (str(e).strip().splitlines() or [""])[-1]
+        error = f"{type(e).__name__}: {message} ({os.path.basename(where.filename)}:{where.lineno})"
+        return name, error, time.perf_counter() - t0
+
+def run_groups(tasks, workers):
+    # yields run_group results as groups finish
+    if workers == 1 or len(tasks) <= 1:
+        init_worker(calibration_file)
+        for task in tasks:
+            yield run_group(task)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=init_worker,
+                             initargs=(calibration_file,)) as pool:
+        futures = {pool.submit(run_group, task): task[0] for task in tasks}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                # the worker itself died (e.g. out of memory)
+                yield futures[future], f"{type(e).__name__}: {e}", 0.0
 
 # --- MAIN PIPELINE ---
 if __name__ == "__main__":
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    print("📡 Loading camera calibration...")
-    cgroup = CameraGroup.load(calibration_file)
+    print(f"🔍 Scanning for valid {pose_input} groups...")
+    groups = group_pose_files(pose_files())
 
-    print("🔍 Scanning for valid H5 groups...")
-    groups = group_h5_files(h5_folder)
+    ts_index = {}
+    if sync_mode != 'none' and os.path.isdir(video_folder):
+        ts_index = index_timestamp_files(video_folder)
+        print(f"⏱ Found {len(ts_index)} timestamp sidecars.")
 
     print(f"📦 Found {len(groups)} subject-movement pairs.\n")
 
-    for (person, movement), cams in groups.items():
+    manifest = RunManifest(manifest_path)
+    params = run_params()
+
+    tasks = []
+    records = {}
+    skipped = []
+    incomplete = []
+    for (person, movement, segment), cams in groups.items():
+        name = group_name(person, movement, segment)
         if all(k in cams for k in ['A', 'B', 'C']):
             fname_dict = {
                 'A': cams['A'],
                 'B': cams['B'],
                 'C': cams['C'],
             }
-            output_csv = os.path.join(output_folder, f"{person}_{movement}_3d.csv")
-            process_group(fname_dict, cgroup, output_csv)
+            task, key, inputs, outputs = plan_group(name, fname_dict, ts_index)
+            if not force_rerun and manifest.is_fresh(key, inputs, params, outputs):
+                skipped.append(name)
+                continue
+            tasks.append(task)
+            records[name] = (key, inputs, outputs)
         else:
-            print(f"[!] Skipping {person}-{movement}: missing some camera views (found {list(cams.keys())})")
+            incomplete.append(name)
+            print(f"[!] Skipping {person}-{movement}{'-seg' + segment if segment else ''}: missing some camera views (found {list(cams.keys())})")
+
+    workers = n_workers or os.cpu_count() or 1
+    print(f"[⏭] {len(skipped)} groups up to date, 🚀 triangulating {len(tasks)} groups with {min(workers, max(len(tasks), 1))} worker(s)...")
+
+    failed = {}
+    t_start = time.perf_counter()
+    for done, (name, error, seconds) in enumerate(run_groups(tasks, workers), start=1):
+        if error:
+            failed[name] = error
+            print(f"[{done}/{len(tasks)}] ❌ {name} failed after {seconds:.1f}s: {error}")
+            continue
+        key, inputs, outputs = records[name]
+        manifest.record(key, inputs, params, outputs)
+        manifest.save()
+        print(f"[{done}/{len(tasks)}] ✅ {name} ({seconds:.1f}s)")
+
+    print(f"\n📊 step3 finished in {time.perf_counter() - t_start:.1f}s: "
+          f"{len(tasks) - len(failed)} done, {len(skipped)} up to date, {len(failed)} failed, "
+          f"{len(incomplete)} missing views")
+    for name, error in sorted(failed.items()):
+        print(f"   ❌ {name}: {error}")
+
+    # every trial's report, including groups skipped as up to date
+    table_path, table = write_dataset_table(output_folder)
+    flagged = table[table['flags'] != ''] if len(table) else table
+    print(f"🩺 Quality table for {len(table)} trials: {table_path} ({len(flagged)} flagged)")
+    for _, row in flagged.head(10).iterrows():
+        print(f"   ⚠️ {row['trial']}: {row['flags']}")
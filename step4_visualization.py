@@ -1,67 +1,113 @@
 import os
-import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
+from pose_backend import COCO_BONES, COCO_KEYPOINTS
+from trial_io import find_trials, load_points
 
 # --- SETTINGS ---
 csv_dir = 'output_3d_data'
 X_LIMITS = [-3000, 3000]
 Y_LIMITS = [-3000, 3000]
 Z_LIMITS = [-1000, 5000]
+FPS = 30                # recording rate; playback runs at real time whatever the decimation
+decimate = 1            # animate every n-th frame
+max_frames = 1800       # level of detail: longer trials are decimated further to at most this many frames
+show_bones = True       # skeleton lines between COCO joints
+html_dir = None         # e.g. 'output_3d_html': write one self-contained HTML per trial instead of opening a browser
+serve_session = False   # True: browse all trials in the local streaming viewer (playback_server.py) instead
+MARKER_SIZE = 4
+BONE_WIDTH = 4
 
-# --- LOOP THROUGH ALL CSV FILES ---
-csv_files = [f for f in os.listdir(csv_dir) if f.endswith('.csv')]
-csv_files.sort()
+# --- FIGURE ---
+def frame_stride(n_frames, decimate=1, max_frames=None):
+    # every n-th frame is animated; long trials get a coarser stride so the
+    # figure never holds more than max_frames frames
+    stride = max(int(decimate), 1)
+    if max_frames:
+        stride = max(stride, -(-n_frames // int(max_frames)))
+    return stride
 
-for file_name in csv_files:
-    file_path = os.path.join(csv_dir, file_name)
-    print(f"\n📈 Visualizing: {file_name}")
 
-    # Load CSV
-    df = pd.read_csv(file_path)
+def bone_pairs(joint_names):
+    # COCO bones as index pairs into joint_names; bones whose joints are
+    # missing are skipped
+    index = {name: i for i, name in enumerate(joint_names)}
+    return [(index[COCO_KEYPOINTS[a]], index[COCO_KEYPOINTS[b]]) for a, b in COCO_BONES
+            if COCO_KEYPOINTS[a] in index and COCO_KEYPOINTS[b] in index]
 
-    # Frame and joint parsing
-    frames = df['Frame'].values
-    keypoints = [col for col in df.columns if col != 'Frame']
-    num_joints = len(keypoints) // 3
-    joint_names = [keypoints[i * 3].split('_')[0] for i in range(num_joints)]
+
+def bone_paths(bones):
+    # bones joined into polylines (ankle-knee-hip-hip-knee-ankle, ...), so a
+    # joint shared by two bones of a line is sent once
+    unused = list(bones)
+    paths = []
+    while unused:
+        path = list(unused.pop(0))
+        extended = True
+        while extended:
+            extended = False
+            for k, (a, b) in enumerate(unused):
+                if a == path[-1] or b == path[-1]:
+                    path.append(b if a == path[-1] else a)
+                elif a == path[0] or b == path[0]:
+                    path.insert(0, b if a == path[0] else a)
+                else:
+                    continue
+                unused.pop(k)
+                extended = True
+                break
+        paths.append(path)
+    return paths
+
+
+def bone_order(bones):
+    # joint index of every line vertex, the bone polylines one after the
+    # other with -1 where the line breaks
+    order = []
+    for path in bone_paths(bones):
+        order += path + [-1]
+    return order[:-1]
+
+
+def bone_lines(points, bones):
+    # (frames, joints, 3) -> (frames, vertices, 3), NaN rows at the breaks
+    order = np.asarray(bone_order(bones), dtype=np.intp)
+    lines = points[:, order]
+    lines[:, order < 0] = np.nan
+    return lines
+
+
+def build_figure(points, joint_names, title, decimate=1, max_frames=None, show_bones=True, fps=FPS):
+    # animated 3D view of a (frames, joints, 3) array: one marker trace and one
+    # bone trace. Animation frames are plain dicts carrying only coordinates
+    # (styling stays on the first frame's traces), and float32 numpy slices
+    # are written by plotly as base64 typed arrays rather than JSON numbers.
+    points = np.asarray(points, dtype=np.float32)
+    stride = frame_stride(len(points), decimate, max_frames)
+    shown = points[::stride]
+    bones = bone_pairs(joint_names) if show_bones else []
+    lines = bone_lines(shown, bones) if bones else None
+
+    def frame_traces(i):
+        traces = [dict(type='scatter3d', x=shown[i, :, 0], y=shown[i, :, 1], z=shown[i, :, 2])]
+        if lines is not None:
+            traces.append(dict(type='scatter3d', x=lines[i, :, 0], y=lines[i, :, 1], z=lines[i, :, 2]))
+        return traces
 
     # Create figure
-    fig = go.Figure()
-
-    # Animation frames
-    frames_list = []
-    for frame_idx in range(len(frames)):
-        frame_data = []
-        for i in range(num_joints):
-            x = [df.iloc[frame_idx, i * 3 + 1]]
-            y = [df.iloc[frame_idx, i * 3 + 2]]
-            z = [df.iloc[frame_idx, i * 3 + 3]]
-
-            frame_data.append(go.Scatter3d(
-                x=x, y=y, z=z,
-                mode='markers',
-                marker=dict(size=5),
-                name=joint_names[i],
-                showlegend=False
-            ))
-
-        frames_list.append(go.Frame(data=frame_data, name=str(frame_idx)))
-
-    # Add first frame
-    for i in range(num_joints):
-        x = [df.iloc[0, i * 3 + 1]]
-        y = [df.iloc[0, i * 3 + 2]]
-        z = [df.iloc[0, i * 3 + 3]]
-        fig.add_trace(go.Scatter3d(
-            x=x, y=y, z=z,
-            mode='markers',
-            marker=dict(size=5),
-            name=joint_names[i]
-        ))
+    first = frame_traces(0)
+    first[0].update(mode='markers', marker=dict(size=MARKER_SIZE), name='joints',
+                    text=list(joint_names), hoverinfo='text')
+    if lines is not None:
+        first[1].update(mode='lines', line=dict(width=BONE_WIDTH), name='bones', hoverinfo='skip')
+    traces = list(range(len(first)))
+    frames_list = [dict(data=frame_traces(i), traces=traces, name=str(i * stride)) for i in range(len(shown))]
+    fig = go.Figure(data=first, frames=frames_list)
 
     # Layout
+    duration = 1000 * stride / fps
     fig.update_layout(
-        title=f"3D Joint Animation: {file_name}",
+        title=title if stride == 1 else f"{title} (1 frame in {stride})",
         scene=dict(
             xaxis=dict(title='X', range=X_LIMITS),
             yaxis=dict(title='Y', range=Y_LIMITS),
@@ -75,7 +121,8 @@ for file_name in csv_files:
                 buttons=[
                     dict(label='Play',
                          method='animate',
-                         args=[None, dict(frame=dict(duration=50, redraw=True), fromcurrent=True)]),
+                         args=[None, dict(frame=dict(duration=duration, redraw=True), transition=dict(duration=0),
+                                          fromcurrent=True)]),
                     dict(label='Pause',
                          method='animate',
                          args=[[None], dict(frame=dict(duration=0, redraw=False), mode='immediate')])
@@ -84,14 +131,50 @@ for file_name in csv_files:
         ],
         margin=dict(l=0, r=0, t=40, b=0)
     )
+    return fig
+
+
+def export_html(fig, path):
+    # one self-contained file (plotly.js inlined), playable offline
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fig.write_html(path, include_plotlyjs=True, auto_play=False)
+    return path
+
+
+# --- LOOP THROUGH ALL 3D TRIALS ---
+if __name__ == "__main__" and serve_session:
+    # frames are streamed from the memory-mapped trial folders on demand
+    from playback_server import serve
+    serve(csv_dir)
+
+elif __name__ == "__main__":
+    # binary trial folders are memory-mapped; CSVs are only parsed for trials
+    # that have no folder (older step3 runs)
+    trial_paths = find_trials(csv_dir)
+    have_trial = {os.path.basename(p) for p in trial_paths}
+    csv_files = [os.path.join(csv_dir, f) for f in sorted(os.listdir(csv_dir))
+                 if f.endswith('.csv') and f[:-len('.csv')] not in have_trial]
+    input_paths = sorted(trial_paths + csv_files)
+
+    for file_path in input_paths:
+        file_name = os.path.basename(file_path)
+        print(f"\n📈 Visualizing: {file_name}")
+
+        # Load points (frames, joints, 3)
+        points, joint_names = load_points(file_path)
+        fig = build_figure(points, joint_names, f"3D Joint Animation: {file_name}",
+                           decimate=decimate, max_frames=max_frames, show_bones=show_bones)
 
-    fig.frames = frames_list
+        if html_dir:
+            html_path = export_html(fig, os.path.join(html_dir, os.path.splitext(file_name)[0] + '.html'))
+            print(f"💾 {html_path} ({os.path.getsize(html_path) / 1e6:.1f} MB)")
+            continue
 
-    # Show the animation
-    fig.show()
+        # Show the animation
+        fig.show()
 
-    # Ask user whether to continue
-    response = input("\n▶️ Press Enter to view next file, or type 'q' to quit: ").strip().lower()
-    if response == 'q':
-        print("🛑 Visualization stopped.")
-        break
+        # Ask user whether to continue
+        response = input("\n▶️ Press Enter to view next file, or type 'q' to quit: ").strip().lower()
+        if response == 'q':
+            print("🛑 Visualization stopped.")
+            break
@@ -0,0 +1,84 @@
+import json
+import threading
+
+import cv2
+import numpy as np
+
+import pose_backend
+from pose_backend import FakePoseBackend, InferenceService
+
+
+def write_clip(path, n_frames, size=(64, 48)):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), 30, size)
+    for i in range(n_frames):
+        writer.write(np.full((size[1], size[0], 3), (i * 20) % 255, dtype=np.uint8))
+    writer.release()
+    return str(path)
+
+
+def close_within(service, timeout=10):
+    # close() must return even when a job failed
+    closer = threading.Thread(target=service.close, daemon=True)
+    closer.start()
+    closer.join(timeout)
+    return not closer.is_alive()
+
+
+def frame_ids(json_path):
+    with open(json_path) as f:
+        return sorted({int(entry["image_id"].split(".")[0]) for entry in json.load(f)})
+
+
+def test_batches_span_clips(tmp_path, monkeypatch):
+    # a long idle timeout leaves batching to the frame count alone:
+    # 10 + 7 + 5 frames pack into 8, 8 and a final 6 flushed at close
+    monkeypatch.setattr(pose_backend, "IDLE_FLUSH_SECONDS", 5.0)
+    backend = FakePoseBackend()
+    service = InferenceService(backend, batch_size=8)
+    lengths = [10, 7, 5]
+    jobs = [service.submit(write_clip(tmp_path / f"cam{i}.avi", n), str(tmp_path / f"cam{i}.json"))
+            for i, n in enumerate(lengths)]
+    service.start()
+    assert close_within(service)
+
+    assert backend.batch_sizes == [8, 8, 6]
+    for job, n in zip(jobs, lengths):
+        assert job.error is None
+        # frame numbering restarts for every clip
+        assert frame_ids(job.json_path) == list(range(n))
+
+
+def test_idle_flush_runs_partial_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(pose_backend, "IDLE_FLUSH_SECONDS", 0.2)
+    backend = FakePoseBackend()
+    finished = threading.Event()
+    service = InferenceService(backend, batch_size=8, on_job_done=lambda job: finished.set()).start()
+    job = service.submit(write_clip(tmp_path / "cam0.avi", 5), str(tmp_path / "cam0.json"))
+
+    # the job completes while the service is still open
+    assert finished.wait(5)
+    assert backend.batch_sizes == [5]
+    assert frame_ids(job.json_path) == list(range(5))
+    assert close_within(service)
+
+
+def test_failed_jobs_do_not_hang(tmp_path, monkeypatch):
+    real_capture = cv2.VideoCapture
+
+    def capture(path):
+        if path.endswith("broken.avi"):
+            raise RuntimeError("decoder crashed")
+        return real_capture(path)
+
+    monkeypatch.setattr(pose_backend.cv2, "VideoCapture", capture)
+    service = InferenceService(FakePoseBackend(), batch_size=4).start()
+    broken = service.submit(write_clip(tmp_path / "broken.avi", 3), str(tmp_path / "broken.json"))
+    unwritable = service.submit(write_clip(tmp_path / "cam1.avi", 3), str(tmp_path / "missing" / "cam1.json"))
+    good = service.submit(write_clip(tmp_path / "cam2.avi", 3), str(tmp_path / "cam2.json"))
+    assert close_within(service)
+
+    assert "decode failed" in broken.error
+    assert "writing results failed" in unwritable.error
+    assert good.error is None
+    assert frame_ids(good.json_path) == list(range(3))
+    assert len(service.done) == 3
@@ -0,0 +1,23 @@
+import os
+
+import numpy as np
+from aniposelib.cameras import CameraGroup
+
+from triangulation import load_calibration, synthetic_views, triangulate_dlt
+
+CALIBRATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "calibration.toml")
+
+
+def test_dlt_matches_aniposelib():
+    # the unweighted batched solve must reproduce cgroup.triangulate on
+    # points projected through the shipped calibration
+    calib = load_calibration(CALIBRATION)
+    cgroup = CameraGroup.load(CALIBRATION)
+    _, points, _ = synthetic_views(calib, n_frames=500)
+
+    ours = triangulate_dlt(calib, points)
+    theirs = cgroup.triangulate(points, progress=False)
+
+    assert np.array_equal(np.isnan(ours), np.isnan(theirs))
+    assert np.allclose(ours, theirs, rtol=0, atol=1e-6, equal_nan=True)
+
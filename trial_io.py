@@ -0,0 +1,157 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# --- 3D TRIAL STORE ---
+# One folder per trial holding plain .npy arrays (memory-mappable with
+# np.load(mmap_mode='r')) plus a small JSON header:
+#   points.npy        (frames, joints, 3) float64, filtered 3D positions
+#   reproj_error.npy  (frames, joints) mean reprojection error in pixels
+#   scores.npy        (frames, joints) mean 2D score of the views used
+#   n_views.npy       (frames, joints) number of views that went into the point
+#   views_used.npy    (frames, joints) uint8 bitmask of those views (bit c = camera c
+#                     in the header's camera order)
+#   camera_error.npy  (frames, joints, cameras) float32 reprojection error of every view
+#   header.json       bodyparts, fps, array names and any extra metadata
+# header.json is written last, so a folder without it is an unfinished trial.
+TRIAL_SUFFIX = "_3d"
+HEADER_FILE = "header.json"
+TRIAL_ARRAYS = ("points", "reproj_error", "scores", "n_views", "views_used", "camera_error")
+CSV_CHUNK_ROWS = 10000
+
+
+def trial_dir_for(output_folder, name):
+    return os.path.join(output_folder, f"{name}{TRIAL_SUFFIX}")
+
+
+def write_header(trial_dir, header):
+    tmp_path = os.path.join(trial_dir, HEADER_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(header, f, indent=4)
+    header_path = os.path.join(trial_dir, HEADER_FILE)
+    os.replace(tmp_path, header_path)
+    return header_path
+
+
+def trial_header(bodyparts, n_frames, fps, stored, extra):
+    header = {
+        "bodyparts": list(bodyparts),
+        "n_frames": int(n_frames),
+        "fps": fps,
+        "arrays": list(stored),
+    }
+    header.update(extra or {})
+    return header
+
+
+def clear_header(trial_dir):
+    os.makedirs(trial_dir, exist_ok=True)
+    header_path = os.path.join(trial_dir, HEADER_FILE)
+    if os.path.exists(header_path):
+        os.remove(header_path)
+
+
+def save_trial(trial_dir, points, bodyparts, fps=None, extra=None, **arrays):
+    clear_header(trial_dir)
+    arrays = dict(arrays, points=points)
+    stored = []
+    for name, array in arrays.items():
+        if array is None:
+            continue
+        np.save(os.path.join(trial_dir, f"{name}.npy"), np.ascontiguousarray(array))
+        stored.append(name)
+    return write_header(trial_dir, trial_header(bodyparts, points.shape[0], fps, stored, extra))
+
+
+class TrialWriter:
+    # A trial filled frame range by frame range: every array is preallocated
+    # on disk as a NaN/zero .npy and written through a memory map, so a trial
+    # of any length never has to fit in memory. close() writes the header.
+    # arrays: {name: (shape after the frame axis, dtype)}
+    def __init__(self, trial_dir, n_frames, bodyparts, arrays):
+        clear_header(trial_dir)
+        self.trial_dir = trial_dir
+        self.n_frames = n_frames
+        self.bodyparts = list(bodyparts)
+        self.arrays = {}
+        for name, (shape, dtype) in arrays.items():
+            array = np.lib.format.open_memmap(os.path.join(trial_dir, f"{name}.npy"), mode="w+",
+                                              dtype=dtype, shape=(int(n_frames),) + tuple(shape))
+            array[:] = np.nan if np.issubdtype(array.dtype, np.floating) else 0
+            self.arrays[name] = array
+
+    def write(self, start, **arrays):
+        for name, data in arrays.items():
+            self.arrays[name][start:start + len(data)] = data
+
+    def close(self, fps=None, extra=None):
+        for array in self.arrays.values():
+            array.flush()
+        stored = list(self.arrays)
+        self.arrays = {}
+        return write_header(self.trial_dir, trial_header(self.bodyparts, self.n_frames, fps, stored, extra))
+
+
+def is_trial_dir(path):
+    return os.path.isfile(os.path.join(path, HEADER_FILE))
+
+
+def load_trial(trial_dir, mmap=True):
+    # header fields plus every stored array; arrays are memory-mapped unless
+    # mmap=False, so opening a long trial reads nothing until it is sliced
+    with open(os.path.join(trial_dir, HEADER_FILE), "r") as f:
+        trial = json.load(f)
+    for name in trial["arrays"]:
+        trial[name] = np.load(os.path.join(trial_dir, f"{name}.npy"), mmap_mode="r" if mmap else None)
+    trial["name"] = os.path.basename(os.path.normpath(trial_dir))[:-len(TRIAL_SUFFIX)]
+    return trial
+
+
+def find_trials(folder):
+    # sorted trial folders directly under folder
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, d) for d in os.listdir(folder)
+                  if d.endswith(TRIAL_SUFFIX) and is_trial_dir(os.path.join(folder, d)))
+
+
+# --- CSV EXPORT ---
+def csv_columns(bodyparts):
+    return ["Frame"] + [f"{bp}_{axis}" for bp in bodyparts for axis in ["X", "Y", "Z"]]
+
+
+def trial_frame(points, bodyparts, first_frame=0):
+    # (frames, joints, 3) -> the Frame, <joint>_X, <joint>_Y, <joint>_Z table
+    n_frames = len(points)
+    frames = np.arange(first_frame, first_frame + n_frames)
+    table = np.column_stack([frames, np.asarray(points).reshape(n_frames, -1)])
+    df = pd.DataFrame(table, columns=csv_columns(bodyparts))
+    df["Frame"] = df["Frame"].astype(int)
+    return df
+
+
+def append_csv(points, bodyparts, csv_path, first_frame):
+    # rows first_frame.. of the table; the file (and its header) is started
+    # at frame 0
+    start = first_frame == 0
+    trial_frame(points, bodyparts, first_frame).to_csv(csv_path, index=False, mode="w" if start else "a",
+                                                       header=start)
+
+
+def export_csv(points, bodyparts, csv_path, chunk_rows=CSV_CHUNK_ROWS):
+    # written in row blocks, so a memory-mapped trial is never loaded whole
+    for start in range(0, max(len(points), 1), chunk_rows):
+        append_csv(points[start:start + chunk_rows], bodyparts, csv_path, start)
+
+
+def load_points(path):
+    # (points, bodyparts) from a trial folder or a legacy 3D CSV
+    if os.path.isdir(path):
+        trial = load_trial(path)
+        return trial["points"], trial["bodyparts"]
+    df = pd.read_csv(path)
+    keypoints = [col for col in df.columns if col != 'Frame']
+    bodyparts = [keypoints[i * 3].rsplit('_', 1)[0] for i in range(len(keypoints) // 3)]
+    return df[keypoints].to_numpy().reshape(len(df), -1, 3), bodyparts
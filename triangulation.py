@@ -0,0 +1,280 @@
+import argparse
+import itertools
+import time
+
+import cv2
+import numpy as np
+import toml
+
+# --- SETTINGS ---
+MIN_VIEWS = 2               # views needed for a 3D point
+SOLVE_CHUNK = 200000        # points per batched solve, bounds the (N, 2C, 4) system in memory
+INVERSE_ITERATIONS = 2      # refinement steps from the least-squares start to the DLT (SVD) solution
+RANSAC_THRESHOLD_PX = 15.0  # a view subset is accepted when every view in it reprojects within this
+
+
+# --- CALIBRATION ---
+def load_calibration(path):
+    # calibration.toml (aniposelib layout) -> stacked camera arrays, in the
+    # cam_0, cam_1, ... order CameraGroup.load uses
+    data = toml.load(path)
+    keys = sorted((k for k in data if k.startswith("cam_")), key=lambda k: int(k.split("_")[1]))
+    calib = {
+        "names": [str(data[k]["name"]) for k in keys],
+        "size": np.array([data[k]["size"] for k in keys], dtype=np.float64),
+        "matrix": np.array([data[k]["matrix"] for k in keys], dtype=np.float64),
+        "dist": np.array([data[k]["distortions"] for k in keys], dtype=np.float64),
+        "rvec": np.array([data[k]["rotation"] for k in keys], dtype=np.float64),
+        "tvec": np.array([data[k]["translation"] for k in keys], dtype=np.float64),
+    }
+    rotations = np.array([cv2.Rodrigues(r)[0] for r in calib["rvec"]])
+    calib["extrinsics"] = np.concatenate([rotations, calib["tvec"][:, :, None]], axis=2)
+    return calib
+
+
+# --- BULK UNDISTORTION AND PROJECTION ---
+def undistort_points(calib, points):
+    # (C, N, 2) pixels -> (C, N, 2) normalized image coordinates, one OpenCV
+    # call per camera for every frame and joint at once; NaN stays NaN
+    out = np.full(points.shape, np.nan)
+    for c in range(len(points)):
+        good = np.isfinite(points[c]).all(axis=1)
+        if good.any():
+            pts = np.ascontiguousarray(points[c, good], dtype=np.float64).reshape(-1, 1, 2)
+            out[c, good] = cv2.undistortPoints(pts, calib["matrix"][c], calib["dist"][c]).reshape(-1, 2)
+    return out
+
+
+def project(calib, p3ds):
+    # (N, 3) -> (C, N, 2) pixels, with lens distortion
+    out = np.full((len(calib["names"]), len(p3ds), 2), np.nan)
+    good = np.isfinite(p3ds).all(axis=1)
+    if good.any():
+        pts = np.ascontiguousarray(p3ds[good], dtype=np.float64).reshape(-1, 1, 3)
+        for c in range(len(out)):
+            proj = cv2.projectPoints(pts, calib["rvec"][c], calib["tvec"][c], calib["matrix"][c], calib["dist"][c])[0]
+            out[c, good] = proj.reshape(-1, 2)
+    return out
+
+
+def camera_errors(calib, p3ds, points):
+    # (C, N) pixel distance between every view's 2D point and the reprojected
+    # 3D point, all cameras in one pass; NaN where either is missing
+    return np.linalg.norm(project(calib, p3ds) - points, axis=2)
+
+
+def mean_view_error(errors, min_views=MIN_VIEWS):
+    # (C, N) camera errors -> (N,) mean over the views that saw each point,
+    # NaN below min_views (same convention as CameraGroup.reprojection_error(mean=True))
+    good = np.isfinite(errors)
+    count = good.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(good, errors, 0).sum(axis=0) / count
+    mean[count < min_views] = np.nan
+    return mean
+
+
+def reprojection_error(calib, p3ds, points, min_views=MIN_VIEWS):
+    return mean_view_error(camera_errors(calib, p3ds, points), min_views)
+
+
+# --- BATCHED DLT ---
+def solve3(m, rhs):
+    # closed-form (Cramer) solve of a stack of 3x3 systems
+    c0 = np.cross(m[:, 1], m[:, 2])
+    c1 = np.cross(m[:, 2], m[:, 0])
+    c2 = np.cross(m[:, 0], m[:, 1])
+    det = np.einsum("ni,ni->n", m[:, 0], c0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (rhs[:, 0:1] * c0 + rhs[:, 1:2] * c1 + rhs[:, 2:3] * c2) / det[:, None]
+
+
+def camera_normal_matrices(extrinsics, normalized, weights):
+    # (C, N, 4, 4): each camera's share of M = A^T A for every point's
+    # weighted DLT system; a subset of views is just a sum over cameras
+    x = normalized[..., 0:1]
+    y = normalized[..., 1:2]
+    rows_x = x * extrinsics[:, None, 2, :] - extrinsics[:, None, 0, :]
+    rows_y = y * extrinsics[:, None, 2, :] - extrinsics[:, None, 1, :]
+    rows = np.nan_to_num(np.stack([rows_x, rows_y], axis=2) * weights[..., None, None])
+    return rows.transpose(0, 1, 3, 2) @ rows
+
+
+def solve_normal(m, n_views):
+    # The DLT answer is the right singular vector of each point's 2C x 4
+    # system with the smallest singular value, i.e. the smallest eigenvector
+    # of M = A^T A. Batched LAPACK SVD is slow for millions of tiny matrices,
+    # so start from the closed-form least-squares point (w = 1) and polish it
+    # with inverse iteration.
+    m = m.copy()
+    m[n_views < 2] = np.eye(4)
+    start = solve3(m[:, :3, :3], -m[:, :3, 3])
+    v = np.concatenate([start, np.ones((len(m), 1))], axis=1)
+    v[~np.isfinite(v).all(axis=1)] = [0.0, 0.0, 0.0, 1.0]
+    # a tiny shift keeps noise-free points (exactly singular M) solvable
+    m += (1e-12 * np.trace(m, axis1=1, axis2=2))[:, None, None] * np.eye(4)
+    for _ in range(INVERSE_ITERATIONS):
+        v = np.linalg.solve(m, v[..., None])[..., 0]
+        v /= np.linalg.norm(v, axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return v[:, :3] / v[:, 3:]
+
+
+def solve_dlt(extrinsics, normalized, weights):
+    # every point's system solved in one batch; a view with weight 0
+    # contributes nothing. Returns (N, 3).
+    m = camera_normal_matrices(extrinsics, normalized, weights).sum(axis=0)
+    return solve_normal(m, (weights > 0).sum(axis=0))
+
+
+def triangulate_dlt(calib, points, scores=None, undistort=True, min_views=MIN_VIEWS):
+    # (C, N, 2) pixel points (NaN = missing) -> (N, 3). Each view is weighted
+    # by its 2D score when scores (C, N) are given, so a shaky detection
+    # pulls the solution less than a confident one.
+    normalized = undistort_points(calib, points) if undistort else np.asarray(points, dtype=np.float64)
+    valid = np.isfinite(normalized).all(axis=2)
+    weights = valid.astype(np.float64)
+    if scores is not None:
+        weights *= np.clip(np.nan_to_num(scores), 0, None)
+    n_points = normalized.shape[1]
+    out = np.full((n_points, 3), np.nan)
+    for start in range(0, n_points, SOLVE_CHUNK):
+        stop = min(start + SOLVE_CHUNK, n_points)
+        out[start:stop] = solve_dlt(calib["extrinsics"], normalized[:, start:stop], weights[:, start:stop])
+    out[(valid & (weights > 0)).sum(axis=0) < min_views] = np.nan
+    return out
+
+
+# --- ROBUST VIEW SELECTION ---
+def view_subsets(n_cams, min_views=MIN_VIEWS):
+    # every camera subset, largest first
+    return [subset for size in range(n_cams, min_views - 1, -1)
+            for subset in itertools.combinations(range(n_cams), size)]
+
+
+def camera_subset(calib, cams):
+    return dict(calib, names=[calib["names"][c] for c in cams], size=calib["size"][cams],
+                matrix=calib["matrix"][cams], dist=calib["dist"][cams], rvec=calib["rvec"][cams],
+                tvec=calib["tvec"][cams], extrinsics=calib["extrinsics"][cams])
+
+
+def triangulate_ransac(calib, points, scores=None, threshold_px=RANSAC_THRESHOLD_PX, min_views=MIN_VIEWS):
+    # Triangulates every frame and joint from every camera subset at once and
+    # keeps, per point, the largest subset in which every view reprojects
+    # within threshold_px (lowest mean error among subsets of that size). A
+    # wrong but confident view (left/right swap, occlusion) is thereby dropped.
+    # Returns (N, 3) points, (N,) mean error of the kept subset and an (N,) bitmask
+    # of the views used (bit c = camera c); points no subset explains are NaN.
+    normalized = undistort_points(calib, points)
+    valid = np.isfinite(normalized).all(axis=2)
+    weights = valid.astype(np.float64)
+    if scores is not None:
+        weights *= np.clip(np.nan_to_num(scores), 0, None)
+    present = valid & (weights > 0)
+    n_cams, n_points = present.shape
+
+    best = np.full((n_points, 3), np.nan)
+    best_error = np.full(n_points, np.inf)
+    best_size = np.zeros(n_points, dtype=int)
+    views_used = np.zeros(n_points, dtype=np.uint8)
+    for start in range(0, n_points, SOLVE_CHUNK):
+        chunk = slice(start, min(start + SOLVE_CHUNK, n_points))
+        per_cam = camera_normal_matrices(calib["extrinsics"], normalized[:, chunk], weights[:, chunk])
+        for subset in view_subsets(n_cams, min_views):
+            cams = list(subset)
+            usable = present[cams, chunk].all(axis=0)
+            if not usable.any():
+                continue
+            p3d = solve_normal(per_cam[cams].sum(axis=0), np.where(usable, len(cams), 0))
+            views = camera_errors(camera_subset(calib, cams), p3d, points[cams, chunk])
+            error = np.where(usable, views.mean(axis=0), np.inf)
+            worst = np.where(usable, views.max(axis=0), np.inf)
+            # subsets come largest first, so a smaller one only wins while
+            # nothing bigger has been accepted
+            size = best_size[chunk]
+            take = (worst < threshold_px) & ((size == 0) | ((size == len(cams)) & (error < best_error[chunk])))
+            idx = np.flatnonzero(take) + start
+            best[idx] = p3d[take]
+            best_error[idx] = error[take]
+            best_size[idx] = len(cams)
+            views_used[idx] = sum(1 << c for c in cams)
+    best_error[best_size == 0] = np.nan
+    return best, best_error, views_used
+
+
+# --- SYNTHETIC DATA AND BENCHMARK ---
+def synthetic_views(calib, n_frames, n_joints=17, noise_px=0.5, missing=0.05, outliers=0.0, seed=0):
+    # random skeleton in front of the cameras, projected through the real
+    # calibration; pixel noise grows as the 2D score drops, some detections
+    # are missing and an outliers fraction has one confidently wrong view
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_frames)[:, None, None] / 30.0
+    center = np.array([0.0, 0.0, 2500.0])
+    p3ds = center + rng.normal(0, 300, (1, n_joints, 3)) + 200 * np.sin(t + rng.random((1, n_joints, 3)) * 6)
+    p3ds = p3ds.reshape(-1, 3)
+    points = project(calib, p3ds)
+    scores = rng.uniform(0.3, 1.0, points.shape[:2])
+    points += rng.normal(0, 1, points.shape) * (noise_px / scores[..., None])
+    wrong = np.flatnonzero(rng.random(points.shape[1]) < outliers)
+    cams = rng.integers(0, len(points), len(wrong))
+    angle = rng.uniform(0, 2 * np.pi, len(wrong))
+    shift = rng.uniform(50, 150, len(wrong))
+    points[cams, wrong] += shift[:, None] * np.stack([np.cos(angle), np.sin(angle)], axis=1)
+    scores[cams, wrong] = 0.95
+    dropped = rng.random(points.shape[:2]) < missing
+    points[dropped] = np.nan
+    scores[dropped] = 0.0
+    return p3ds, points, scores
+
+
+def robust_check(calibration_path, n_frames=2000, outliers=0.1):
+    # view selection must leave clean points alone and pull the ones with a
+    # wrong view back towards the truth
+    calib = load_calibration(calibration_path)
+    truth, points, scores = synthetic_views(calib, n_frames, outliers=outliers)
+    _, clean_points, _ = synthetic_views(calib, n_frames)
+    wrong = np.abs(np.nan_to_num(points - clean_points)).max(axis=(0, 2)) > 1
+    plain = triangulate_dlt(calib, points, scores)
+    robust, _, views_used = triangulate_ransac(calib, points, scores)
+    distance = lambda p, m: np.nanmedian(np.linalg.norm(p[m] - truth[m], axis=1))
+    print(f"🎯 {wrong.sum()} of {len(truth)} points with one wrong view")
+    print(f"   median error, wrong-view points   all views {distance(plain, wrong):8.2f} mm, "
+          f"selected {distance(robust, wrong):8.2f} mm")
+    print(f"   median error, clean points        all views {distance(plain, ~wrong):8.2f} mm, "
+          f"selected {distance(robust, ~wrong):8.2f} mm")
+    print(f"   dropped points {np.isnan(robust[:, 0]).mean():.2%}, "
+          f"all views kept on clean points {(views_used[~wrong] == (1 << len(points)) - 1).mean():.2%}")
+
+
+def benchmark(calibration_path, n_frames, repeat):
+    from aniposelib.cameras import CameraGroup
+    calib = load_calibration(calibration_path)
+    cgroup = CameraGroup.load(calibration_path)
+    _, points, scores = synthetic_views(calib, n_frames)
+    cgroup.triangulate(points[:, :100], progress=False)  # warm up any JIT
+    results = {}
+    for name, fn in [("aniposelib", lambda: cgroup.triangulate(points, progress=False)),
+                     ("dlt", lambda: triangulate_dlt(calib, points)),
+                     ("dlt weighted", lambda: triangulate_dlt(calib, points, scores)),
+                     ("ransac", lambda: triangulate_ransac(calib, points, scores))]:
+        best = float("inf")
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - t0)
+        results[name] = best
+    print(f"📊 {n_frames} frames x 17 joints x {len(calib['names'])} cameras (best of {repeat})")
+    for name, seconds in results.items():
+        print(f"   {name:<13} {seconds * 1000:9.1f} ms  {points.shape[1] / seconds / 1e6:6.2f} M points/s")
+    return results
+
+
+if __name__ == "__main__":
+    # the agreement with aniposelib is checked by test_triangulation.py
+    parser = argparse.ArgumentParser(description="Batched DLT triangulation: view selection report and benchmark")
+    parser.add_argument("--calibration", default="calibration.toml")
+    parser.add_argument("--frames", type=int, default=18000, help="10 minutes at 30 fps")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    robust_check(args.calibration)
+    benchmark(args.calibration, args.frames, args.repeat)